@@ -1,20 +1,419 @@
 # Module defining simple REST API for user signup & data retrieval
 
+from urllib.parse import urlencode
+import base64
+import binascii
+import json
+import logging
+import math
+
 import falcon
 
-import user, auth, session
+import user, auth, session, hashing, cache, config, metrics, patch, ratelimit
+import writebehind, encoding
+
+def create_user_storage():
+    """Returns a new user Datastore, configured per the config module"""
+    user_cache = None # default
+    if config.USER_CACHE_SIZE > 0:
+        user_cache = cache.LRUCache(max_size=config.USER_CACHE_SIZE,
+                                    ttl=config.USER_CACHE_TTL)
+    unknown_cache = None # default
+    if config.UNKNOWN_USER_CACHE_SIZE > 0:
+        unknown_cache = cache.LRUCache(max_size=config.UNKNOWN_USER_CACHE_SIZE,
+                                       ttl=config.UNKNOWN_USER_CACHE_TTL)
+    engine_options = {'pool_pre_ping': config.DATABASE_POOL_PRE_PING}
+    pool_options = [('pool_recycle', config.DATABASE_POOL_RECYCLE)]
+    if not (config.DATABASE_URL or 'sqlite:').startswith('sqlite:'):
+        # (SQLite connections aren't pooled by size, so can't be sized)
+        pool_options.extend([('pool_size', config.DATABASE_POOL_SIZE),
+                             ('max_overflow', config.DATABASE_MAX_OVERFLOW)])
+    for option, value in pool_options:
+        if value is not None:
+            engine_options[option] = value
+    return user.Datastore(url=config.DATABASE_URL,
+                          engine_options=engine_options,
+                          cache=user_cache,
+                          sqlite_busy_timeout=config.SQLITE_BUSY_TIMEOUT,
+                          unknown_cache=unknown_cache,
+                          data_format=config.DATA_FORMAT,
+                          compress_threshold=config.DATA_COMPRESS_THRESHOLD,
+                          indexed_fields=sorted(config.INDEXED_FIELDS))
+
+def create_login_limiter():
+    """Returns a ratelimit.LoginLimiter per the config module, or None"""
+    if not (config.LOGIN_USER_RATE > 0 or config.LOGIN_ADDRESS_RATE > 0):
+        return None # rate limiting disabled
+    return ratelimit.LoginLimiter(user_rate=config.LOGIN_USER_RATE,
+                                  user_burst=config.LOGIN_USER_BURST,
+                                  address_rate=config.LOGIN_ADDRESS_RATE,
+                                  address_burst=config.LOGIN_ADDRESS_BURST,
+                                  max_keys=config.LOGIN_LIMITER_SIZE)
+
+def create_write_buffer():
+    """Returns a writebehind.WriteBuffer per the config module, or None"""
+    if not config.WRITE_BEHIND_WINDOW > 0:
+        return None # write-behind disabled
+    return writebehind.WriteBuffer(user_storage,
+                                   window=config.WRITE_BEHIND_WINDOW,
+                                   max_pending=config.WRITE_BEHIND_MAX_PENDING)
+
+user_storage = create_user_storage()
+write_buffer = create_write_buffer()
+login_limiter = create_login_limiter()
+response_cache = cache.LRUCache(max_size=config.RESPONSE_CACHE_SIZE)
+compressed_cache = cache.LRUCache(max_size=config.RESPONSE_CACHE_SIZE)
+json_handler = encoding.JSONHandler(config.JSON_LIBRARY)
+hash_policy = hashing.HashPolicy(memory_cost=config.HASH_MEMORY_COST,
+                                 time_cost=config.HASH_TIME_COST,
+                                 parallelism=config.HASH_PARALLELISM)
+hash_pool = hashing.HashingPool(max_workers=config.HASH_WORKERS,
+                                max_queue=config.HASH_QUEUE_DEPTH,
+                                pool_type=config.HASH_POOL_TYPE)
+
+def report_gauges():
+    """
+    Returns list of tuples: metric name, labels & value for API counters
+
+    >>> ('restdemo_hash_pool_pending', {}, 0) in report_gauges()
+    True
+    """
+    gauges = [('restdemo_hash_pool_' + name, {}, value)
+              for name, value in sorted(hash_pool.stats().items())]
+    for cache_name, lru_cache in [('user', user_storage.cache),
+                                  ('unknown_user', user_storage.unknown_cache),
+                                  ('response', response_cache),
+                                  ('compressed', compressed_cache)]:
+        if lru_cache is None:
+            continue # caching disabled
+        gauges.extend(('restdemo_cache_' + name, {'cache': cache_name}, value)
+                      for name, value in sorted(lru_cache.stats().items()))
+    if write_buffer is not None:
+        gauges.extend(('restdemo_write_behind_' + name, {}, value)
+                      for name, value in sorted(write_buffer.stats().items()))
+    return gauges
+
+def warmup():
+    """
+    Prepare this process' resources, ahead of its first request
+
+    Creates the user database engine (& a first connection) & loads the
+    password hashing library. Each is otherwise created on first use, so
+    failures are logged, not raised.
+
+    >>> warmup()
+    >>> user_storage.loaded
+    True
+    """
+    logger = logging.getLogger(warmup.__name__)
+    for name, step in [('user storage', user_storage.warmup),
+                       ('password hashing', lambda: hash_policy.handler)]:
+        try:
+            step()
+        except Exception:
+            logger.exception('Warmup of %s failed', name)
+
+metrics.registry.sample_rate = config.METRICS_SAMPLE_RATE
+metrics.registry.add_gauge_callback(report_gauges)
+
+def run_hashing_job(function, *args):
+    """
+    Returns result of password hashing job, run on the hashing pool
+
+    Raises HTTP 503 (with a Retry-After header) if the pool is saturated
+
+    Keyword Parameters:
+      function  -- callable, hashing job to run (e.g.: user.hash_password)
+      args  -- positional arguments for function
+    """
+    try:
+        with metrics.timed('hash_pool'): # includes any wait for a worker
+            return hash_pool.run(function, *args)
+    except hashing.PoolSaturatedException:
+        raise falcon.HTTPServiceUnavailable(
+            title='Server busy', retry_after=config.HASH_RETRY_AFTER)
+
+def etag_matches(if_none_match, etag):
+    """
+    Returns True if If-None-Match header value matches the entity tag
+
+    Keyword Parameters:
+      if_none_match  -- String, HTTP If-None-Match request header (or None)
+      etag  -- String, quoted entity tag of the current representation
+
+    >>> etag_matches('"abc"', '"abc"')
+    True
+    >>> etag_matches('"xyz", W/"abc"', '"abc"') # weak comparison
+    True
+    >>> etag_matches('*', '"abc"')
+    True
+    >>> etag_matches('"xyz"', '"abc"')
+    False
+    >>> etag_matches(None, '"abc"')
+    False
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate in ('*', etag):
+            return True
+    return False
+
+def parse_fields(fields):
+    """
+    Returns tuple of requested user data fields, or None (for all data)
+
+    Keyword Parameters:
+      fields  -- String of comma-separated, top-level or dotted-path
+        keys (or List of Strings, as parsed by Falcon), or None
+
+    >>> parse_fields('phone,address.city,phone')
+    ('address.city', 'phone')
+    >>> parse_fields(None) is None
+    True
+    """
+    if fields is None:
+        return None
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    return tuple(sorted(set(field.strip() for field in fields if field.strip())))
+
+def get_user_record(username, fields=None):
+    """
+    Returns tuple: dict representing referenced user & its data version
+
+    Data for which a write is pending (see: write_buffer) is returned, so
+    users read their own writes.
+
+    Keyword Parameters:
+      username  -- String, name of the user to retrieve
+      fields  -- List of Strings, user data keys to return (Optional)
+    """
+    if write_buffer is not None:
+        pending = write_buffer.get(username)
+        if pending is not None:
+            new_data, version = pending
+            if fields is not None:
+                new_data = user.project_data(new_data, fields)
+            return {'username': username, 'data': new_data}, version
+    return user.get_user_record(user_storage, username, fields)
+
+def update_user_data(username, new_data):
+    """
+    Replace referenced user's JSON data, or buffer it (see: write_buffer)
+
+    Keyword Parameters:
+      username  -- String, name of the user to update
+      new_data  -- Dict, List, or String representing new JSON data
+    """
+    if write_buffer is not None:
+        write_buffer.put(username, new_data)
+        return
+    user.update_user_data(user_storage, username, new_data)
+
+def delete_user(username):
+    """Remove referenced user, & discard any write pending for them"""
+    user.delete_user(user_storage, username)
+    if write_buffer is not None:
+        write_buffer.discard(username)
+
+def send_user_data(req, resp, username):
+    """
+    Respond with JSON data for referenced user
 
-user_storage = user.Datastore()
+    Repeat requests for an unchanged user are answered from a cache of
+    encoded response bodies, or with HTTP 304 if the client sent a
+    matching If-None-Match header. If the request has a 'fields' query
+    parameter, only those fields of the user's data are sent.
+
+    Keyword Parameters:
+      req  -- Falcon HTTP request object representing current API call
+      resp  -- Falcon HTTP response object to populate
+      username  -- String, name of the user to respond with
+    """
+    fields = parse_fields(req.params.get('fields'))
+    user_data, version = get_user_record(username, fields)
+    etag = '"{}"'.format(version)
+    resp.etag = etag
+    resp.cache_control = ['private', 'no-cache'] # always revalidate
+    if etag_matches(req.if_none_match, etag):
+        resp.status = falcon.HTTP_NOT_MODIFIED
+        return
+    cache_key = (username, version, fields)
+    body = response_cache.get(cache_key)
+    if body is None:
+        body = json_handler.dumps(user_data)
+        response_cache.set(cache_key, body)
+    resp.data = body
+    resp.content_type = falcon.MEDIA_JSON
+
+def patch_user_data(username, content_type, body):
+    """
+    Apply a PATCH request body to referenced user's data
+
+    Raises HTTP 415 for unsupported patch formats, 400 for malformed
+    patches & 409 if the patch can't be applied to the current data
+
+    Keyword Parameters:
+      username  -- String, name of the user to update
+      content_type  -- String, HTTP Content-Type request header (or None)
+      body  -- bytes, HTTP PATCH request body
+
+    >>> patch_user_data('pat.ng', 'text/plain', b'')
+    Traceback (most recent call last):
+       ...
+    falcon.errors.HTTPUnsupportedMediaType: Use application/merge-patch+json or application/json-patch+json
+    """
+    media_type = (content_type or '').split(';', 1)[0].strip().lower()
+    patch_types = {patch.MERGE_PATCH: patch.MERGE_PATCH,
+                   'application/json': patch.MERGE_PATCH,
+                   patch.JSON_PATCH: patch.JSON_PATCH}
+    if media_type not in patch_types:
+        raise falcon.HTTPUnsupportedMediaType(
+            'Use {} or {}'.format(patch.MERGE_PATCH, patch.JSON_PATCH),
+            headers={'Accept-Patch': ', '.join([patch.MERGE_PATCH, patch.JSON_PATCH])})
+    try:
+        patch_document = json_handler.loads(body)
+    except ValueError:
+        raise falcon.HTTPBadRequest('Invalid JSON', 'Could not parse patch body')
+    if write_buffer is not None:
+        write_buffer.flush([username]) # patch the latest data
+    try:
+        user.patch_user_data(user_storage, username, patch_document,
+                             patch_types[media_type])
+    except patch.InvalidPatchException as e:
+        raise falcon.HTTPBadRequest('Invalid patch', str(e))
+    except patch.PatchConflictException as e:
+        raise falcon.HTTPConflict('Patch not applied', str(e))
+
+def require_admin(req):
+    """
+    Raise HTTP 401, unless the session user is an API administrator
+
+    Keyword Parameters:
+      req  -- Falcon HTTP request object representing current API call
+    """
+    session_user = session.get_user_name(req)
+    if not session_user:
+        raise falcon.HTTPUnauthorized(title='Login required')
+    if session_user not in config.ADMIN_USERS:
+        raise falcon.HTTPUnauthorized(title='Permission denied')
+
+def encode_json_lines(items):
+    """
+    Returns generator, yielding JSON Lines text (bytes) for each item
+
+    >>> lines = list(encode_json_lines([{'username': 'pat.ng'}, ['Hello World']]))
+    >>> [json.loads(line.decode('utf-8')) for line in lines]
+    [{'username': 'pat.ng'}, ['Hello World']]
+    >>> lines[-1][-1:]
+    b'\\n'
+    """
+    for item in items:
+        yield json_handler.dumps(item) + b'\n'
+
+def iter_lines(stream, chunk_size=64*1024, max_line_size=None):
+    """
+    Returns generator, yielding each line (bytes) read from the stream
+
+    Lines longer than max_line_size bytes are discarded as they are read
+    (rather than buffered), & None is yielded in their place.
+
+    >>> from io import BytesIO
+    >>> list(iter_lines(BytesIO(b'{"a": 1}\\n\\n["b"]'), chunk_size=3))
+    [b'{"a": 1}', b'', b'["b"]']
+    >>> list(iter_lines(BytesIO(b'["too long"]\\n["b"]'), 3, max_line_size=5))
+    [None, b'["b"]']
+    """
+    pending, discarding = b'', False
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop() # incomplete line
+        for line in lines:
+            if discarding:
+                discarding = False
+                yield None
+            elif max_line_size is not None and len(line) > max_line_size:
+                yield None
+            else:
+                yield line
+        if max_line_size is not None and len(pending) > max_line_size:
+            pending, discarding = b'', True
+    if discarding:
+        yield None
+    elif pending:
+        yield pending
+
+def read_limited(stream, limit):
+    """
+    Returns request body (bytes), raising HTTP 413 if it exceeds limit
+
+    Keyword Parameters:
+      stream  -- file-like object, to read the body from
+      limit  -- Integer, maximum body size in bytes (None: no limit)
+
+    >>> from io import BytesIO
+    >>> read_limited(BytesIO(b'12345'), 5)
+    b'12345'
+    >>> read_limited(BytesIO(b'123456'), 5)
+    Traceback (most recent call last):
+       ...
+    falcon.errors.HTTPRequestEntityTooLarge: ('Request body too large', 'Maximum request body size is 5 bytes')
+    """
+    if limit is None:
+        return stream.read()
+    body = stream.read(limit + 1) # never buffer more than 1 byte extra
+    if len(body) > limit:
+        raise body_too_large(limit)
+    return body
+
+def body_too_large(limit):
+    """Returns HTTP 413 error, for a body larger than limit bytes"""
+    return falcon.HTTPRequestEntityTooLarge(
+        'Request body too large',
+        'Maximum request body size is {} bytes'.format(limit))
+
+class RequestBodyLimit:
+    """
+    Falcon middleware, enforcing request body size limits
+
+    Bodies are limited to config.MAX_BODY_SIZE, unless the resource has
+    a max_body_size attribute (None: no limit). Oversized requests are
+    refused with HTTP 413 based on Content-Length, before the body is
+    read. URL-encoded form bodies are parsed here (instead of by Falcon,
+    which would read them before any limit could be checked).
+    """
+    def process_resource(self, req, resp, resource, params):
+        limit = getattr(resource, 'max_body_size', config.MAX_BODY_SIZE)
+        if limit is not None and (req.content_length or 0) > limit:
+            raise body_too_large(limit)
+        if (req.method not in ('GET', 'HEAD') and req.content_type and
+                'application/x-www-form-urlencoded' in req.content_type):
+            body = read_limited(req.bounded_stream, limit)
+            try:
+                form = body.decode('ascii') # form values are percent-encoded
+            except UnicodeDecodeError:
+                raise falcon.HTTPBadRequest('Invalid form',
+                                            'Non-ASCII characters found in form body')
+            req.params.update(falcon.uri.parse_query_string(
+                form, keep_blank_qs_values=req.options.keep_blank_qs_values,
+                parse_qs_csv=False))
 
 class BaseResource:
     """Falcon resource to handle requests with no URL path"""
     def on_get(self, req, resp):
         """Handle GET requests"""
-        json_body = ["Hello World"] #default
         login_user = session.get_user_name(req) #check login
         if login_user:
-            json_body = user.get_user_data(user_storage, login_user)
-        resp.media = json_body
+            send_user_data(req, resp, login_user)
+            return
+        resp.media = ["Hello World"] #default
 
 class UserResource:
     def on_post(self, req, resp):
@@ -35,21 +434,21 @@ class UserResource:
             request_password = req.params[password_post_field]
         except KeyError:
             raise falcon.HTTPMissingParam(password_post_field)
-        new_data = None #optional
-        if data_post_field in req.params:
-            # Falcon has special handling of commas in post data,
-            # our JSON text may be split on any commas into list of str
-            falcon_data = req.params[data_post_field]
-            new_data = falcon_data # default, assume text is unmangled
-            if isinstance(falcon_data, list): #text was munged
-                new_data = ','.join(falcon_data)#merge strings & add commas back in
+        new_data = req.params.get(data_post_field) #optional
+        if isinstance(new_data, list): # parameter was repeated
+            raise falcon.HTTPInvalidParam('Must be provided once',
+                                          data_post_field)
         # securely hash user password & attempt to add new user
-        new_hash = user.hash_password(request_password)
-        with user_storage.get_session() as storage_session:
-            user_storage.add(storage_session,
-                             new_name = request_username,
-                             new_hash = new_hash,
-                             new_json = new_data)
+        new_hash = run_hashing_job(user.hash_password, request_password,
+                                   hash_policy)
+        try:
+            user.add_user(user_storage,
+                          new_name = request_username,
+                          new_hash = new_hash,
+                          new_json = new_data)
+        except user.UserExistsException:
+            raise falcon.HTTPConflict('Username unavailable',
+                                      'User already exists')
         msg = 'Successfully signed up new user: {}'.format(request_username)
         resp.media = {'message': msg}
 
@@ -62,8 +461,7 @@ class UserResource:
             raise falcon.HTTPUnauthorized(title='Permission denied')
 
         # fetch data
-        user_data = user.get_user_data(user_storage, username)
-        resp.media = user_data
+        send_user_data(req, resp, username)
 
     def on_put(self, req, resp, username=None):
         """
@@ -80,7 +478,24 @@ class UserResource:
 
         # update data
         new_data = req.media
-        user.update_user_data(user_storage, username, new_data)
+        update_user_data(username, new_data)
+
+    def on_patch(self, req, resp, username=None):
+        """
+        Handle PATCH requests for partial user data update
+
+        The HTTP PATCH body is a JSON Merge Patch (Content-Type:
+        application/merge-patch+json, or application/json) or a JSON Patch
+        (application/json-patch+json) to apply to the user's JSON data.
+        """
+        session_user = session.get_user_name(req)
+        if not session_user:
+            raise falcon.HTTPUnauthorized(title='Login required')
+        if session_user != username:
+            raise falcon.HTTPUnauthorized(title='Permission denied')
+
+        # update data
+        patch_user_data(username, req.content_type, req.bounded_stream.read())
 
     def on_delete(self, req, resp, username=None):
         """Handle DELETE requests to remove user"""
@@ -91,10 +506,349 @@ class UserResource:
             raise falcon.HTTPUnauthorized(title='Permission denied')
 
         # delete user
-        user.delete_user(user_storage, username)
+        delete_user(username)
         # and revoke user's session token
         session.invalidate_session(req)
 
+class UserImportResource:
+    """Falcon Resource to handle bulk user creation requests"""
+    max_body_size = None # streamed; lines are limited instead
+    def on_post(self, req, resp):
+        """
+        Handle POST requests to create many users (administrators only)
+
+        The HTTP POST body is JSON Lines text: one JSON object per line,
+        each with keys:
+          username  -- New user to create (Required)
+          password  -- New user's password (Required, or pw_hash)
+          pw_hash  -- New user's existing argon2 password hash
+          data  -- JSON value containing user data (Optional)
+
+        Responds with the number of users imported & a list of errors
+        """
+        require_admin(req)
+        results = {'imported': 0, 'errors': []}
+        batch = []
+        lines = iter_lines(req.bounded_stream,
+                           max_line_size=config.MAX_IMPORT_LINE_SIZE)
+        for line_number, line in enumerate(lines, 1):
+            if line is None:
+                results['errors'].append({'line': line_number,
+                                          'error': 'Line too long'})
+                continue
+            if not line.strip():
+                continue # skip blank lines
+            try:
+                batch.append(self.parse_line(line, line_number))
+            except ValueError as e:
+                results['errors'].append({'line': line_number, 'error': str(e)})
+                continue
+            if len(batch) >= config.IMPORT_BATCH_SIZE:
+                self.import_batch(batch, results)
+                batch = []
+        if batch:
+            self.import_batch(batch, results)
+        resp.media = results
+
+    @staticmethod
+    def parse_line(line, line_number):
+        """Returns dict of user to import, or raises ValueError if invalid"""
+        try:
+            new_user = json_handler.loads(line)
+        except ValueError:
+            raise ValueError('Invalid JSON')
+        if not isinstance(new_user, dict) or not isinstance(
+                new_user.get('username'), str):
+            raise ValueError('Missing username')
+        if 'password' in new_user:
+            if not isinstance(new_user['password'], str):
+                raise ValueError('Invalid password')
+            # hashed later, along with the rest of the batch
+        elif not isinstance(new_user.get('pw_hash'), str) or not (
+                hash_policy.identify(new_user['pw_hash'])):
+            raise ValueError('Missing password, or invalid pw_hash')
+        new_user['line'] = line_number
+        return new_user
+
+    @staticmethod
+    def import_batch(batch, results):
+        """Hash passwords in parallel & add a batch of users"""
+        to_hash = [new_user for new_user in batch if 'password' in new_user]
+        new_hashes = hash_pool.map(user.hash_password,
+                                   [(new_user['password'], hash_policy)
+                                    for new_user in to_hash])
+        for new_user, new_hash in zip(to_hash, new_hashes):
+            new_user['pw_hash'] = new_hash
+        failed_names = set(user.add_users(user_storage, [
+            {'new_name': new_user['username'],
+             'new_hash': new_user['pw_hash'],
+             'new_json': new_user.get('data')} for new_user in batch]))
+        results['imported'] += len(batch) - len(failed_names)
+        for new_user in batch:
+            if new_user['username'] in failed_names:
+                results['errors'].append({'line': new_user['line'],
+                                          'error': 'User already exists'})
+
+class UserExportResource:
+    """Falcon Resource to handle bulk user retrieval requests"""
+    def on_get(self, req, resp):
+        """
+        Handle GET requests for all users (administrators only)
+
+        Responds with JSON Lines text: a JSON object for each user, with
+        keys: username, pw_hash & data
+        """
+        require_admin(req)
+        users = user.export_users(user_storage, config.EXPORT_BATCH_SIZE)
+        resp.content_type = 'application/x-ndjson'
+        resp.stream = encode_json_lines(users)
+
+def require_lookup(req):
+    """
+    Raise HTTP 401, unless the session user may read other users' data
+    (administrators, & the config.LOOKUP_USERS)
+
+    Keyword Parameters:
+      req  -- Falcon HTTP request object representing current API call
+    """
+    session_user = session.get_user_name(req)
+    if not session_user:
+        raise falcon.HTTPUnauthorized(title='Login required')
+    if not (session_user in config.ADMIN_USERS
+            or session_user in config.LOOKUP_USERS
+            or '*' in config.LOOKUP_USERS):
+        raise falcon.HTTPUnauthorized(title='Permission denied')
+
+class UserLookupResource:
+    """Falcon Resource to handle batch user data retrieval requests"""
+    def on_get(self, req, resp):
+        """
+        Handle GET requests for the data of many users
+
+        Responds with JSON Lines text: a JSON object for each user found,
+        with keys: username & data
+
+        HTTP GET parameters:
+          username  -- User to retrieve (may be repeated)
+          prefix  -- Retrieve users whose names begin with this, in name
+            order (instead of by username)
+          after  -- With prefix: only users whose names sort after this
+            (e.g.: the last username of the previous page)
+          limit  -- With prefix: maximum users to retrieve
+          fields  -- Comma-separated keys of the user data to retrieve
+        """
+        require_lookup(req)
+        usernames = req.params.get('username')
+        if isinstance(usernames, str):
+            usernames = [usernames] # not repeated
+        prefix = req.get_param('prefix')
+        if usernames is None and prefix is None:
+            raise falcon.HTTPMissingParam('username')
+        self.send_users(req, resp, usernames, prefix)
+
+    def on_post(self, req, resp):
+        """
+        Handle POST requests for the data of many users
+
+        The HTTP POST body is a JSON object, with keys:
+          usernames  -- List of users to retrieve (Required)
+          fields  -- List of keys of the user data to retrieve (Optional)
+        """
+        require_lookup(req)
+        document = req.media
+        if not isinstance(document, dict) or not isinstance(
+                document.get('usernames'), list) or not all(
+                    isinstance(name, str) for name in document['usernames']):
+            raise falcon.HTTPInvalidParam('Must be a list of Strings', 'usernames')
+        if document.get('fields') is not None:
+            if not isinstance(document['fields'], list) or not all(
+                    isinstance(field, str) for field in document['fields']):
+                raise falcon.HTTPInvalidParam('Must be a list of Strings',
+                                              'fields')
+            req.params['fields'] = document['fields']
+        self.send_users(req, resp, document['usernames'], prefix=None)
+
+    def send_users(self, req, resp, usernames, prefix):
+        """Respond with JSON Lines data, for the requested users"""
+        fields = parse_fields(req.params.get('fields'))
+        if usernames is not None:
+            if len(usernames) > config.LOOKUP_MAX_USERS:
+                raise falcon.HTTPInvalidParam('No more than {} users'.format(
+                    config.LOOKUP_MAX_USERS), 'username')
+            users = user.get_user_records(user_storage, usernames, fields)
+        else:
+            limit = req.get_param_as_int('limit', min=1,
+                                         max=config.LOOKUP_MAX_USERS)
+            users = user.find_user_records(user_storage, prefix,
+                                           req.get_param('after'),
+                                           limit or config.LOOKUP_PAGE_SIZE,
+                                           fields)
+        resp.content_type = 'application/x-ndjson'
+        resp.stream = encode_json_lines(users)
+
+def encode_cursor(after):
+    """
+    Returns opaque (URL-safe) cursor String, referencing a listing page
+
+    Keyword Parameters:
+      after  -- String, name of the last user of the previous page (or
+        tuple: its field value & name, for a query)
+
+    >>> decode_cursor(encode_cursor('pat.ng'))
+    'pat.ng'
+    >>> decode_cursor(encode_cursor(('pat@example.org', 'pat.ng')), pair=True)
+    ('pat@example.org', 'pat.ng')
+    """
+    payload = json.dumps({'after': after}, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, pair=False):
+    """
+    Returns name to list users after, from an encode_cursor String
+
+    Raises HTTP 400 if the cursor is invalid
+
+    Keyword Parameters:
+      cursor  -- String, from encode_cursor
+      pair  -- Boolean, if True return a tuple: field value & name (the
+        cursor of a query)
+
+    >>> try:
+    ...     decode_cursor('not a cursor')
+    ... except falcon.HTTPInvalidParam as error:
+    ...     error.description
+    'The "cursor" parameter is invalid. Invalid cursor'
+    """
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        after = json.loads(payload.decode('utf-8'))['after']
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        after = None
+    if pair and isinstance(after, list) and len(after) == 2 and all(
+            isinstance(part, str) for part in after):
+        return tuple(after)
+    if pair or not isinstance(after, str):
+        raise falcon.HTTPInvalidParam('Invalid cursor', 'cursor')
+    return after
+
+class UserListResource:
+    """Falcon Resource to handle user listing requests"""
+    def on_get(self, req, resp):
+        """
+        Handle GET requests for a page of users (administrators only)
+
+        Responds with JSON Lines text: a JSON object for each user (in
+        name order), with keys: username & data. If more users follow, a
+        Link header (rel=next) references the next page.
+
+        HTTP GET parameters:
+          cursor  -- From the previous page's next Link (Optional,
+            default: the first page)
+          limit  -- Maximum users per page (Optional)
+          fields  -- Comma-separated keys of the user data to retrieve
+        """
+        require_admin(req)
+        after = None # default: first page
+        cursor = req.get_param('cursor')
+        if cursor is not None:
+            after = decode_cursor(cursor)
+        limit = req.get_param_as_int('limit', min=1,
+                                     max=config.LIST_MAX_PAGE_SIZE)
+        limit = limit or config.LIST_PAGE_SIZE
+        fields = parse_fields(req.params.get('fields'))
+        users, after = user.list_users(user_storage, after, limit, fields)
+        if after is not None:
+            params = [('cursor', encode_cursor(after)), ('limit', limit)]
+            if fields is not None:
+                params.append(('fields', ','.join(fields)))
+            resp.add_link('{}?{}'.format(req.path, urlencode(params)), 'next')
+        resp.content_type = 'application/x-ndjson'
+        resp.stream = encode_json_lines(users)
+
+class UserQueryResource:
+    """Falcon Resource to find users, by an indexed user data field"""
+    def on_get(self, req, resp):
+        """
+        Handle GET requests for users whose data has a field value
+
+        Responds with JSON Lines text: a JSON object for each user found
+        (in order of field value, then name), with keys: username & data.
+        If more users follow, a Link header (rel=next) references the
+        next page.
+
+        HTTP GET parameters:
+          field  -- Key of the user data to match, one of the
+            config.INDEXED_FIELDS (Required)
+          value  -- Field value to find (e.g.: an email address)
+          prefix  -- Find field values beginning with this, instead
+          cursor  -- From the previous page's next Link (Optional,
+            default: the first page)
+          limit  -- Maximum users per page (Optional)
+          fields  -- Comma-separated keys of the user data to retrieve
+        """
+        require_lookup(req)
+        field = req.get_param('field', required=True)
+        if field not in user_storage.indexed_fields:
+            raise falcon.HTTPInvalidParam('Not an indexed field', 'field')
+        value, prefix = req.get_param('value'), req.get_param('prefix')
+        if value is None and prefix is None:
+            raise falcon.HTTPMissingParam('value')
+        if value is not None and prefix is not None:
+            raise falcon.HTTPInvalidParam('Not allowed with prefix', 'value')
+        after = None # default: first page
+        cursor = req.get_param('cursor')
+        if cursor is not None:
+            after = decode_cursor(cursor, pair=True)
+        limit = req.get_param_as_int('limit', min=1,
+                                     max=config.LOOKUP_MAX_USERS)
+        limit = limit or config.LOOKUP_PAGE_SIZE
+        fields = parse_fields(req.params.get('fields'))
+        users, after = user.find_indexed_users(
+            user_storage, field, prefix if value is None else value,
+            prefix=value is None, after=after, limit=limit, fields=fields)
+        if after is not None:
+            params = [('field', field)]
+            if value is None:
+                params.append(('prefix', prefix))
+            else:
+                params.append(('value', value))
+            params.extend([('cursor', encode_cursor(after)), ('limit', limit)])
+            if fields is not None:
+                params.append(('fields', ','.join(fields)))
+            resp.add_link('{}?{}'.format(req.path, urlencode(params)), 'next')
+        resp.content_type = 'application/x-ndjson'
+        resp.stream = encode_json_lines(users)
+
+def check_login_rate(username, address):
+    """
+    Raises falcon.HTTPTooManyRequests, if login attempts for username (or
+    from client address) exceed the configured rate limits
+
+    >>> check_login_rate('pat.ng', '192.0.2.1') # within limits
+    """
+    if login_limiter is None:
+        return # rate limiting disabled
+    retry_after = login_limiter.check(username, address)
+    if retry_after:
+        raise falcon.HTTPTooManyRequests(
+            title='Too many login attempts',
+            description='Please try again later',
+            retry_after=int(math.ceil(retry_after)))
+
+def get_login_hash(username):
+    """
+    Returns stored password hash for username, or None if no such user
+
+    For unknown users, the policy's dummy hash is prepared here (outside the
+    hashing pool) so the login is then answered in the same time as for a
+    real user, with a wrong password.
+    """
+    try:
+        return user.get_user_hash(user_storage, username)
+    except user.UserNotFoundException:
+        hash_policy.dummy_hash # computed once, then reused
+        return None
+
 class AuthResource:
     """Falcon Resource to handle authentication requests"""
     def on_post(self, req, resp):
@@ -115,8 +869,21 @@ class AuthResource:
             request_password = req.params[password_post_field]
         except KeyError:
             raise falcon.HTTPMissingParam(password_post_field)
-        stored_hash = user.get_user_hash(user_storage, request_username)
-        if auth.check_password(request_password, stored_hash):
+        for name, value in [(username_post_field, request_username),
+                            (password_post_field, request_password)]:
+            if not isinstance(value, str): # parameter was repeated
+                raise falcon.HTTPInvalidParam('Must be provided once', name)
+        check_login_rate(request_username, req.remote_addr)
+        stored_hash = get_login_hash(request_username)
+        password_ok, new_hash = run_hashing_job(auth.check_password_and_update,
+                                                request_password, stored_hash,
+                                                hash_policy)
+        if password_ok:
+            if new_hash: # hash cost settings have changed since last login
+                try:
+                    user.update_user_hash(user_storage, request_username, new_hash)
+                except user.UserNotFoundException: # deleted since checked
+                    raise falcon.HTTPUnauthorized(title='Login incorrect')
             # log in user
             session.create_login_session(request_username, req)
             resp.media = {'message': 'Login success!'}
@@ -127,13 +894,34 @@ class AuthResource:
         """Handle user logout DELETE requests"""
         session.invalidate_session(req)
 
-api = falcon.API()
-api.req_options.auto_parse_form_urlencoded = True # parse POST request bodies
+body_limit = RequestBodyLimit() # parses POST forms
+compression = None # (also used by the asgi module)
+if config.COMPRESS_MIN_SIZE > 0:
+    compression = encoding.CompressionMiddleware(
+        min_size=config.COMPRESS_MIN_SIZE, level=config.COMPRESS_LEVEL,
+        cache=compressed_cache)
+middleware = [metrics.MetricsMiddleware(), body_limit]
+if compression is not None: # (responses are compressed before timed)
+    middleware.append(compression)
+falcon_api = falcon.API(middleware=middleware,
+                        response_type=metrics.TimedResponse)
+falcon_api.req_options.auto_parse_qs_csv = False # dont split values on commas
+json_handlers = falcon.media.Handlers({'application/json': json_handler,
+                                       falcon.MEDIA_JSON: json_handler})
+falcon_api.req_options.media_handlers = json_handlers
+falcon_api.resp_options.media_handlers = json_handlers
 
-api.add_route('/', BaseResource())
-api.add_route('/user', UserResource())
-api.add_route('/user/{username}', UserResource())
-api.add_route('/auth', AuthResource())
+falcon_api.add_route('/', BaseResource())
+falcon_api.add_route('/user', UserResource())
+falcon_api.add_route('/user/{username}', UserResource())
+falcon_api.add_route('/users', UserListResource())
+falcon_api.add_route('/users/import', UserImportResource())
+falcon_api.add_route('/users/export', UserExportResource())
+falcon_api.add_route('/users/lookup', UserLookupResource())
+falcon_api.add_route('/users/query', UserQueryResource())
+falcon_api.add_route('/auth', AuthResource())
+if config.METRICS_ROUTE:
+    falcon_api.add_route(config.METRICS_ROUTE, metrics.MetricsResource())
 
 # add WSGI middleware
-api = session.wrap_app_with_session_middleware(api) # add web sessions
+api = session.wrap_app_with_session_middleware(falcon_api) # add web sessions
@@ -0,0 +1,498 @@
+"""
+Module defining an asyncio (ASGI) application for the simple REST API
+
+The base, /user & /auth resources are served by coroutines: blocking
+datastore access runs on a small thread pool, & password hashing on the
+hashing pool, so a single event loop thread can hold many idle
+connections. Requests & responses are handled with the WSGI
+application's own helpers (e.g.: api.send_user_data), & their bodies are
+limited to config.MAX_BODY_SIZE.
+
+Other routes (e.g.: bulk import/export, metrics) are passed to the WSGI
+application (api.api), run on the same thread pool: their request bodies
+are read, & responses sent, part by part as the application streams them.
+
+Serve with any ASGI 3 server, e.g.:
+    $ uvicorn asgi:app
+"""
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import asyncio
+import logging
+import re
+import sys
+import time
+
+import falcon
+
+import api, auth, user, session, hashing, config, metrics
+
+executor = ThreadPoolExecutor(max_workers=config.ASYNC_DATABASE_WORKERS)
+
+def run_blocking(function, *args):
+    """
+    Returns asyncio Future for the result of function, run on a thread
+
+    Keyword Parameters:
+      function  -- callable, blocking work (e.g.: a datastore query)
+      args  -- positional arguments for function
+    """
+    return asyncio.get_event_loop().run_in_executor(executor, function, *args)
+
+async def run_hashing_job(function, *args):
+    """
+    Returns result of password hashing job, awaiting the hashing pool
+
+    Raises HTTP 503 (with a Retry-After header) if the pool is saturated
+
+    Keyword Parameters:
+      function  -- callable, hashing job to run (e.g.: user.hash_password)
+      args  -- positional arguments for function
+    """
+    loop = asyncio.get_event_loop()
+    finished = loop.create_future()
+
+    def wake(job): # called from a pool thread
+        loop.call_soon_threadsafe(
+            lambda: finished.done() or finished.set_result(None))
+    with metrics.timed('hash_pool'): # includes any wait for a worker
+        try:
+            job = api.hash_pool.submit(function, *args)
+        except hashing.PoolSaturatedException:
+            raise falcon.HTTPServiceUnavailable(
+                title='Server busy', retry_after=config.HASH_RETRY_AFTER)
+        job.add_done_callback(wake)
+        await finished
+        return job.result()
+
+class AsyncDatastore:
+    """
+    Class providing coroutine access to the (blocking) user Datastore
+
+    Each method runs the corresponding user (or api) module function on the
+    thread pool.
+    """
+    @property
+    def datastore(self):
+        return api.user_storage # may be replaced (e.g.: by tests)
+
+    async def get_user_hash(self, username):
+        return await run_blocking(user.get_user_hash, self.datastore, username)
+
+    async def update_user_hash(self, username, new_hash):
+        return await run_blocking(user.update_user_hash, self.datastore,
+                                  username, new_hash)
+
+    async def update_user_data(self, username, new_data):
+        return await run_blocking(api.update_user_data, username, new_data)
+
+    async def delete_user(self, username):
+        return await run_blocking(api.delete_user, username)
+
+    async def add_user(self, new_name, new_hash, new_json=None):
+        return await run_blocking(user.add_user, self.datastore, new_name,
+                                  new_hash, new_json)
+
+user_storage = AsyncDatastore()
+
+class RequestBodyStream:
+    """
+    File-like object, reading an ASGI request body as it is received
+
+    Used as the wsgi.input of requests passed to the WSGI application,
+    which reads it on a thread (while the event loop receives each part):
+    so bodies, e.g.: bulk imports, are never buffered whole.
+    """
+    def __init__(self, receive, loop):
+        """
+        Keyword Parameters:
+          receive  -- coroutine function, returning ASGI messages
+          loop  -- asyncio event loop, to receive the messages on
+        """
+        self._receive = receive
+        self._loop = loop
+        self._buffer = bytearray()
+        self._more_body = True
+
+    def _fill(self, size=None):
+        """Receive body parts until size bytes are buffered (None: all)"""
+        while self._more_body and (size is None or len(self._buffer) < size):
+            message = asyncio.run_coroutine_threadsafe(
+                self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                self._more_body = False
+                break
+            self._buffer.extend(message.get('body', b''))
+            self._more_body = message.get('more_body', False)
+
+    def _take(self, size):
+        """Returns (& removes) up to size bytes, from the buffer"""
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            self._fill()
+            return self._take(len(self._buffer))
+        self._fill(size)
+        return self._take(size)
+
+    def readline(self, size=-1):
+        limited = size is not None and size >= 0
+        while (b'\n' not in self._buffer and self._more_body and
+               not (limited and len(self._buffer) >= size)):
+            self._fill(len(self._buffer) + 1)
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        return self._take(min(end, size) if limited else end)
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b''))
+
+def require_login(req, username):
+    """Raise HTTP 401, unless the session user is the referenced user"""
+    session_user = session.get_user_name(req)
+    if not session_user:
+        raise falcon.HTTPUnauthorized(title='Login required')
+    if session_user != username:
+        raise falcon.HTTPUnauthorized(title='Permission denied')
+
+def get_param(req, name):
+    """Returns request parameter, raising HTTP 400 if it is missing"""
+    try:
+        return req.params[name]
+    except KeyError:
+        raise falcon.HTTPMissingParam(name)
+
+class BaseResource:
+    """Resource to handle requests with no URL path"""
+    async def on_get(self, req, resp):
+        login_user = session.get_user_name(req) #check login
+        if login_user:
+            await run_blocking(api.send_user_data, req, resp, login_user)
+            return
+        resp.media = ["Hello World"] #default
+
+class UserResource:
+    """Resource to handle user signup, retrieval, update & removal"""
+    async def on_post(self, req, resp):
+        request_username = get_param(req, 'username')
+        request_password = get_param(req, 'password')
+        new_data = req.params.get('data')
+        if isinstance(new_data, list): # parameter was repeated
+            raise falcon.HTTPInvalidParam('Must be provided once', 'data')
+        new_hash = await run_hashing_job(user.hash_password, request_password,
+                                         api.hash_policy)
+        try:
+            await user_storage.add_user(request_username, new_hash, new_data)
+        except user.UserExistsException:
+            raise falcon.HTTPConflict('Username unavailable',
+                                      'User already exists')
+        msg = 'Successfully signed up new user: {}'.format(request_username)
+        resp.media = {'message': msg}
+
+    async def on_get(self, req, resp, username=None):
+        require_login(req, username)
+        await run_blocking(api.send_user_data, req, resp, username)
+
+    async def on_put(self, req, resp, username=None):
+        require_login(req, username)
+        await user_storage.update_user_data(username, req.media)
+
+    async def on_patch(self, req, resp, username=None):
+        require_login(req, username)
+        await run_blocking(api.patch_user_data, username, req.content_type,
+                           req.bounded_stream.read())
+
+    async def on_delete(self, req, resp, username=None):
+        require_login(req, username)
+        await user_storage.delete_user(username)
+        session.invalidate_session(req) # and revoke user's session token
+
+class AuthResource:
+    """Resource to handle authentication requests"""
+    async def on_post(self, req, resp):
+        request_username = get_param(req, 'username')
+        request_password = get_param(req, 'password')
+        for name, value in [('username', request_username),
+                            ('password', request_password)]:
+            if not isinstance(value, str): # parameter was repeated
+                raise falcon.HTTPInvalidParam('Must be provided once', name)
+        api.check_login_rate(request_username, req.remote_addr)
+        try:
+            stored_hash = await user_storage.get_user_hash(request_username)
+        except user.UserNotFoundException:
+            stored_hash = None # answered as a wrong password (see: api)
+            await run_blocking(lambda: api.hash_policy.dummy_hash)
+        password_ok, new_hash = await run_hashing_job(
+            auth.check_password_and_update, request_password, stored_hash,
+            api.hash_policy)
+        if password_ok:
+            if new_hash: # hash cost settings have changed since last login
+                try:
+                    await user_storage.update_user_hash(request_username, new_hash)
+                except user.UserNotFoundException: # deleted since checked
+                    raise falcon.HTTPUnauthorized(title='Login incorrect')
+            with metrics.timed('session_save'):
+                session.create_login_session(request_username, req)
+            resp.media = {'message': 'Login success!'}
+            return
+        raise falcon.HTTPUnauthorized(title='Login incorrect')
+
+    async def on_delete(self, req, resp):
+        session.invalidate_session(req)
+
+def compile_route(uri_template):
+    """
+    Returns regular expression, matching paths for a URI template
+
+    >>> compile_route('/user/{username}').match('/user/pat.ng').groupdict()
+    {'username': 'pat.ng'}
+    """
+    pattern = re.sub(r'\\{(\w+)\\}', r'(?P<\1>[^/]+)', re.escape(uri_template))
+    return re.compile(pattern + '$')
+
+routes = [(uri_template, compile_route(uri_template), resource)
+          for uri_template, resource in [('/', BaseResource()),
+                                         ('/user', UserResource()),
+                                         ('/user/{username}', UserResource()),
+                                         ('/auth', AuthResource())]]
+
+def find_responder(method, path):
+    """
+    Returns tuple: URI template, coroutine & its URI parameters (or Nones)
+
+    >>> find_responder('GET', '/user/pat.ng')[0]
+    '/user/{username}'
+    >>> find_responder('GET', '/users/export')
+    (None, None, None)
+    """
+    for uri_template, pattern, resource in routes:
+        match = pattern.match(path)
+        if match:
+            responder = getattr(resource, 'on_' + method.lower(), None)
+            if responder is None:
+                break # let the WSGI application respond (e.g.: 405)
+            return uri_template, responder, match.groupdict()
+    return None, None, None
+
+def create_environ(scope, stream, content_length=None):
+    """
+    Returns WSGI environ dict, for an ASGI request
+
+    Keyword Parameters:
+      scope  -- Dict, ASGI HTTP connection scope
+      stream  -- file-like object, to read the request body from
+      content_length  -- Integer, size of the body (Optional, default:
+        per the request's Content-Length header)
+
+    >>> environ = create_environ({'method': 'GET', 'path': '/user/pat.ng',
+    ...     'headers': [(b'content-type', b'application/json'),
+    ...                 (b'content-length', b'2'), (b'x-note', b'a'),
+    ...                 (b'x-note', b'b')]}, BytesIO(b'{}'))
+    >>> [environ[name] for name in ['PATH_INFO', 'CONTENT_TYPE',
+    ...                             'CONTENT_LENGTH', 'HTTP_X_NOTE']]
+    ['/user/pat.ng', 'application/json', '2', 'a,b']
+    """
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {'REQUEST_METHOD': scope['method'],
+               'SCRIPT_NAME': scope.get('root_path', ''),
+               'PATH_INFO': scope['path'],
+               'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+               'SERVER_NAME': server_name,
+               'SERVER_PORT': str(server_port),
+               'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+               'wsgi.version': (1, 0),
+               'wsgi.url_scheme': scope.get('scheme', 'http'),
+               'wsgi.input': stream,
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': True,
+               'wsgi.multiprocess': False,
+               'wsgi.run_once': False}
+    client = scope.get('client') # (host, port), if known
+    if client:
+        environ['REMOTE_ADDR'] = client[0]
+    if content_length is not None:
+        environ['CONTENT_LENGTH'] = str(content_length)
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH' and content_length is not None:
+            continue
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ: # repeated header
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+def encode_headers(headers):
+    """Returns list of ASGI (bytes) headers, for (String) HTTP headers"""
+    return [(name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in headers]
+
+async def call_wsgi_app(wsgi_app, environ, send):
+    """
+    Respond with a WSGI application, sending each part of its body as it
+    is produced (so streamed responses, e.g.: exports, aren't buffered)
+
+    The application, & its whole response, runs on one pool thread (as
+    database cursors may be bound to it), handing each message to the
+    event loop to send. Errors before the response starts are raised.
+    """
+    loop = asyncio.get_event_loop()
+    def send_message(message): # called from the pool thread
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+    def respond():
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response['status'], response['headers'] = status, headers
+        chunks = wsgi_app(environ, start_response)
+        try:
+            iterator = iter(chunks)
+            # (a generator may only call start_response when first iterated)
+            chunk = next(iterator, None)
+            send_message({'type': 'http.response.start',
+                          'status': int(response['status'][:3]),
+                          'headers': encode_headers(response['headers'])})
+            try:
+                while chunk is not None:
+                    if chunk:
+                        send_message({'type': 'http.response.body',
+                                      'body': chunk, 'more_body': True})
+                    chunk = next(iterator, None)
+            except Exception: # too late for an error response
+                logging.getLogger(app.__name__).exception('Unhandled error')
+            send_message({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+    await run_blocking(respond)
+
+async def read_body(scope, receive, limit):
+    """
+    Returns complete request body (bytes)
+
+    Raises HTTP 413 as soon as the Content-Length header, or the bytes
+    received, exceed limit
+
+    Keyword Parameters:
+      scope  -- Dict, ASGI HTTP connection scope
+      receive  -- coroutine function, returning ASGI messages
+      limit  -- Integer, maximum body size in bytes (None: no limit)
+    """
+    for name, value in scope.get('headers', []):
+        if (name.lower() == b'content-length' and limit is not None and
+                value.isdigit() and int(value) > limit):
+            raise api.body_too_large(limit)
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if limit is not None and size > limit:
+            raise api.body_too_large(limit)
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+def create_response():
+    """Returns new Falcon Response, with the WSGI application's options"""
+    return metrics.TimedResponse(options=api.falcon_api.resp_options)
+
+def error_response(error):
+    """Returns Falcon Response, representing a Falcon HTTPError"""
+    resp = create_response()
+    resp.status = error.status
+    resp.set_headers(error.headers or {})
+    resp.data = error.to_json().encode('utf-8')
+    resp.content_type = falcon.MEDIA_JSON
+    return resp
+
+async def send_response(resp, send):
+    """Send a (complete) Falcon Response, as ASGI messages"""
+    data = resp.data
+    if data is None:
+        data = (resp.body or '').encode('utf-8')
+    if resp.status in (falcon.HTTP_204, falcon.HTTP_NOT_MODIFIED):
+        data = b'' # no body allowed
+    resp.set_header('Content-Length', str(len(data)))
+    await send({'type': 'http.response.start',
+                'status': int(resp.status[:3]),
+                # (as Falcon's WSGI application sends them)
+                'headers': encode_headers(resp._wsgi_headers())})
+    await send({'type': 'http.response.body', 'body': data})
+
+async def handle(scope, body, uri_template, responder, params):
+    """
+    Returns Falcon Response, for a request to a route served by coroutines
+
+    Requests are handled as by the WSGI application: with its request
+    options, form parsing (see: api.RequestBodyLimit) & response
+    compression (see: encoding.CompressionMiddleware).
+    """
+    session_app = api.api
+    environ = create_environ(scope, BytesIO(body), len(body))
+    req = falcon.Request(environ, options=api.falcon_api.req_options)
+    resp = create_response()
+    req_session = session.Session(session_app.store, session_app.get_token(environ))
+    environ[session.ENVIRON_KEY] = req_session
+    started = time.perf_counter()
+    try:
+        # (coroutine resources have the default body size limit)
+        api.body_limit.process_resource(req, resp, None, params)
+        await responder(req, resp, **params)
+    except falcon.HTTPError as error:
+        resp = error_response(error)
+    if api.compression is not None:
+        api.compression.process_response(req, resp, None, True)
+    if req_session.modified or req_session.deleted:
+        with metrics.timed('session_save'):
+            req_session.save()
+    if req_session.cookie_out is not None:
+        resp.set_header('Set-Cookie',
+                        session_app.cookie_header(req_session.cookie_out))
+    if metrics.registry.sampled():
+        metrics.registry.observe(metrics.REQUEST_METRIC,
+                                 time.perf_counter() - started,
+                                 method=scope['method'], route=uri_template,
+                                 status=resp.status.split(' ', 1)[0])
+    return resp
+
+async def app(scope, receive, send):
+    """ASGI 3 application, serving the REST API"""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if config.WARMUP:
+                    await run_blocking(api.warmup)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if api.write_buffer is not None:
+                    await run_blocking(api.write_buffer.close)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        raise ValueError('Unsupported ASGI scope: {}'.format(scope['type']))
+    session_app = api.api
+    uri_template, responder, params = find_responder(scope['method'], scope['path'])
+    try:
+        if responder is None or not isinstance(session_app, session.SessionMiddleware):
+            # e.g.: bulk import & export (streamed), or Beaker sessions
+            # (which are only available to WSGI apps)
+            stream = RequestBodyStream(receive, asyncio.get_event_loop())
+            await call_wsgi_app(session_app, create_environ(scope, stream), send)
+            return
+        body = await read_body(scope, receive, config.MAX_BODY_SIZE)
+        resp = await handle(scope, body, uri_template, responder, params)
+    except falcon.HTTPError as error:
+        resp = error_response(error)
+    except Exception:
+        logging.getLogger(app.__name__).exception('Unhandled error')
+        resp = create_response()
+        resp.status = falcon.HTTP_500
+    await send_response(resp, send)
@@ -2,15 +2,16 @@
 Module providing API authentication helper functions
 """
 
-from passlib.hash import argon2
+import hashing, metrics
 
-def check_password(user_password, pw_hash):
+def check_password(user_password, pw_hash, policy=None):
     """
     Returns True if password matches secure hash, False if not
 
     Keyword Parameters:
       user_password  -- (String) plain-text password supplied by user
       pw_hash  -- (String) secure hash, retrieved from User datastore
+      policy  -- (hashing.HashPolicy) hash cost settings in use (Optional)
 
     >>> argon2_example = '$argon2i$v=19$m=102400,t=2,p=8$712rlRJiTInxvhdCaG1trQ$QJmh4Q6Q82t+3sgUexBfrQ'
     >>> check_password('greatsecret', argon2_example)
@@ -19,4 +20,46 @@ def check_password(user_password, pw_hash):
     False
     """
     # check if hash matches the provided password
-    return argon2.verify(user_password, pw_hash)
+    with metrics.timed('password_verify'):
+        return (policy or hashing.default_policy).verify(user_password, pw_hash)
+
+def check_password_and_update(user_password, pw_hash, policy=None):
+    """
+    Returns tuple: True if password matches hash & any replacement hash
+
+    When the password matches but the stored hash was made with cost
+    settings other than the current policy's, the password is rehashed
+    (the replacement hash is None, if no update is needed).
+
+    If pw_hash is None (e.g.: for an unknown user) the password is checked
+    against the policy's dummy hash, so the check costs the same as for a
+    real user, & always fails.
+
+    Keyword Parameters:
+      user_password  -- (String) plain-text password supplied by user
+      pw_hash  -- (String) secure hash, retrieved from User datastore (or
+        None, if there is no such user)
+      policy  -- (hashing.HashPolicy) hash cost settings to use (Optional)
+
+    >>> policy = hashing.HashPolicy(memory_cost=512, time_cost=1, parallelism=1)
+    >>> argon2_example = '$argon2i$v=19$m=102400,t=2,p=8$712rlRJiTInxvhdCaG1trQ$QJmh4Q6Q82t+3sgUexBfrQ'
+    >>> matched, new_hash = check_password_and_update('greatsecret', argon2_example, policy)
+    >>> matched, new_hash[:28]
+    (True, '$argon2i$v=19$m=512,t=1,p=1$')
+    >>> check_password_and_update('greatsecret', new_hash, policy)
+    (True, None)
+    >>> check_password_and_update('otherpassw', argon2_example, policy)
+    (False, None)
+    >>> check_password_and_update('greatsecret', None, policy)
+    (False, None)
+    """
+    policy = policy or hashing.default_policy
+    if pw_hash is None: # spend the same effort, then fail
+        check_password(user_password, policy.dummy_hash, policy)
+        return False, None
+    if not check_password(user_password, pw_hash, policy):
+        return False, None
+    if policy.needs_update(pw_hash):
+        with metrics.timed('password_hash'):
+            return True, policy.hash(user_password)
+    return True, None
@@ -0,0 +1,380 @@
+"""
+Module defining a load-testing & benchmark harness for the REST API
+
+Drives the api.api WSGI application, either in-process or through a local
+HTTP server, & reports latency percentiles, throughput & memory for each
+API flow. Results can be saved as JSON & compared against a saved baseline.
+
+Usage:
+    $ python bench.py --output baseline.json
+    $ python bench.py --baseline baseline.json # after changing something
+"""
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.client import HTTPConnection
+from socketserver import ThreadingMixIn
+from urllib.parse import urlencode
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+from falcon import testing
+
+import api, hashing
+
+class InProcessClient:
+    """Class encapsulating requests made directly to a WSGI application"""
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method, path, body=b'', headers=None):
+        """Returns tuple: HTTP status code & dict of lowercase headers"""
+        env = testing.create_environ(method=method, path=path, body=body,
+                                     headers=headers)
+        start_response = testing.StartResponseMock()
+        for chunk in self.app(env, start_response):
+            pass # consume the body, as a server would
+        status_code = int(start_response.status[:3])
+        return status_code, dict(
+            (name.lower(), value) for name, value in start_response.headers)
+
+    def close(self):
+        pass
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """wsgiref server, handling each connection in a new thread"""
+    daemon_threads = True
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """wsgiref request handler, which doesn't log every request"""
+    def log_message(self, format, *args):
+        pass
+
+class HTTPClient:
+    """Class encapsulating requests made to a local wsgiref HTTP server"""
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app,
+                                  server_class=ThreadingWSGIServer,
+                                  handler_class=QuietRequestHandler)
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def request(self, method, path, body=b'', headers=None):
+        """Returns tuple: HTTP status code & dict of lowercase headers"""
+        connection = HTTPConnection('127.0.0.1', self.port)
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            response.read()
+            return response.status, dict(
+                (name.lower(), value) for name, value in response.getheaders())
+        finally:
+            connection.close()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def form(**params):
+    """Returns tuple: url-encoded form body (bytes) & its headers"""
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    return urlencode(params).encode('utf-8'), headers
+
+def login(client, username, password='bench-password'):
+    """Returns Cookie header dict, after signing up & logging in user"""
+    body, headers = form(username=username, password=password)
+    client.request('POST', '/user', body, headers)
+    status, response_headers = client.request('POST', '/auth', body, headers)
+    session_token = response_headers['set-cookie'].lstrip().split(';', 1)[0]
+    return {'Cookie': session_token}
+
+class Scenario(ABC):
+    """
+    Class encapsulating one benchmarked API flow
+
+    Subclasses define request(client, iteration) & optionally setup()
+    """
+    name = None
+
+    def setup(self, client, iterations):
+        """Prepare users, sessions etc. (not timed)"""
+        pass
+
+    @abstractmethod
+    def request(self, client, iteration):
+        """Make one API request, returns HTTP status code"""
+
+class Signup(Scenario):
+    name = 'signup'
+    def request(self, client, iteration):
+        body, headers = form(username='signup-{}'.format(iteration),
+                             password='bench-password')
+        return client.request('POST', '/user', body, headers)[0]
+
+class Login(Scenario):
+    name = 'login'
+    def setup(self, client, iterations):
+        login(client, 'login')
+
+    def request(self, client, iteration):
+        body, headers = form(username='login', password='bench-password')
+        return client.request('POST', '/auth', body, headers)[0]
+
+class GetAnonymous(Scenario):
+    name = 'get_anonymous'
+    def request(self, client, iteration):
+        return client.request('GET', '/')[0]
+
+class GetUser(Scenario):
+    name = 'get_user'
+    data = {'address': '1 Microsoft Way', 'phone': '1-555-555-5555'}
+
+    def setup(self, client, iterations):
+        self.headers = login(client, self.name)
+        self.headers['Content-Type'] = 'application/json'
+        body = json.dumps(self.data).encode('utf-8')
+        client.request('PUT', '/user/' + self.name, body, self.headers)
+
+    def request(self, client, iteration):
+        return client.request('GET', '/user/' + self.name, headers=self.headers)[0]
+
+class PutUser(GetUser):
+    name = 'put_user'
+    def request(self, client, iteration):
+        body = json.dumps(dict(self.data, iteration=iteration)).encode('utf-8')
+        return client.request('PUT', '/user/' + self.name, body, self.headers)[0]
+
+class DeleteUser(Scenario):
+    name = 'delete_user'
+    def setup(self, client, iterations):
+        self.headers = [login(client, 'delete-{}'.format(iteration))
+                        for iteration in range(iterations)]
+
+    def request(self, client, iteration):
+        path = '/user/delete-{}'.format(iteration)
+        return client.request('DELETE', path, headers=self.headers[iteration])[0]
+
+SCENARIOS = [GetAnonymous, Signup, Login, GetUser, PutUser, DeleteUser]
+
+def percentile(sorted_values, fraction):
+    """
+    Returns nearest-rank percentile of a sorted list of values
+
+    >>> values = list(range(1, 101))
+    >>> percentile(values, 0.5), percentile(values, 0.99), percentile(values, 1)
+    (50, 99, 100)
+    """
+    rank = max(int(math.ceil(fraction * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+def max_rss_kib():
+    """Returns peak resident memory of this process, in KiB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak // 1024 # reported in bytes
+    return peak
+
+def run_scenario(scenario, client, iterations, concurrency):
+    """
+    Returns dict of latency, throughput & memory results for scenario
+
+    Requests that raise an exception (e.g.: a dropped connection) are
+    counted as errors, & left out of the latencies.
+
+    >>> class Dropped(GetAnonymous):
+    ...     def request(self, client, iteration):
+    ...         raise ConnectionResetError()
+    >>> result = run_scenario(Dropped(), InProcessClient(api.api), 2, 1)
+    >>> result['errors'], result['p95_ms']
+    (2, None)
+    """
+    scenario.setup(client, iterations)
+    latencies = [None] * iterations
+    errors = []
+
+    def timed_request(iteration):
+        started = time.perf_counter()
+        try:
+            status = scenario.request(client, iteration)
+        except Exception as error:
+            errors.append(type(error).__name__)
+            return
+        latencies[iteration] = time.perf_counter() - started
+        if status >= 400:
+            errors.append(status)
+
+    rss_before = max_rss_kib()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed_request, range(iterations)))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(latency for latency in latencies if latency is not None)
+    def percentile_ms(fraction):
+        return percentile(latencies, fraction) * 1000 if latencies else None
+    return {'requests': iterations,
+            'errors': len(errors),
+            'requests_per_second': iterations / elapsed,
+            'p50_ms': percentile_ms(0.50),
+            'p95_ms': percentile_ms(0.95),
+            'p99_ms': percentile_ms(0.99),
+            'max_rss_kib': max_rss_kib(),
+            'rss_growth_kib': max_rss_kib() - rss_before}
+
+STARTUP_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import api
+imported = time.perf_counter()
+api.warmup()
+print(json.dumps({'import_ms': (imported - started) * 1000,
+                  'warmup_ms': (time.perf_counter() - imported) * 1000}))
+"""
+
+def measure_startup(runs=3):
+    """
+    Returns dict: fastest times (ms) to import the API, & to warm it up,
+    each in a new Python process (as for a new WSGI process)
+
+    >>> sorted(measure_startup(runs=1))
+    ['import_ms', 'warmup_ms']
+    """
+    timings = []
+    for run in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', STARTUP_SCRIPT], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        timings.append(json.loads(output.decode('utf-8')))
+    return dict((name, min(timing[name] for timing in timings))
+                for name in ['import_ms', 'warmup_ms'])
+
+def run_benchmarks(mode='inprocess', iterations=100, concurrency=4,
+                   scenario_names=None):
+    """
+    Returns dict of benchmark results, for each scenario
+
+    Keyword Parameters:
+      mode  -- String, 'inprocess' or 'http' (via a local wsgiref server)
+      iterations  -- Integer, number of requests per scenario
+      concurrency  -- Integer, number of concurrent clients
+      scenario_names  -- List of Strings, scenarios to run (Optional)
+
+    >>> user_storage = api.user_storage
+    >>> results = run_benchmarks(iterations=2, concurrency=1,
+    ...                          scenario_names=['get_anonymous'])
+    >>> sorted(results['results']['get_anonymous'])[:4]
+    ['errors', 'max_rss_kib', 'p50_ms', 'p95_ms']
+    >>> api.user_storage is user_storage # restored
+    True
+    """
+    user_storage, login_limiter = api.user_storage, api.login_limiter
+    api.user_storage = api.create_user_storage() # start empty
+    api.login_limiter = None # measure the API, not its login rate limits
+    results = {}
+    try:
+        client_classes = {'inprocess': InProcessClient, 'http': HTTPClient}
+        client = client_classes[mode](api.api)
+        try:
+            for scenario_class in SCENARIOS:
+                if scenario_names and scenario_class.name not in scenario_names:
+                    continue
+                results[scenario_class.name] = run_scenario(
+                    scenario_class(), client, iterations, concurrency)
+        finally:
+            client.close()
+    finally: # (e.g.: for tests run in the same process)
+        api.user_storage, api.login_limiter = user_storage, login_limiter
+    return {'meta': {'mode': mode,
+                     'iterations': iterations,
+                     'concurrency': concurrency,
+                     'hash_policy': repr(api.hash_policy),
+                     'python': platform.python_version(),
+                     'date': datetime.now().isoformat()},
+            'results': results}
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Returns list of Strings, describing regressions from baseline
+
+    A scenario regresses if its p95 latency is more than tolerance
+    (fraction) higher, or its throughput more than tolerance lower.
+
+    >>> baseline = {'results': {'login': {'p95_ms': 100, 'requests_per_second': 10}}}
+    >>> results = {'results': {'login': {'p95_ms': 150, 'requests_per_second': 10}}}
+    >>> compare(results, baseline)
+    ['login: p95_ms 150.00 vs. 100.00 baseline']
+    >>> compare(baseline, baseline)
+    []
+    """
+    regressions = []
+    for name, result in sorted(results['results'].items()):
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]
+        if result['p95_ms'] is None: # every request failed
+            regressions.append('{}: no successful requests'.format(name))
+            continue
+        for metric, worse in [('p95_ms', lambda new, old: new > old * (1 + tolerance)),
+                              ('requests_per_second', lambda new, old: new < old * (1 - tolerance))]:
+            if worse(result[metric], base[metric]):
+                regressions.append('{}: {} {:.2f} vs. {:.2f} baseline'.format(
+                    name, metric, result[metric], base[metric]))
+    return regressions
+
+def print_results(results):
+    """Print table of benchmark results"""
+    columns = ['requests_per_second', 'p50_ms', 'p95_ms', 'p99_ms',
+               'errors', 'max_rss_kib']
+    print('{:<14}'.format('scenario') + ''.join('{:>20}'.format(c) for c in columns))
+    for name, result in results['results'].items():
+        print('{:<14}'.format(name) + ''.join(
+            '{:>20}'.format('-') if result[c] is None # no successful requests
+            else '{:>20.2f}'.format(result[c]) for c in columns))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the REST API')
+    parser.add_argument('--mode', choices=['inprocess', 'http'], default='inprocess')
+    parser.add_argument('--requests', type=int, default=100,
+                        help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--scenario', action='append', dest='scenarios',
+                        choices=[s.name for s in SCENARIOS],
+                        help='run only this scenario (may be repeated)')
+    parser.add_argument('--cheap-hashing', action='store_true',
+                        help='use minimal argon2 costs, to measure the rest of the API')
+    parser.add_argument('--output', help='save results to this JSON file')
+    parser.add_argument('--baseline', help='compare results to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='fractional slowdown allowed, vs. baseline')
+    args = parser.parse_args()
+    if args.cheap_hashing:
+        api.hash_policy = hashing.HashPolicy(memory_cost=8, time_cost=1, parallelism=1)
+    results = run_benchmarks(args.mode, args.requests, args.concurrency,
+                             args.scenarios)
+    results['startup'] = measure_startup()
+    print_results(results)
+    print('startup: import {import_ms:.2f}ms, warmup {warmup_ms:.2f}ms'.format(
+        **results['startup']))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['meta']['mode'] != results['meta']['mode']:
+            print('WARNING: baseline was measured in {} mode'.format(
+                baseline['meta']['mode']))
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        sys.exit(1 if regressions else 0)
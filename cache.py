@@ -0,0 +1,161 @@
+"""
+Module defining a simple in-process, thread-safe LRU cache with expiry
+"""
+from collections import OrderedDict
+from itertools import islice
+import threading
+import time
+
+class LRUCache:
+    """
+    Class encapsulating a bounded mapping, with optional time-to-live
+
+    Once max_size entries are stored, the least recently used entry is
+    evicted to make room. Entries older than ttl seconds are discarded.
+
+    >>> cache = LRUCache(max_size=2, ttl=60)
+    >>> cache.set('a', 1)
+    >>> cache.set('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.set('c', 3) # evicts least recently used ('b')
+    >>> cache.get('b') is None
+    True
+    >>> cache.invalidate('a')
+    >>> cache.get('a', 'missing')
+    'missing'
+    >>> from pprint import pprint
+    >>> pprint(cache.stats())
+    {'evictions': 1,
+     'expirations': 0,
+     'hits': 1,
+     'invalidations': 1,
+     'misses': 2,
+     'size': 1}
+    """
+    def __init__(self, max_size=1024, ttl=None, clock=time.monotonic):
+        """
+        Keyword Parameters:
+          max_size  -- Integer, maximum number of entries to store
+          ttl  -- Number, seconds before an entry expires (None: never)
+          clock  -- callable, returning current time in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict() # key: (expiry time, value)
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0,
+                          'expirations': 0, 'invalidations': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Returns cached value for key, or default if not cached
+
+        >>> now = [0]
+        >>> cache = LRUCache(ttl=10, clock=lambda: now[0])
+        >>> cache.set('a', 1)
+        >>> now[0] = 11 # later
+        >>> cache.get('a') is None
+        True
+        >>> cache.stats()['expirations']
+        1
+        """
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                self._counters['misses'] += 1
+                return default
+            if expires is not None and expires <= self._clock():
+                del self._entries[key]
+                self._counters['expirations'] += 1
+                self._counters['misses'] += 1
+                return default
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return value
+
+    def stamp(self):
+        """
+        Returns token, to detect invalidations while a value is loaded
+
+        >>> cache = LRUCache()
+        >>> token = cache.stamp()
+        >>> cache.invalidate('a') # e.g.: concurrent update
+        >>> cache.set('a', 'stale value', token)
+        >>> cache.get('a') is None
+        True
+        """
+        return self._counters['invalidations']
+
+    def set(self, key, value, stamp=None):
+        """
+        Store value for key, evicting the least recently used if full
+
+        Keyword Parameters:
+          key  -- hashable object, identifying the value
+          value  -- object to cache
+          stamp  -- token from stamp(), obtained before value was loaded.
+            If provided & any invalidation has happened since, the value
+            is assumed stale & not stored. (Optional)
+        """
+        expires = None
+        if self.ttl is not None:
+            expires = self._clock() + self.ttl
+        with self._lock:
+            if stamp is not None and stamp != self._counters['invalidations']:
+                return # value may have been loaded before an update
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def invalidate(self, key):
+        """Discard any cached value for key"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._counters['invalidations'] += 1
+
+    def purge_expired(self, limit=None):
+        """
+        Discard expired entries, returns number of entries discarded
+
+        Keyword Parameters:
+          limit  -- Integer, maximum number of entries to check (Optional)
+
+        >>> now = [0]
+        >>> cache = LRUCache(ttl=10, clock=lambda: now[0])
+        >>> cache.set('a', 1)
+        >>> now[0] = 5
+        >>> cache.set('b', 2)
+        >>> now[0] = 11 # 'a' has expired
+        >>> cache.purge_expired(), len(cache)
+        (1, 1)
+        """
+        if self.ttl is None:
+            return 0 # nothing expires
+        now = self._clock()
+        with self._lock:
+            # least recently used entries are the most likely to be expired
+            entries = islice(self._entries.items(), limit)
+            expired = [key for key, (expires, value) in entries if expires <= now]
+            for key in expired:
+                del self._entries[key]
+            self._counters['expirations'] += len(expired)
+        return len(expired)
+
+    def clear(self):
+        """Discard all cached values"""
+        with self._lock:
+            self._entries.clear()
+            self._counters['invalidations'] += 1
+
+    def stats(self):
+        """Returns dict of cache hit/miss & eviction counters"""
+        with self._lock:
+            return dict(self._counters, size=len(self._entries))
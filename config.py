@@ -0,0 +1,176 @@
+"""
+Module defining API deployment settings
+
+Every setting has a default suited to local development & testing. Each
+may be overridden by an environment variable of the same name, prefixed
+with 'RESTDEMO_' (e.g.: RESTDEMO_HASH_WORKERS=4)
+"""
+import os
+
+ENV_PREFIX = 'RESTDEMO_'
+
+def get_setting(name, default, convert=str):
+    """
+    Returns value of the referenced setting from the environment
+
+    Keyword Parameters:
+      name  -- String, setting name (without the environment prefix)
+      default  -- value to return, if setting isn't present in environment
+      convert  -- callable, used to convert the environment String value
+
+    >>> get_setting('NOT_SET_ANYWHERE', 42, int)
+    42
+    >>> os.environ['RESTDEMO_EXAMPLE'] = '7'
+    >>> get_setting('EXAMPLE', 42, int)
+    7
+    >>> del os.environ['RESTDEMO_EXAMPLE']
+    """
+    try:
+        return convert(os.environ[ENV_PREFIX + name])
+    except KeyError:
+        return default # not configured
+
+def boolean(text):
+    """
+    Returns bool represented by (environment variable) text
+
+    >>> boolean('true'), boolean('1'), boolean('no'), boolean('False')
+    (True, True, False, False)
+    """
+    return text.strip().lower() in ('1', 'true', 'yes', 'on')
+
+def name_set(text):
+    """
+    Returns set of names, from comma-separated (environment variable) text
+
+    >>> sorted(name_set('pat.ng, salvador.dali,'))
+    ['pat.ng', 'salvador.dali']
+    """
+    return frozenset(name.strip() for name in text.split(',') if name.strip())
+
+# Directory of state shared by every worker process (e.g.: under mod_wsgi
+# with several daemon processes): the user database & login sessions are
+# kept here, & per-process user caches are disabled. None: state is kept
+# per process (the user database, in a tempfile)
+SHARED_STATE_DIR = get_setting('SHARED_STATE_DIR', None)
+
+def shared_state_path(filename):
+    """
+    Returns path of filename in SHARED_STATE_DIR (None, if not configured)
+
+    >>> shared_state_path('users.sqlite3') is None # not configured
+    True
+    """
+    if SHARED_STATE_DIR is None:
+        return None
+    return os.path.join(SHARED_STATE_DIR, filename)
+
+# Users permitted to use the administrative API (e.g.: bulk import)
+ADMIN_USERS = get_setting('ADMIN_USERS', frozenset(), name_set)
+
+# Password hashing worker pool
+HASH_POOL_TYPE = get_setting('HASH_POOL_TYPE', 'thread') # or: 'process'
+HASH_WORKERS = get_setting('HASH_WORKERS', 2, int) # max concurrent hashes
+HASH_QUEUE_DEPTH = get_setting('HASH_QUEUE_DEPTH', 8, int) # max waiting jobs
+HASH_RETRY_AFTER = get_setting('HASH_RETRY_AFTER', 1, int) # seconds
+
+# Password hashing cost (None: use passlib defaults; see: python hashing.py)
+HASH_MEMORY_COST = get_setting('HASH_MEMORY_COST', None, int) # KiB
+HASH_TIME_COST = get_setting('HASH_TIME_COST', None, int)
+HASH_PARALLELISM = get_setting('HASH_PARALLELISM', None, int)
+
+# User data read cache (size 0, the default: disable caching). Other
+# processes' writes aren't seen, so don't enable it for shared state
+USER_CACHE_SIZE = get_setting('USER_CACHE_SIZE', 0, int) # max users
+USER_CACHE_TTL = get_setting('USER_CACHE_TTL', 60, float) # seconds
+
+# Cache of usernames found not to exist, to answer repeated logins for
+# unknown users without a database query (size 0: disable caching)
+UNKNOWN_USER_CACHE_SIZE = get_setting('UNKNOWN_USER_CACHE_SIZE',
+                                      0 if SHARED_STATE_DIR else 10000, int)
+UNKNOWN_USER_CACHE_TTL = get_setting('UNKNOWN_USER_CACHE_TTL', 5, float) # seconds
+
+# Login attempt rate limits, per minute (0: no limit) & max burst
+LOGIN_USER_RATE = get_setting('LOGIN_USER_RATE', 6, float) # per username
+LOGIN_USER_BURST = get_setting('LOGIN_USER_BURST', 10, int)
+LOGIN_ADDRESS_RATE = get_setting('LOGIN_ADDRESS_RATE', 60, float) # per client
+LOGIN_ADDRESS_BURST = get_setting('LOGIN_ADDRESS_BURST', 30, int)
+LOGIN_LIMITER_SIZE = get_setting('LOGIN_LIMITER_SIZE', 100000, int) # max keys
+
+# Encoded user data response cache (max number of responses)
+RESPONSE_CACHE_SIZE = get_setting('RESPONSE_CACHE_SIZE', 1024, int)
+
+# JSON library for request & response bodies: 'json' (the standard module),
+# one of 'orjson' or 'ujson', or 'auto' (the fastest of those installed)
+JSON_LIBRARY = get_setting('JSON_LIBRARY', 'json')
+# Compress responses (with gzip or deflate, as the client accepts) of at
+# least this many bytes (0: disabled), at this zlib level (1-9: smallest)
+COMPRESS_MIN_SIZE = get_setting('COMPRESS_MIN_SIZE', 1024, int)
+COMPRESS_LEVEL = get_setting('COMPRESS_LEVEL', 6, int)
+
+# User database (None: an ephemeral SQLite3 tempfile, per process)
+DATABASE_URL = get_setting('DATABASE_URL', None if SHARED_STATE_DIR is None
+                           else 'sqlite:///' + shared_state_path('users.sqlite3'))
+# Connection pool (for server databases: e.g. PostgreSQL, MySQL)
+DATABASE_POOL_SIZE = get_setting('DATABASE_POOL_SIZE', None, int)
+DATABASE_MAX_OVERFLOW = get_setting('DATABASE_MAX_OVERFLOW', None, int)
+DATABASE_POOL_RECYCLE = get_setting('DATABASE_POOL_RECYCLE', None, int) # seconds
+DATABASE_POOL_PRE_PING = get_setting('DATABASE_POOL_PRE_PING', False, boolean)
+SQLITE_BUSY_TIMEOUT = get_setting('SQLITE_BUSY_TIMEOUT', 5000, int) # ms
+# How user data is stored: 'json' (a JSON column) or 'packed' (compact
+# binary, compressed above DATA_COMPRESS_THRESHOLD bytes; 0: never)
+DATA_FORMAT = get_setting('DATA_FORMAT', 'json')
+DATA_COMPRESS_THRESHOLD = get_setting('DATA_COMPRESS_THRESHOLD', 1024, int)
+# Write-behind of user data replacements (PUT): a user's updates within
+# this window are coalesced, & flushed in one transaction (0: disabled)
+WRITE_BEHIND_WINDOW = get_setting('WRITE_BEHIND_WINDOW', 0, float) # seconds
+WRITE_BEHIND_MAX_PENDING = get_setting('WRITE_BEHIND_MAX_PENDING', 10000, int)
+# Create database engine & load password hashing, as each process starts
+# (in the background), instead of on first request
+WARMUP = get_setting('WARMUP', True, boolean)
+
+# User sessions
+# HMAC key for 'signed' sessions (required by them: same in every process)
+SESSION_SECRET = get_setting('SESSION_SECRET', None)
+SESSION_STORE = get_setting('SESSION_STORE', # or: memory, beaker
+                            'signed' if SESSION_SECRET and not SHARED_STATE_DIR
+                            else 'sqlite')
+# SQLite3 database file, for 'sqlite' sessions
+SESSION_DATABASE = get_setting('SESSION_DATABASE',
+                               shared_state_path('sessions.sqlite3') or 'sessions.sqlite3')
+SESSION_MAX_AGE = get_setting('SESSION_MAX_AGE', 24*3600, int) # seconds
+SESSION_MEMORY_SIZE = get_setting('SESSION_MEMORY_SIZE', 100000, int) # for 'memory'
+# Expired session cleanup (interval 0: disable)
+SESSION_REAP_INTERVAL = get_setting('SESSION_REAP_INTERVAL', 300, float) # seconds
+SESSION_REAP_BATCH_SIZE = get_setting('SESSION_REAP_BATCH_SIZE', 500, int)
+SESSION_REAP_MAX_BATCHES = get_setting('SESSION_REAP_MAX_BATCHES', 100, int) # per run
+SESSION_REAP_PAUSE = get_setting('SESSION_REAP_PAUSE', 0.05, float) # seconds
+
+# Request body size limits (bytes; 413 Request Entity Too Large if exceeded)
+MAX_BODY_SIZE = get_setting('MAX_BODY_SIZE', 1024*1024, int) # except bulk import
+MAX_IMPORT_LINE_SIZE = get_setting('MAX_IMPORT_LINE_SIZE', 1024*1024, int)
+
+# Bulk user import/export (users per database transaction, or fetch)
+IMPORT_BATCH_SIZE = get_setting('IMPORT_BATCH_SIZE', 500, int)
+EXPORT_BATCH_SIZE = get_setting('EXPORT_BATCH_SIZE', 1000, int)
+
+# Paginated user listing (users per page: default & maximum)
+LIST_PAGE_SIZE = get_setting('LIST_PAGE_SIZE', 100, int)
+LIST_MAX_PAGE_SIZE = get_setting('LIST_MAX_PAGE_SIZE', 1000, int)
+
+# Batch user lookup: users (besides administrators) permitted to read
+# other users' data ('*': any logged-in user), & request size limits
+LOOKUP_USERS = get_setting('LOOKUP_USERS', frozenset(), name_set)
+LOOKUP_MAX_USERS = get_setting('LOOKUP_MAX_USERS', 1000, int) # per request
+LOOKUP_PAGE_SIZE = get_setting('LOOKUP_PAGE_SIZE', 100, int) # prefix default
+# User data fields (dotted-path keys, e.g.: email,address.city) to index,
+# for GET /users/query lookups by field value
+INDEXED_FIELDS = get_setting('INDEXED_FIELDS', frozenset(), name_set)
+
+# Threads for blocking datastore access, when serving the API via ASGI
+ASYNC_DATABASE_WORKERS = get_setting('ASYNC_DATABASE_WORKERS', 8, int)
+
+# Request timing metrics (route None or '': don't expose metrics). Metrics
+# are served without login: expose them only to trusted networks
+METRICS_ROUTE = get_setting('METRICS_ROUTE', None)
+METRICS_SAMPLE_RATE = get_setting('METRICS_SAMPLE_RATE', 1.0, float) # 0-1
@@ -0,0 +1,263 @@
+"""
+Module defining JSON body encoding & negotiated HTTP response compression
+
+JSON is encoded & parsed with the standard library json module, or with a
+faster library (orjson or ujson) if configured: integers those can't hold
+exactly (beyond 64 bits) are left to the json module. Responses are
+compressed with gzip or deflate, as the client accepts (per its HTTP
+Accept-Encoding header), when they are large enough to benefit.
+"""
+import importlib
+import json
+import re
+import zlib
+
+import falcon
+import falcon.media
+
+JSON_LIBRARIES = ('orjson', 'ujson', 'json') # fastest first
+CODINGS = ('gzip', 'deflate') # in order of preference
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+# numbers of 16+ digits may be outside 64-bit integer (or exact float) range
+LONG_NUMBER = re.compile(rb'[0-9]{16}')
+
+def stdlib_dumps(obj):
+    """Returns obj encoded as UTF-8 JSON bytes, by the json module"""
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+def stdlib_loads(raw):
+    """Returns object parsed from UTF-8 JSON bytes, by the json module"""
+    return json.loads(raw.decode('utf-8'))
+
+def with_fallback(dumps, loads):
+    """
+    Returns tuple: dumps & loads functions, using the json module for
+    values a faster library can't encode, or may not parse exactly
+
+    Faster libraries hold integers in 64 bits: encoding larger ones
+    raises TypeError or OverflowError, & parsing them may round them to
+    floats. So bodies with long numbers are parsed by the json module.
+
+    >>> dumps, loads = with_fallback(lambda obj: b'0', lambda raw: 0.0)
+    >>> dumps(2**70), loads(b'[18446744073709551616]')
+    (b'0', [18446744073709551616])
+    """
+    def fallback_dumps(obj):
+        try:
+            return dumps(obj)
+        except (TypeError, OverflowError):
+            return stdlib_dumps(obj) # raises TypeError, if not JSON
+    def fallback_loads(raw):
+        if LONG_NUMBER.search(raw):
+            return stdlib_loads(raw) # (also parses any non-numbers)
+        return loads(raw)
+    return fallback_dumps, fallback_loads
+
+def load_json_library(name='json'):
+    """
+    Returns tuple: name of the JSON library, & its dumps & loads functions
+
+    The dumps function returns UTF-8 bytes (non-ASCII characters are not
+    escaped) & loads parses bytes. Faster libraries fall back to the
+    json module where they'd be lossy (see: with_fallback). Raises
+    ImportError if the referenced library isn't installed.
+
+    Keyword Parameters:
+      name  -- String, one of JSON_LIBRARIES or 'auto': the first of
+        them that is installed
+
+    >>> name, dumps, loads = load_json_library('json')
+    >>> dumps({'city': 'Zürich'})
+    b'{"city": "Z\\xc3\\xbcrich"}'
+    >>> loads(b'[1, 2]')
+    [1, 2]
+    >>> load_json_library('auto')[0] in JSON_LIBRARIES
+    True
+    """
+    if name != 'auto' and name not in JSON_LIBRARIES:
+        raise ValueError('Unknown JSON library: {}'.format(name))
+    for library in (JSON_LIBRARIES if name == 'auto' else [name]):
+        try:
+            module = importlib.import_module(library)
+        except ImportError:
+            if name != 'auto':
+                raise
+            continue # try the next fastest
+        if library == 'orjson':
+            return (library,) + with_fallback(module.dumps, module.loads)
+        if library == 'ujson':
+            return (library,) + with_fallback((lambda obj: module.dumps(
+                obj, ensure_ascii=False, escape_forward_slashes=False
+            ).encode('utf-8')), (lambda raw: module.loads(raw.decode('utf-8'))))
+        return library, stdlib_dumps, stdlib_loads
+
+class JSONHandler(falcon.media.BaseHandler):
+    """
+    Falcon media handler, encoding JSON with the configured library
+
+    >>> handler = JSONHandler('json')
+    >>> handler.deserialize(handler.serialize({'a': [1]}))
+    {'a': [1]}
+    """
+    def __init__(self, library='json'):
+        """
+        Keyword Parameters:
+          library  -- String, JSON library to use (see: load_json_library)
+        """
+        self.library, self.dumps, self.loads = load_json_library(library)
+
+    def deserialize(self, raw):
+        try:
+            return self.loads(raw)
+        except ValueError as err:
+            raise falcon.HTTPBadRequest(
+                'Invalid JSON', 'Could not parse JSON body - {0}'.format(err))
+
+    def serialize(self, media):
+        return self.dumps(media)
+
+def negotiate(accept_encoding):
+    """
+    Returns content coding to compress a response with (one of CODINGS),
+    per an HTTP Accept-Encoding request header, or None
+
+    >>> negotiate('gzip, deflate, br')
+    'gzip'
+    >>> negotiate('gzip;q=0.5, deflate')
+    'deflate'
+    >>> negotiate('*;q=0.1, gzip;q=0')
+    'deflate'
+    >>> negotiate('identity') is None, negotiate(None) is None
+    (True, True)
+    """
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        weight = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0 # malformed
+        weights[coding.strip().lower()] = weight
+    best, best_weight = None, 0.0
+    for coding in CODINGS:
+        weight = weights.get(coding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = coding, weight
+    return best
+
+def compressible(content_type):
+    """
+    Returns True if responses of content_type are worth compressing
+
+    >>> compressible('application/json; charset=UTF-8'), compressible('image/png')
+    (True, False)
+    """
+    return (content_type or '').lower().startswith(COMPRESSIBLE_TYPES)
+
+def compress(data, coding, level=6):
+    """
+    Returns data (bytes), compressed per an HTTP content coding
+
+    Keyword Parameters:
+      data  -- bytes, to compress
+      coding  -- String, 'gzip' or 'deflate' (zlib format, per HTTP)
+      level  -- Integer, 1 (fastest) to 9 (smallest)
+
+    >>> import gzip
+    >>> gzip.decompress(compress(b'{"a": 1}', 'gzip'))
+    b'{"a": 1}'
+    >>> zlib.decompress(compress(b'{"a": 1}', 'deflate'))
+    b'{"a": 1}'
+    """
+    if coding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif coding == 'deflate':
+        compressor = zlib.compressobj(level)
+    else:
+        raise ValueError('Unknown content coding: {}'.format(coding))
+    return compressor.compress(data) + compressor.flush()
+
+def compress_body(data, coding, level=6, cache=None, cache_key=None):
+    """
+    Returns data compressed per an HTTP content coding, from cache if
+    cache_key (e.g.: request URI, entity tag & coding) is cached there
+
+    >>> from cache import LRUCache
+    >>> compressed_cache = LRUCache()
+    >>> key = ('/user/pat.ng', '"abc"', 'gzip')
+    >>> first = compress_body(b'{"a": 1}', 'gzip', cache=compressed_cache,
+    ...                       cache_key=key)
+    >>> compress_body(b'{"a": 1}', 'gzip', cache=compressed_cache,
+    ...               cache_key=key) is first
+    True
+    """
+    if cache is None or cache_key is None:
+        return compress(data, coding, level)
+    compressed = cache.get(cache_key)
+    if compressed is None:
+        compressed = compress(data, coding, level)
+        cache.set(cache_key, compressed)
+    return compressed
+
+def weak_etag(etag):
+    """
+    Returns entity tag, marked weak (as compressed & uncompressed
+    representations aren't byte-for-byte identical)
+
+    >>> weak_etag('"abc"'), weak_etag('W/"abc"'), weak_etag(None)
+    ('W/"abc"', 'W/"abc"', None)
+    """
+    if etag is None or etag.startswith('W/'):
+        return etag
+    return 'W/' + etag
+
+class CompressionMiddleware:
+    """
+    Falcon middleware, compressing response bodies of at least min_size
+    bytes (except streamed bodies) with gzip or deflate, as negotiated
+
+    Compressed bodies may be kept in a cache, by request URI, entity tag &
+    coding: so repeat requests for an unchanged (tagged) representation,
+    e.g.: large user data, are compressed only once.
+    """
+    def __init__(self, min_size=1024, level=6, cache=None):
+        """
+        Keyword Parameters:
+          min_size  -- Integer, smallest body (in bytes) to compress
+          level  -- Integer, compression level: 1 (fastest) to 9
+          cache  -- cache.LRUCache, to hold compressed bodies of tagged
+            responses (Optional, default: no caching)
+        """
+        self.min_size = min_size
+        self.level = level
+        self.cache = cache
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if resp.stream is not None or resp.get_header('Content-Encoding'):
+            return # streamed, or already encoded
+        if not compressible(resp.content_type):
+            return
+        data = resp.data
+        if data is None and resp.body is not None:
+            data = resp.body.encode('utf-8')
+        if data is None or len(data) < self.min_size:
+            return
+        resp.append_header('Vary', 'Accept-Encoding')
+        coding = negotiate(req.get_header('Accept-Encoding'))
+        if coding is None:
+            return
+        etag = resp.etag
+        cache_key = None # untagged: may differ, for the same URI
+        if etag is not None:
+            cache_key = (req.relative_uri, etag, coding)
+        resp.body = None
+        resp.data = compress_body(data, coding, self.level, self.cache,
+                                  cache_key)
+        resp.set_header('Content-Encoding', coding)
+        resp.etag = weak_etag(etag)
@@ -0,0 +1,380 @@
+"""
+Module defining password hashing policy & a bounded hashing worker pool
+
+Password hashing (argon2) is deliberately expensive, so hashing jobs are
+run on a small dedicated pool instead of on every WSGI request thread. A
+burst of signup/login requests then can't starve the cheap API endpoints.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import argparse
+import binascii
+import os
+import statistics
+import threading
+import time
+
+class PoolSaturatedException(RuntimeError):
+    """Raised when hashing pool has no capacity left to queue another job"""
+    pass
+
+def _timed_call(function, args):
+    """
+    Returns tuple of job runtime (in seconds) & result of function call
+
+    Keyword Parameters:
+      function  -- callable, hashing job to run (must be picklable, for
+        process pools: e.g. a module-level function)
+      args  -- Tuple, positional arguments for function
+
+    >>> runtime, result = _timed_call(sum, ([1, 2, 3],))
+    >>> result
+    6
+    """
+    started = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - started, result
+
+class HashPolicy:
+    """
+    Class encapsulating argon2 password hashing cost parameters
+
+    Parameters left as None use the passlib defaults (at time of writing:
+    memory_cost=102400 KiB, time_cost=2, parallelism=8)
+
+    >>> policy = HashPolicy(memory_cost=512, time_cost=1, parallelism=1)
+    >>> new_hash = policy.hash('secret')
+    >>> new_hash[:28]
+    '$argon2i$v=19$m=512,t=1,p=1$'
+    >>> policy.verify('secret', new_hash)
+    True
+    >>> policy.needs_update(new_hash)
+    False
+    >>> stale_hash = HashPolicy(memory_cost=256, time_cost=1, parallelism=1).hash('secret')
+    >>> policy.verify('secret', stale_hash)
+    True
+    >>> policy.needs_update(stale_hash)
+    True
+    """
+    def __init__(self, memory_cost=None, time_cost=None, parallelism=None):
+        """
+        Keyword Parameters:
+          memory_cost  -- Integer, KiB of memory used per hash (Optional)
+          time_cost  -- Integer, number of argon2 passes (Optional)
+          parallelism  -- Integer, number of argon2 lanes (Optional)
+        """
+        self.settings = {}
+        for name, value in [('memory_cost', memory_cost),
+                            ('rounds', time_cost), # passlib's name
+                            ('parallelism', parallelism)]:
+            if value is not None:
+                self.settings[name] = value
+        self._handler = None
+        self._dummy_hash = None
+
+    def __getstate__(self):
+        """Returns picklable policy state (for use in process pools)"""
+        return {'settings': self.settings, '_handler': None,
+                '_dummy_hash': self._dummy_hash}
+
+    def __repr__(self):
+        params = ', '.join('{}={}'.format(k, v) for k, v in sorted(self.settings.items()))
+        return 'HashPolicy({})'.format(params)
+
+    @property
+    def handler(self):
+        """passlib argon2 handler, configured with policy cost settings"""
+        if self._handler is None:
+            from passlib.hash import argon2 # deferred: loaded on first use
+            self._handler = argon2.using(**self.settings)
+            self._handler.get_backend() # load the argon2 library now, too
+        return self._handler
+
+    @property
+    def dummy_hash(self):
+        """
+        Hash of a random, unknowable password, made with this policy
+
+        Verifying a password against it costs as much as verifying a real
+        user's (e.g.: so unknown usernames can't be detected by timing)
+        """
+        if self._dummy_hash is None:
+            self._dummy_hash = self.hash(binascii.hexlify(os.urandom(32)).decode())
+        return self._dummy_hash
+
+    def hash(self, user_password):
+        """Returns new, salted secure hash of referenced password"""
+        return self.handler.hash(user_password)
+
+    def verify(self, user_password, pw_hash):
+        """Returns True if password matches secure hash, False if not"""
+        return self.handler.verify(user_password, pw_hash)
+
+    def identify(self, pw_hash):
+        """
+        Returns True if String is a secure hash, usable with this policy
+
+        >>> HashPolicy().identify('FACECAFE')
+        False
+        """
+        return self.handler.identify(pw_hash)
+
+    def needs_update(self, pw_hash):
+        """Returns True if hash doesn't use the policy cost settings"""
+        return self.handler.needs_update(pw_hash)
+
+    @classmethod
+    def calibrate(cls, target_seconds=0.25, memory_cost=None,
+                  parallelism=None, samples=3):
+        """
+        Returns HashPolicy tuned to take about target_seconds per hash
+
+        Benchmarks this machine: the argon2 time_cost is scaled to meet
+        the target latency. If even a single pass is too slow, the
+        memory_cost is reduced instead.
+
+        Keyword Parameters:
+          target_seconds  -- Number, desired duration of one hash
+          memory_cost  -- Integer, KiB of memory to start with (Optional)
+          parallelism  -- Integer, number of argon2 lanes (Optional)
+          samples  -- Integer, hashes to time per measurement
+
+        >>> policy = HashPolicy.calibrate(0.001, memory_cost=64, parallelism=1, samples=1)
+        >>> policy.settings['memory_cost'] <= 64
+        True
+        """
+        from passlib.hash import argon2
+        defaults = argon2.using()
+        memory_cost = memory_cost or defaults.memory_cost
+        parallelism = parallelism or defaults.parallelism
+        min_memory_cost = 8 * parallelism # argon2 minimum
+        while True:
+            one_pass = cls(memory_cost, 1, parallelism)._time_hash(samples)
+            if one_pass < target_seconds or memory_cost <= min_memory_cost:
+                break
+            memory_cost = max(memory_cost//2, min_memory_cost)
+        time_cost = max(int(target_seconds / one_pass), 1)
+        return cls(memory_cost, time_cost, parallelism)
+
+    def _time_hash(self, samples):
+        """Returns median duration (in seconds) of hashing with policy"""
+        durations = []
+        for sample in range(samples):
+            started = time.perf_counter()
+            self.hash('calibration password')
+            durations.append(time.perf_counter() - started)
+        return statistics.median(durations)
+
+default_policy = HashPolicy() # passlib defaults
+
+class HashingPool:
+    """
+    Class encapsulating a bounded executor for password hashing jobs
+
+    Jobs beyond the worker count wait in a queue of limited depth; once
+    the queue is full new jobs are refused with PoolSaturatedException.
+
+    >>> pool = HashingPool(max_workers=1, max_queue=0)
+    >>> pool.run(sum, [1, 2, 3])
+    6
+    >>> stats = pool.stats()
+    >>> stats['submitted'], stats['completed'], stats['rejected']
+    (1, 1, 0)
+    >>> import threading
+    >>> unblock = threading.Event()
+    >>> busy_job = pool.submit(unblock.wait)
+    >>> pool.run(sum, [1])
+    Traceback (most recent call last):
+       ...
+    hashing.PoolSaturatedException: 1 hashing jobs already pending
+    >>> unblock.set()
+    >>> busy_job.result()
+    True
+    >>> pool.shutdown()
+    """
+    executor_types = {'thread': ThreadPoolExecutor,
+                      'process': ProcessPoolExecutor}
+
+    def __init__(self, max_workers=2, max_queue=8, pool_type='thread'):
+        """
+        Keyword Parameters:
+          max_workers  -- Integer, maximum number of concurrent hash jobs
+          max_queue  -- Integer, maximum number of jobs waiting for a worker
+          pool_type  -- String, 'thread' or 'process'
+        """
+        if pool_type not in self.executor_types:
+            raise ValueError('Unknown pool_type: {}'.format(pool_type))
+        self.max_workers = max_workers
+        self.max_pending = max_workers + max_queue
+        self.pool_type = pool_type
+        self._executor = None # created on first use (not at import time)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._counters = {'submitted': 0, 'completed': 0, 'failed': 0,
+                          'rejected': 0, 'run_seconds': 0.0,
+                          'wait_seconds': 0.0, 'max_run_seconds': 0.0}
+
+    def _get_executor(self):
+        """Returns the pool executor, creating it if necessary"""
+        if self._executor is None:
+            executor_class = self.executor_types[self.pool_type]
+            self._executor = executor_class(max_workers=self.max_workers)
+        return self._executor
+
+    def submit(self, function, *args):
+        """
+        Schedule a hashing job & return a Future for its result
+
+        Raises PoolSaturatedException if all workers are busy & the
+        queue is already full.
+
+        Keyword Parameters:
+          function  -- callable, hashing job to run
+          args  -- positional arguments for function
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._counters['rejected'] += 1
+                msg = '{} hashing jobs already pending'.format(self._pending)
+                raise PoolSaturatedException(msg)
+            self._pending += 1
+            self._counters['submitted'] += 1
+            executor = self._get_executor()
+        submitted = time.perf_counter()
+        try:
+            timed_future = executor.submit(_timed_call, function, args)
+        except:
+            self._finish_job(None, 0.0)
+            raise
+        return _JobFuture(self, timed_future, submitted)
+
+    def run(self, function, *args, timeout=None):
+        """
+        Returns result of hashing job, blocking until it is complete
+
+        Keyword Parameters:
+          function  -- callable, hashing job to run
+          args  -- positional arguments for function
+          timeout  -- Number, max seconds to wait for result (Optional)
+        """
+        return self.submit(function, *args).result(timeout)
+
+    def map(self, function, arg_tuples, retry_seconds=0.01):
+        """
+        Returns list of function results, for each tuple of arguments
+
+        For batch work: at most max_workers of the jobs are pending at
+        once, leaving the queue free for interactive requests. If the
+        pool is saturated this waits for capacity, rather than raising
+        PoolSaturatedException.
+
+        Keyword Parameters:
+          function  -- callable, hashing job to run
+          arg_tuples  -- iterable of Tuples, positional arguments for each job
+          retry_seconds  -- Number, seconds to wait for pool capacity
+
+        >>> pool = HashingPool(max_workers=2, max_queue=0)
+        >>> pool.map(sum, [([1, 2],), ([3],), ([4, 5],)])
+        [3, 3, 9]
+        """
+        in_flight, results = deque(), []
+        for args in arg_tuples:
+            while True:
+                if len(in_flight) < self.max_workers:
+                    try:
+                        in_flight.append(self.submit(function, *args))
+                        break
+                    except PoolSaturatedException:
+                        if not in_flight: # pool is busy with other work
+                            time.sleep(retry_seconds)
+                            continue
+                results.append(in_flight.popleft().result())
+        results.extend(job.result() for job in in_flight)
+        return results
+
+    def _finish_job(self, run_seconds, total_seconds):
+        """Record completion of a job (run_seconds None, if job failed)"""
+        with self._lock:
+            self._pending -= 1
+            if run_seconds is None:
+                self._counters['failed'] += 1
+                return
+            self._counters['completed'] += 1
+            self._counters['run_seconds'] += run_seconds
+            self._counters['wait_seconds'] += max(total_seconds-run_seconds, 0)
+            self._counters['max_run_seconds'] = max(
+                run_seconds, self._counters['max_run_seconds'])
+
+    def stats(self):
+        """Returns dict of pool job counters & timings (in seconds)"""
+        with self._lock:
+            stats = dict(self._counters, pending=self._pending)
+        completed = stats['completed']
+        stats['mean_run_seconds'] = stats['run_seconds']/completed if completed else 0.0
+        stats['mean_wait_seconds'] = stats['wait_seconds']/completed if completed else 0.0
+        return stats
+
+    def shutdown(self, wait=True):
+        """Stop pool workers (pool will restart, if used again)"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+class _JobFuture:
+    """Wrapper unpacking job result & timing from an executor Future"""
+    def __init__(self, pool, timed_future, submitted):
+        self._pool = pool
+        self._submitted = submitted
+        self._recorded = False
+        self._timed_future = timed_future
+        timed_future.add_done_callback(self._record)
+
+    def _record(self, timed_future):
+        """Record job timing with the pool (exactly once)"""
+        with self._pool._lock:
+            if self._recorded:
+                return
+            self._recorded = True
+        total_seconds = time.perf_counter() - self._submitted
+        try:
+            run_seconds, result = timed_future.result()
+        except BaseException:
+            run_seconds = None # job raised an Exception, or was cancelled
+        self._pool._finish_job(run_seconds, total_seconds)
+
+    def done(self):
+        """Returns True if job has finished"""
+        return self._timed_future.done()
+
+    def add_done_callback(self, callback):
+        """
+        Call callback (with this job) once the job has finished
+
+        The callback may be called from a pool thread.
+        """
+        self._timed_future.add_done_callback(lambda timed_future: callback(self))
+
+    def result(self, timeout=None):
+        """Returns job result, blocking up to timeout seconds"""
+        try:
+            run_seconds, result = self._timed_future.result(timeout)
+        finally:
+            if self._timed_future.done():
+                self._record(self._timed_future) # dont wait for callback
+        return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Pick argon2 cost settings for this machine')
+    parser.add_argument('target_seconds', type=float, nargs='?', default=0.25,
+                        help='desired duration of one password hash')
+    parser.add_argument('--memory-cost', type=int, help='starting KiB')
+    parser.add_argument('--parallelism', type=int)
+    args = parser.parse_args()
+    policy = HashPolicy.calibrate(args.target_seconds, args.memory_cost,
+                                  args.parallelism)
+    for name, setting in [('memory_cost', 'HASH_MEMORY_COST'),
+                          ('rounds', 'HASH_TIME_COST'),
+                          ('parallelism', 'HASH_PARALLELISM')]:
+        print('RESTDEMO_{}={}'.format(setting, policy.settings[name]))
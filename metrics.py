@@ -0,0 +1,285 @@
+"""
+Module defining low-overhead request timing histograms & their exposition
+
+Durations are recorded into fixed-bucket histograms (one per metric name &
+label values), & rendered in the Prometheus text exposition format:
+
+  restdemo_request_duration_seconds  -- whole API requests, by method,
+    route & status
+  restdemo_phase_duration_seconds  -- one layer of a request, by phase
+    (e.g.: datastore_query, password_verify, session_load, json_encode)
+"""
+from bisect import bisect_left
+import random
+import threading
+import time
+
+import falcon
+
+REQUEST_METRIC = 'restdemo_request_duration_seconds'
+PHASE_METRIC = 'restdemo_phase_duration_seconds'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# bucket upper bounds (seconds): from a cache hit, up to a slow password hash
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """
+    Class encapsulating counts of observed values, per bucket
+
+    >>> histogram = Histogram(buckets=(0.1, 1.0))
+    >>> for seconds in [0.05, 0.1, 0.5, 3]:
+    ...     histogram.observe(seconds)
+    >>> histogram.snapshot()
+    ([(0.1, 2), (1.0, 3), (inf, 4)], 3.65, 4)
+    """
+    __slots__ = ('buckets', '_counts', '_sum', '_lock')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Keyword Parameters:
+          buckets  -- sorted tuple of Numbers, bucket upper bounds
+        """
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1) # last: +Inf bucket
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Record one observed value (e.g.: a duration, in seconds)"""
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self):
+        """
+        Returns tuple: list of (upper bound, cumulative count), sum & count
+        """
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        cumulative, running = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            running += count
+            cumulative.append((bound, running))
+        return cumulative, total, running
+
+class _Timer:
+    """Context manager, observing its duration into a Histogram"""
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+class _NullTimer:
+    """Context manager, for unsampled (not recorded) durations"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+NULL_TIMER = _NullTimer()
+
+def format_value(value):
+    """
+    Returns Prometheus text representation of a Number
+
+    >>> format_value(float('inf')), format_value(0.25), format_value(3)
+    ('+Inf', '0.25', '3')
+    """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+def format_labels(labels):
+    """
+    Returns Prometheus text representation of a label tuple
+
+    >>> format_labels((('phase', 'session_load'), ('le', '0.1')))
+    '{phase="session_load",le="0.1"}'
+    >>> format_labels(())
+    ''
+    """
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                                .replace('"', r'\"').replace('\n', r'\n'))
+               for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+class Registry:
+    """
+    Class encapsulating a set of named, labelled histograms
+
+    >>> registry = Registry()
+    >>> with registry.timed(PHASE_METRIC, phase='example'):
+    ...     pass
+    >>> print(registry.render()) # doctest: +ELLIPSIS
+    # TYPE restdemo_phase_duration_seconds histogram
+    restdemo_phase_duration_seconds_bucket{phase="example",le="0.0001"} 1
+    ...
+    restdemo_phase_duration_seconds_count{phase="example"} 1
+    <BLANKLINE>
+    """
+    def __init__(self, sample_rate=1.0, buckets=DEFAULT_BUCKETS):
+        """
+        Keyword Parameters:
+          sample_rate  -- Number, fraction of durations to record (0-1)
+          buckets  -- sorted tuple of Numbers, histogram bucket bounds
+        """
+        self.sample_rate = sample_rate
+        self.buckets = buckets
+        self._histograms = {} # (name, label tuple): Histogram
+        self._gauges = [] # callables, returning (name, labels, value) tuples
+        self._lock = threading.Lock()
+
+    def histogram(self, name, labels=()):
+        """
+        Returns Histogram for referenced metric name & label tuple
+        """
+        key = (name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram(self.buckets))
+        return histogram
+
+    def sampled(self):
+        """Returns True if the next duration should be recorded"""
+        rate = self.sample_rate
+        return rate >= 1 or (rate > 0 and random.random() < rate)
+
+    def timed(self, name, **labels):
+        """
+        Returns context manager, recording its duration (if sampled)
+
+        >>> registry = Registry(sample_rate=0)
+        >>> with registry.timed(PHASE_METRIC, phase='example'):
+        ...     pass
+        >>> registry.render()
+        ''
+        """
+        if not self.sampled():
+            return NULL_TIMER
+        return _Timer(self.histogram(name, tuple(sorted(labels.items()))))
+
+    def observe(self, name, seconds, **labels):
+        """Record one duration, without sampling"""
+        self.histogram(name, tuple(sorted(labels.items()))).observe(seconds)
+
+    def add_gauge_callback(self, callback):
+        """
+        Report current values from callback, in each render()
+
+        Keyword Parameters:
+          callback  -- callable, returning a list of tuples: metric name,
+            dict of labels & Number value
+
+        >>> registry = Registry()
+        >>> registry.add_gauge_callback(lambda: [('example_size', {}, 2)])
+        >>> print(registry.render())
+        # TYPE example_size gauge
+        example_size 2
+        <BLANKLINE>
+        """
+        self._gauges.append(callback)
+
+    def clear(self):
+        """Discard all recorded durations"""
+        with self._lock:
+            self._histograms = {}
+
+    def render(self):
+        """Returns String: all metrics, in Prometheus text format"""
+        lines = []
+        by_name = {}
+        for (name, labels), histogram in sorted(self._histograms.items(),
+                                                key=lambda item: item[0]):
+            by_name.setdefault(name, []).append((labels, histogram))
+        for name, series in sorted(by_name.items()):
+            lines.append('# TYPE {} histogram'.format(name))
+            for labels, histogram in series:
+                buckets, total, count = histogram.snapshot()
+                for bound, cumulative in buckets:
+                    lines.append('{}_bucket{} {}'.format(
+                        name, format_labels(labels + (('le', format_value(bound)),)),
+                        cumulative))
+                lines.append('{}_sum{} {}'.format(
+                    name, format_labels(labels), format_value(total)))
+                lines.append('{}_count{} {}'.format(
+                    name, format_labels(labels), count))
+        gauges = {}
+        for callback in self._gauges:
+            for name, labels, value in callback():
+                gauges.setdefault(name, []).append(
+                    (tuple(sorted(labels.items())), value))
+        for name, series in sorted(gauges.items()):
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in series:
+                lines.append('{}{} {}'.format(
+                    name, format_labels(labels), format_value(value)))
+        if not lines:
+            return ''
+        return '\n'.join(lines) + '\n'
+
+registry = Registry() # process-wide metrics
+
+def timed(phase):
+    """
+    Returns context manager, recording the duration of a request phase
+
+    Keyword Parameters:
+      phase  -- String, name of the timed layer (e.g.: 'datastore_query')
+    """
+    return registry.timed(PHASE_METRIC, phase=phase)
+
+class TimedResponse(falcon.Response):
+    """Falcon Response, timing the encoding of its media (e.g.: JSON)"""
+    __slots__ = ()
+
+    @property
+    def media(self):
+        return self._media
+
+    @media.setter
+    def media(self, obj):
+        with timed('json_encode'):
+            falcon.Response.media.fset(self, obj)
+
+class MetricsMiddleware:
+    """
+    Falcon middleware, timing each request (if sampled)
+    """
+    def process_request(self, req, resp):
+        if registry.sampled():
+            req.context['metrics_started'] = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        started = req.context.get('metrics_started')
+        if started is None:
+            return # not sampled
+        registry.observe(REQUEST_METRIC, time.perf_counter() - started,
+                         method=req.method,
+                         route=req.uri_template or 'unrouted',
+                         status=resp.status.split(' ', 1)[0])
+
+class MetricsResource:
+    """Falcon Resource to expose metrics, in Prometheus text format"""
+    def __init__(self, metrics_registry=None):
+        self.registry = metrics_registry or registry
+
+    def on_get(self, req, resp):
+        """Handle GET requests for current metric values"""
+        resp.content_type = CONTENT_TYPE
+        resp.body = self.registry.render()
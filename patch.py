@@ -0,0 +1,213 @@
+"""
+Module defining JSON Merge Patch (RFC 7396) & JSON Patch (RFC 6902) functions
+
+Used to partially update user data, without replacing the whole document.
+"""
+import copy
+
+MERGE_PATCH = 'application/merge-patch+json'
+JSON_PATCH = 'application/json-patch+json'
+
+class InvalidPatchException(ValueError):
+    """Raised when a patch document is malformed"""
+
+class PatchConflictException(RuntimeError):
+    """Raised when a patch can't be applied to the current document"""
+
+def merge_patch(target, patch):
+    """
+    Returns result of applying a JSON Merge Patch to target
+
+    Keyword Parameters:
+      target  -- JSON value (e.g.: Dict) to patch. It is not modified.
+      patch  -- JSON value: members to replace, or remove (if null)
+
+    >>> from pprint import pprint
+    >>> pprint(merge_patch({'a': 'b', 'c': {'d': 'e', 'f': 'g'}},
+    ...                    {'a': 'z', 'c': {'f': None}}))
+    {'a': 'z', 'c': {'d': 'e'}}
+    >>> merge_patch({'a': 'b'}, ['c'])
+    ['c']
+    """
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    if isinstance(target, dict):
+        result = dict(target)
+    else:
+        result = {}
+    for name, value in patch.items():
+        if value is None:
+            result.pop(name, None)
+        else:
+            result[name] = merge_patch(result.get(name), value)
+    return result
+
+def parse_pointer(pointer):
+    """
+    Returns list of reference tokens (Strings), from a JSON Pointer
+
+    >>> parse_pointer('/a~1b/0/m~0n')
+    ['a/b', '0', 'm~n']
+    >>> parse_pointer('')
+    []
+    """
+    if pointer == '':
+        return []
+    if not isinstance(pointer, str) or not pointer.startswith('/'):
+        raise InvalidPatchException('Invalid JSON Pointer: {}'.format(pointer))
+    return [token.replace('~1', '/').replace('~0', '~')
+            for token in pointer[1:].split('/')]
+
+def validate_operations(operations):
+    """
+    Returns list of JSON Patch operations, or raises InvalidPatchException
+
+    Each operation is returned as a dict, with its 'path' (& any 'from')
+    parsed into a list of reference tokens.
+
+    >>> validate_operations([{'op': 'add', 'path': '/a', 'value': 1}])
+    [{'op': 'add', 'path': ['a'], 'value': 1}]
+    >>> validate_operations([{'op': 'add', 'path': '/a'}])
+    Traceback (most recent call last):
+       ...
+    patch.InvalidPatchException: Operation 0 is missing: value
+    """
+    required = {'add': ['path', 'value'], 'remove': ['path'],
+                'replace': ['path', 'value'], 'move': ['from', 'path'],
+                'copy': ['from', 'path'], 'test': ['path', 'value']}
+    if not isinstance(operations, list):
+        raise InvalidPatchException('JSON Patch must be a list of operations')
+    parsed = []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in required:
+            raise InvalidPatchException('Operation {} is invalid'.format(index))
+        for member in required[operation['op']]:
+            if member not in operation:
+                raise InvalidPatchException('Operation {} is missing: {}'.format(
+                    index, member))
+        operation = dict(operation, path=parse_pointer(operation['path']))
+        if 'from' in required[operation['op']]:
+            operation['from'] = parse_pointer(operation['from'])
+        parsed.append(operation)
+    return parsed
+
+def _index(container, token, adding=False):
+    """Returns list index or dict key, referenced by token"""
+    if isinstance(container, dict):
+        if not adding and token not in container:
+            raise PatchConflictException('No such member: {}'.format(token))
+        return token
+    if isinstance(container, list):
+        if adding and token == '-':
+            return len(container)
+        if not token.isdigit() or (len(token) > 1 and token.startswith('0')):
+            raise PatchConflictException('Invalid array index: {}'.format(token))
+        index = int(token)
+        if index > len(container) or (index == len(container) and not adding):
+            raise PatchConflictException('Array index out of range: {}'.format(token))
+        return index
+    raise PatchConflictException('Cannot reference into a scalar value')
+
+def _get(document, tokens):
+    """Returns the value referenced by a list of tokens"""
+    for token in tokens:
+        document = document[_index(document, token)]
+    return document
+
+def _add(document, tokens, value):
+    """Returns document, with value added at location tokens"""
+    if not tokens:
+        return value # replace the whole document
+    parent = _get(document, tokens[:-1])
+    index = _index(parent, tokens[-1], adding=True)
+    if isinstance(parent, list):
+        parent.insert(index, value)
+    else:
+        parent[index] = value
+    return document
+
+def _remove(document, tokens):
+    """Returns value removed from location tokens"""
+    if not tokens:
+        raise PatchConflictException('Cannot remove the whole document')
+    parent = _get(document, tokens[:-1])
+    return parent.pop(_index(parent, tokens[-1]))
+
+def _equal(value, other):
+    """
+    Returns True if JSON values are equal, per RFC 6902 'test' operations
+
+    Unlike Python's ==, booleans never equal numbers (though numbers are
+    compared by value), at any depth.
+
+    >>> _equal({'a': [1, {'b': 2.0}]}, {'a': [1.0, {'b': 2}]})
+    True
+    >>> _equal(True, 1), _equal([0], [False]), _equal({'a': 1}, {'a': True})
+    (False, False, False)
+    """
+    if isinstance(value, bool) or isinstance(other, bool):
+        return value is other
+    if isinstance(value, dict) and isinstance(other, dict):
+        return value.keys() == other.keys() and all(
+            _equal(value[key], other[key]) for key in value)
+    if isinstance(value, list) and isinstance(other, list):
+        return len(value) == len(other) and all(
+            _equal(item, other_item) for item, other_item in zip(value, other))
+    if isinstance(value, (dict, list)) or isinstance(other, (dict, list)):
+        return False
+    return value == other
+
+def apply_json_patch(document, operations):
+    """
+    Returns result of applying JSON Patch operations to document
+
+    Raises PatchConflictException if an operation can't be applied (e.g.:
+    it references a missing member, or a 'test' operation fails)
+
+    Keyword Parameters:
+      document  -- JSON value (e.g.: Dict) to patch. It is not modified.
+      operations  -- List of operations, from validate_operations
+
+    >>> apply_json_patch({'a': [1, 2]}, validate_operations([
+    ...     {'op': 'add', 'path': '/a/1', 'value': 9},
+    ...     {'op': 'copy', 'from': '/a', 'path': '/b'},
+    ...     {'op': 'remove', 'path': '/a/0'}]))
+    {'a': [9, 2], 'b': [1, 9, 2]}
+    >>> apply_json_patch({'a': 1}, validate_operations([
+    ...     {'op': 'test', 'path': '/a', 'value': 2}]))
+    Traceback (most recent call last):
+       ...
+    patch.PatchConflictException: Test failed: /a
+    >>> apply_json_patch({'a': 1}, validate_operations([
+    ...     {'op': 'test', 'path': '/a', 'value': True}]))
+    Traceback (most recent call last):
+       ...
+    patch.PatchConflictException: Test failed: /a
+    """
+    document = copy.deepcopy(document)
+    for operation in operations:
+        op, path = operation['op'], operation['path']
+        if op == 'add':
+            document = _add(document, path, copy.deepcopy(operation['value']))
+        elif op == 'remove':
+            _remove(document, path)
+        elif op == 'replace':
+            _get(document, path) # must exist
+            if path:
+                _remove(document, path)
+            document = _add(document, path, copy.deepcopy(operation['value']))
+        elif op == 'move':
+            if path[:len(operation['from'])] == operation['from'] and path != operation['from']:
+                raise PatchConflictException('Cannot move a value into itself')
+            value = _get(document, operation['from'])
+            if operation['from']:
+                _remove(document, operation['from'])
+            document = _add(document, path, value)
+        elif op == 'copy':
+            value = copy.deepcopy(_get(document, operation['from']))
+            document = _add(document, path, value)
+        elif op == 'test':
+            if not _equal(_get(document, path), operation['value']):
+                raise PatchConflictException('Test failed: /{}'.format('/'.join(
+                    token.replace('~', '~0').replace('/', '~1') for token in path)))
+    return document
@@ -0,0 +1,105 @@
+"""
+Module defining in-memory token bucket rate limiters, for login attempts
+"""
+from collections import OrderedDict
+import threading
+import time
+
+class TokenBucketLimiter:
+    """
+    Class encapsulating a token bucket for each key (e.g.: a username)
+
+    Each bucket holds up to burst tokens, refilled at rate tokens per
+    second, & each attempt takes one token. At most max_keys buckets are
+    kept: the least recently used are evicted.
+
+    >>> now = [0]
+    >>> limiter = TokenBucketLimiter(rate=0.5, burst=2, clock=lambda: now[0])
+    >>> limiter.acquire('pat.ng'), limiter.acquire('pat.ng')
+    (0, 0)
+    >>> limiter.acquire('pat.ng') # empty: seconds until next token
+    2.0
+    >>> now[0] = 2 # later
+    >>> limiter.acquire('pat.ng')
+    0
+    """
+    def __init__(self, rate, burst, max_keys=100000, clock=time.monotonic):
+        """
+        Keyword Parameters:
+          rate  -- Number, tokens added to each bucket per second
+          burst  -- Integer, maximum tokens held by a bucket
+          max_keys  -- Integer, maximum number of buckets to keep
+          clock  -- callable, returning current time in seconds
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._clock = clock
+        self._buckets = OrderedDict() # key: (tokens, time last updated)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def acquire(self, key):
+        """
+        Take a token from key's bucket
+
+        Returns 0 if a token was taken, or the Number of seconds until the
+        bucket will have a token (the attempt should be refused)
+        """
+        now = self._clock()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return (1 - tokens) / self.rate
+            self._buckets[key] = (tokens - 1, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False) # least recently used
+            return 0
+
+class LoginLimiter:
+    """
+    Class limiting login attempts per username, & per client address
+
+    >>> limiter = LoginLimiter(user_rate=1, user_burst=1,
+    ...                        address_rate=60, address_burst=10)
+    >>> limiter.check('pat.ng', '192.0.2.1')
+    0
+    >>> limiter.check('pat.ng', '192.0.2.2') > 0 # same user, elsewhere
+    True
+    >>> limiter.check('cruz', '192.0.2.1')
+    0
+    """
+    def __init__(self, user_rate, user_burst, address_rate, address_burst,
+                 max_keys=100000):
+        """
+        Keyword Parameters:
+          user_rate  -- Number, attempts per minute for each username (0:
+            no limit)
+          user_burst  -- Integer, attempts allowed at once for a username
+          address_rate  -- Number, attempts per minute for each client
+            address (0: no limit)
+          address_burst  -- Integer, attempts allowed at once for an address
+          max_keys  -- Integer, maximum usernames (& addresses) to track
+        """
+        self.limiters = []
+        for key_type, rate, burst in [('user', user_rate, user_burst),
+                                      ('address', address_rate, address_burst)]:
+            if rate > 0:
+                self.limiters.append((key_type, TokenBucketLimiter(
+                    rate / 60.0, burst, max_keys)))
+
+    def check(self, username, address):
+        """
+        Returns 0 if a login attempt is allowed, or the Number of seconds
+        the client should wait before trying again
+        """
+        keys = {'user': username, 'address': address}
+        for key_type, limiter in self.limiters:
+            retry_after = limiter.acquire(keys[key_type])
+            if retry_after:
+                return retry_after
+        return 0
@@ -1,14 +1,42 @@
 """
 Module defining user session utility functions
+
+Sessions are identified by a cookie token, & kept by a session store:
+  signed  -- (default, given a secret) stateless HMAC-signed tokens,
+    holding the session data itself. Logouts are recorded in a compact
+    in-memory revocation set.
+  memory  -- random tokens, referencing session data held in an in-memory
+    LRU cache (a local stand-in for a shared cache service)
+  sqlite  -- (default, without a secret) random tokens, referencing
+    session data held in a SQLite3 database file: shared by every process
+    on the host
+  beaker  -- Beaker sessions, stored in a SQLite3 database
 """
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime, timedelta
+from http.cookies import SimpleCookie, CookieError
+import binascii
+import hashlib
+import hmac
+import json
 import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import cache, config, metrics
 
-from beaker.middleware import SessionMiddleware
-import sqlalchemy
+ENVIRON_KEY = 'api.session' # WSGI environ key, for the request's Session
+COOKIE_NAME = 'api.session.id'
+BEAKER_URL = 'sqlite:///beaker.sqlite3'
+
+reaper = None # SessionReaper, for the installed session middleware
 
 def create_login_session(username, request):
     """
-    Establishes a Beaker session for the referenced user
+    Establishes a session for the referenced user
 
     Keyword Parameters:
     username  -- String, identifying user
@@ -16,14 +44,32 @@ def create_login_session(username, request):
 
     >>> from unittest.mock import Mock
     >>> fake_req = Mock()
-    >>> fake_req.env = {'beaker.session': {}}
+    >>> store = MemoryStore(max_size=2, max_age=3600)
+    >>> fake_req.env = {'api.session': Session(store)}
     >>> # Check login
     >>> create_login_session('pat.ng', fake_req)
-    >>> fake_req.env
-    {'beaker.session': {'name': 'pat.ng'}}
+    >>> store.load(fake_req.env['api.session'].token)
+    {'name': 'pat.ng'}
     """
-    session = request.env['beaker.session']
+    session = request.env[ENVIRON_KEY]
     session['name'] = username
+    with metrics.timed('session_save'):
+        session.save() # sessions are only persisted when changed
+
+def has_session_cookie(request):
+    """
+    Returns True if the request carries a session token cookie
+
+    Keyword Parameters:
+    request  -- Falcon HTTP request object representing current API call
+
+    >>> from unittest.mock import Mock
+    >>> fake_req = Mock()
+    >>> fake_req.cookies = {}
+    >>> has_session_cookie(fake_req)
+    False
+    """
+    return COOKIE_NAME in request.cookies
 
 def get_user_name(request):
     """
@@ -36,9 +82,12 @@ def get_user_name(request):
     """
     # obtain logged in API username (if available)
     session_user_name = None #default
-    if 'beaker.session' in request.env:
+    if not has_session_cookie(request):
+        return session_user_name # anonymous: dont touch the session store
+    if ENVIRON_KEY in request.env:
         try:
-            session_user_name = request.env['beaker.session'].get('name')
+            with metrics.timed('session_load'):
+                session_user_name = request.env[ENVIRON_KEY].get('name')
         except KeyError:
             pass # return default
     return session_user_name
@@ -50,8 +99,560 @@ def invalidate_session(request):
     Keyword Parameters:
     request  -- Falcon HTTP request object representing current API call
     """
-    if 'beaker.session' in request.env:
-        request.env['beaker.session'].delete()
+    if ENVIRON_KEY in request.env and has_session_cookie(request):
+        request.env[ENVIRON_KEY].delete()
+
+def _b64encode(data):
+    """Returns URL & cookie-safe String encoding of referenced bytes"""
+    return urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+def _b64decode(text):
+    """Returns bytes, decoded from a _b64encode String"""
+    return urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+class SignedCookieStore:
+    """
+    Class encapsulating stateless, HMAC-signed session tokens
+
+    Tokens carry the session data (so they must hold nothing secret) &
+    an expiry time. Deleted tokens are remembered, until they expire.
+
+    >>> store = SignedCookieStore(b'secret key', max_age=3600)
+    >>> token = store.save(None, {'name': 'pat.ng'})
+    >>> store.load(token)
+    {'name': 'pat.ng'}
+    >>> store.load(token[:-2] + 'xx') is None # tampered
+    True
+    >>> store.load('a\xe9.abc') is None, store.load('abc.\xe9') is None
+    (True, True)
+    >>> store.delete(token)
+    >>> store.load(token) is None # revoked
+    True
+    """
+    def __init__(self, secret, max_age, clock=time.time):
+        """
+        Keyword Parameters:
+          secret  -- bytes, key used to sign tokens
+          max_age  -- Integer, seconds a token remains valid
+          clock  -- callable, returning current time in seconds
+        """
+        self._secret = secret
+        self.max_age = max_age
+        self._clock = clock
+        self._revoked = {} # token id: expiry time
+        self._lock = threading.Lock()
+
+    def _sign(self, payload):
+        """Returns signature (ASCII bytes) of payload bytes"""
+        digest = hmac.new(self._secret, payload, hashlib.sha256)
+        return _b64encode(digest.digest()).encode('ascii')
+
+    def _verify(self, token):
+        """Returns claims dict from valid, unexpired token (or None)"""
+        try:
+            token = token.encode('ascii')
+        except UnicodeEncodeError:
+            return None # (not a token this store made)
+        payload, separator, signature = token.rpartition(b'.')
+        if not payload or not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        try:
+            claims = json.loads(_b64decode(payload.decode('ascii')).decode('utf-8'))
+        except (ValueError, binascii.Error):
+            return None
+        if claims['exp'] <= self._clock():
+            return None
+        return claims
+
+    def load(self, token):
+        """Returns session data dict for token (None, if invalid)"""
+        claims = self._verify(token)
+        if claims is None or claims['id'] in self._revoked:
+            return None
+        return claims['data']
+
+    def save(self, token, data):
+        """
+        Returns new token for session data, revoking any previous token
+
+        >>> store = SignedCookieStore(b'secret key', max_age=3600)
+        >>> first = store.save(None, {'name': 'pat.ng'})
+        >>> second = store.save(first, {'name': 'pat.ng'})
+        >>> store.load(first) is None, store.load(second)
+        (True, {'name': 'pat.ng'})
+        """
+        if token is not None:
+            self.delete(token)
+        claims = {'data': data,
+                  'exp': int(self._clock() + self.max_age),
+                  'id': _b64encode(os.urandom(9))}
+        payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+        signature = self._sign(payload.encode('ascii')).decode('ascii')
+        return '{}.{}'.format(payload, signature)
+
+    def delete(self, token):
+        """Revoke token, until it would have expired anyway"""
+        claims = self._verify(token)
+        if claims is None:
+            return # already invalid
+        with self._lock:
+            self._revoked[claims['id']] = claims['exp']
+
+    def reap(self, batch_size):
+        """
+        Forget revoked tokens which have since expired
+
+        Returns number of revoked token ids removed (up to batch_size)
+
+        >>> now = [0]
+        >>> store = SignedCookieStore(b'secret key', 60, clock=lambda: now[0])
+        >>> store.delete(store.save(None, {'name': 'pat.ng'}))
+        >>> store.reap(batch_size=10)
+        0
+        >>> now[0] = 61 # later
+        >>> store.reap(batch_size=10)
+        1
+        """
+        now = self._clock()
+        with self._lock:
+            expired = []
+            for token_id, expires in self._revoked.items():
+                if expires <= now:
+                    expired.append(token_id)
+                    if len(expired) >= batch_size:
+                        break
+            for token_id in expired:
+                del self._revoked[token_id]
+        return len(expired)
+
+class MemoryStore:
+    """
+    Class encapsulating session data held in an in-process LRU cache
+
+    >>> store = MemoryStore(max_size=2, max_age=3600)
+    >>> token = store.save(None, {'name': 'pat.ng'})
+    >>> store.load(token)
+    {'name': 'pat.ng'}
+    >>> store.delete(token)
+    >>> store.load(token) is None
+    True
+    """
+    def __init__(self, max_size, max_age):
+        """
+        Keyword Parameters:
+          max_size  -- Integer, maximum number of sessions to hold
+          max_age  -- Integer, seconds until a session expires
+        """
+        self.max_age = max_age
+        self.sessions = cache.LRUCache(max_size=max_size, ttl=max_age)
+
+    def load(self, token):
+        """Returns session data dict for token (None, if invalid)"""
+        data = self.sessions.get(token)
+        if data is None:
+            return None
+        return dict(data)
+
+    def save(self, token, data):
+        """Returns new token for session data, removing any previous one"""
+        if token is not None:
+            self.delete(token)
+        new_token = _b64encode(os.urandom(24))
+        self.sessions.set(new_token, dict(data))
+        return new_token
+
+    def delete(self, token):
+        """Remove session referenced by token"""
+        self.sessions.invalidate(token)
+
+    def reap(self, batch_size):
+        """Remove expired sessions, returns number removed (up to batch_size)"""
+        return self.sessions.purge_expired(limit=batch_size)
+
+class SQLiteStore:
+    """
+    Class encapsulating session data held in a SQLite3 database file
+
+    Every process using the same file shares the sessions (e.g.: several
+    WSGI daemon processes). Each thread keeps its own connection.
+
+    >>> from tempfile import TemporaryDirectory
+    >>> with TemporaryDirectory() as db_dir:
+    ...     path = '{}/sessions.sqlite3'.format(db_dir)
+    ...     token = SQLiteStore(path, max_age=3600).save(None, {'name': 'pat.ng'})
+    ...     other_process = SQLiteStore(path, max_age=3600)
+    ...     other_process.load(token)
+    ...     other_process.delete(token)
+    ...     SQLiteStore(path, max_age=3600).load(token) is None
+    {'name': 'pat.ng'}
+    True
+    """
+    schema_sql = ('CREATE TABLE IF NOT EXISTS session ('
+                  ' token TEXT PRIMARY KEY, data TEXT NOT NULL,'
+                  ' expires REAL NOT NULL);'
+                  'CREATE INDEX IF NOT EXISTS ix_session_expires ON session (expires)')
+
+    def __init__(self, path, max_age, busy_timeout=5000, clock=time.time):
+        """
+        Keyword Parameters:
+          path  -- String, SQLite3 database file (created if needed)
+          max_age  -- Integer, seconds until a session expires
+          busy_timeout  -- Integer, milliseconds to wait for another
+            process' write lock
+          clock  -- callable, returning current time in seconds
+        """
+        self.path = path
+        self.max_age = max_age
+        self.busy_timeout = busy_timeout
+        self._clock = clock
+        self._local = threading.local() # connection, for each thread
+
+    def _connect(self):
+        """Returns this thread's database connection (opened on first use)"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path,
+                                         timeout=self.busy_timeout / 1000.0)
+            # readers dont block the (single) writer, & vice versa
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(self.schema_sql)
+            self._local.connection = connection
+        return connection
+
+    def load(self, token):
+        """Returns session data dict for token (None, if invalid)"""
+        row = self._connect().execute(
+            'SELECT data FROM session WHERE token = ? AND expires > ?',
+            (token, self._clock())).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save(self, token, data):
+        """Returns new token for session data, removing any previous one"""
+        new_token = _b64encode(os.urandom(24))
+        connection = self._connect()
+        with connection: # one transaction
+            if token is not None:
+                connection.execute('DELETE FROM session WHERE token = ?', (token,))
+            connection.execute('INSERT INTO session VALUES (?, ?, ?)',
+                               (new_token, json.dumps(data),
+                                self._clock() + self.max_age))
+        return new_token
+
+    def delete(self, token):
+        """Remove session referenced by token"""
+        connection = self._connect()
+        with connection:
+            connection.execute('DELETE FROM session WHERE token = ?', (token,))
+
+    def reap(self, batch_size):
+        """
+        Remove expired sessions, returns number removed (up to batch_size)
+
+        >>> now = [0]
+        >>> store = SQLiteStore(':memory:', max_age=60, clock=lambda: now[0])
+        >>> token = store.save(None, {'name': 'pat.ng'})
+        >>> now[0] = 61 # later
+        >>> store.reap(batch_size=10)
+        1
+        """
+        connection = self._connect()
+        with connection:
+            return connection.execute(
+                'DELETE FROM session WHERE token IN (SELECT token FROM session'
+                ' WHERE expires <= ? LIMIT ?)', (self._clock(), batch_size)).rowcount
+
+class BeakerSessionTable:
+    """
+    Class encapsulating removal of expired Beaker SQLite3 sessions
+    """
+    index_sql = 'CREATE INDEX IF NOT EXISTS ix_beaker_cache_accessed ON beaker_cache (accessed)'
+    delete_sql = ('DELETE FROM beaker_cache WHERE id IN ('
+                  ' SELECT id FROM beaker_cache WHERE accessed < :cutoff LIMIT :batch_size)')
+
+    def __init__(self, url, max_age):
+        """
+        Keyword Parameters:
+          url  -- String, SQLAlchemy URL of the Beaker session database
+          max_age  -- Integer, seconds since last access that a session
+            remains valid
+        """
+        self.url = url
+        self.max_age = max_age
+        self._engine = None # created on first reap (not at import time)
+        self._indexed = False
+
+    def reap(self, batch_size):
+        """Remove expired sessions, returns number removed (up to batch_size)"""
+        # deferred: SQLAlchemy is slow to import
+        import sqlalchemy
+        from sqlalchemy.exc import OperationalError
+        if self._engine is None:
+            self._engine = sqlalchemy.create_engine(self.url)
+        if not self._indexed:
+            try:
+                self._engine.execute(self.index_sql)
+            except OperationalError:
+                return 0 # Beaker hasn't created its table yet
+            self._indexed = True
+        # Beaker records access times as local time
+        cutoff = datetime.now() - timedelta(seconds=self.max_age)
+        result = self._engine.execute(sqlalchemy.text(self.delete_sql),
+                                      cutoff=cutoff, batch_size=batch_size)
+        return result.rowcount
+
+class SessionReaper:
+    """
+    Class encapsulating periodic removal of expired sessions
+
+    Each run removes expired sessions from a store in batches (pausing
+    between batches, so the store isn't locked for long) & logs the
+    number of sessions removed & time taken.
+
+    >>> store = MemoryStore(max_size=10, max_age=0) # expire immediately
+    >>> for login in range(3):
+    ...     token = store.save(None, {'name': 'pat.ng'})
+    >>> reaper = SessionReaper(store, interval=60, batch_size=2, pause=0)
+    >>> stats = reaper.run_once()
+    >>> stats['removed'], stats['batches']
+    (3, 2)
+    """
+    def __init__(self, store, interval, batch_size, max_batches=100, pause=0.05):
+        """
+        Keyword Parameters:
+          store  -- session store (or BeakerSessionTable) object, to reap
+          interval  -- Number, seconds between runs
+          batch_size  -- Integer, maximum sessions to remove per batch
+          max_batches  -- Integer, maximum batches per run
+          pause  -- Number, seconds to wait between batches
+        """
+        self.store = store
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.pause = pause
+        self.last_run = None # stats from most recent run
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        """Returns stats dict, after removing a round of expired sessions"""
+        started = time.perf_counter()
+        removed, batches = 0, 0
+        while batches < self.max_batches:
+            batch_removed = self.store.reap(self.batch_size)
+            removed += batch_removed
+            batches += 1
+            if batch_removed < self.batch_size:
+                break # all expired sessions are gone
+            if self._stop.wait(self.pause):
+                break # shutting down
+        self.last_run = {'removed': removed, 'batches': batches,
+                         'seconds': time.perf_counter() - started}
+        logger = logging.getLogger(SessionReaper.__name__)
+        logger.info('Removed %(removed)d expired sessions in %(seconds).3fs',
+                    self.last_run)
+        return self.last_run
+
+    def _run(self):
+        """
+        Repeat runs until stopped
+
+        The first run waits a random part of the interval, so it doesn't
+        slow process startup (nor coincide with other new processes')
+        """
+        logger = logging.getLogger(SessionReaper.__name__)
+        if self._stop.wait(random.uniform(0, self.interval)):
+            return
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(e) # dont worry, will be retried next interval
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        """Begin reaping sessions periodically, in a background thread"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='session-reaper')
+        self._thread.start()
+
+    def stop(self):
+        """Stop background reaping"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+class Session:
+    """
+    Class encapsulating session data for one API request
+
+    Provides the subset of the dict (& Beaker session) interface used by
+    this module. Session data is only loaded from the store when first
+    accessed, & only written back when it has changed.
+
+    >>> store = MemoryStore(max_size=2, max_age=3600)
+    >>> session = Session(store)
+    >>> session.get('name') is None
+    True
+    >>> session['name'] = 'pat.ng'
+    >>> session.modified
+    True
+    >>> session.save()
+    >>> session.modified, store.load(session.token)
+    (False, {'name': 'pat.ng'})
+    >>> Session(store, session.token).get('name')
+    'pat.ng'
+    >>> Session(store, 'bad token').get('name') is None
+    True
+    """
+    def __init__(self, store, token=None):
+        """
+        Keyword Parameters:
+          store  -- session store (e.g.: SignedCookieStore) object
+          token  -- String, session token from the request's cookie
+        """
+        self.store = store
+        self.token = token
+        self.cookie_out = None # new token for the response cookie
+        self.modified = False
+        self.deleted = False
+        self._data = None # not loaded yet
+
+    def _load(self):
+        """Returns session data dict, loading it from store if needed"""
+        if self._data is None:
+            self._data = {}
+            if self.token is not None:
+                loaded = self.store.load(self.token)
+                if loaded is None:
+                    self.token = None # expired or invalid
+                else:
+                    self._data = loaded
+        return self._data
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+        self.modified = True
+
+    def get(self, key, default=None):
+        return self._load().get(key, default)
+
+    def delete(self):
+        """Discard session data & revoke its token"""
+        self._data = {}
+        self.deleted = True
+        self.modified = False
+
+    def save(self):
+        """
+        Persist any changes to the session store
+
+        Sets cookie_out to the new token value for the session cookie,
+        or to '' if the cookie should be removed.
+        """
+        if self.deleted:
+            if self.token is not None:
+                self.store.delete(self.token)
+                self.token = None
+                self.cookie_out = ''
+            self.deleted = False
+        elif self.modified:
+            self.token = self.store.save(self.token, self._data)
+            self.cookie_out = self.token
+            self.modified = False
+
+class SessionMiddleware:
+    """
+    WSGI Middleware, providing a Session in each request's environ
+    """
+    def __init__(self, wsgi_app, store, max_age, cookie_name=COOKIE_NAME,
+                 environ_key=ENVIRON_KEY):
+        """
+        Keyword Parameters:
+          wsgi_app  -- WSGI application to wrap
+          store  -- session store (e.g.: SignedCookieStore) object
+          max_age  -- Integer, seconds until session cookie expires
+          cookie_name  -- String, name of the session token cookie
+          environ_key  -- String, WSGI environ key to put Session in
+        """
+        self.wsgi_app = wsgi_app
+        self.store = store
+        self.max_age = max_age
+        self.cookie_name = cookie_name
+        self.environ_key = environ_key
+
+    def get_token(self, environ):
+        """Returns session token from the request's cookies (or None)"""
+        cookie_header = environ.get('HTTP_COOKIE')
+        if not cookie_header:
+            return None
+        cookies = SimpleCookie()
+        try:
+            cookies.load(cookie_header)
+        except CookieError:
+            return None # ignore malformed cookies
+        if self.cookie_name in cookies:
+            return cookies[self.cookie_name].value
+        return None
+
+    def cookie_header(self, token):
+        """
+        Returns Set-Cookie header value for token ('' removes cookie)
+        """
+        cookie = SimpleCookie()
+        cookie[self.cookie_name] = token
+        morsel = cookie[self.cookie_name]
+        morsel['path'] = '/'
+        morsel['httponly'] = True
+        morsel['max-age'] = self.max_age if token else 0
+        return morsel.output(header='')
+
+    def __call__(self, environ, start_response):
+        session = Session(self.store, self.get_token(environ))
+        environ[self.environ_key] = session
+
+        def session_start_response(status, headers, exc_info=None):
+            if session.modified or session.deleted:
+                with metrics.timed('session_save'):
+                    session.save()
+            if session.cookie_out is not None:
+                headers.append(('Set-Cookie', self.cookie_header(session.cookie_out)))
+            return start_response(status, headers, exc_info)
+        return self.wsgi_app(environ, session_start_response)
+
+def create_session_store(store_type, max_age):
+    """
+    Returns new session store object of the referenced type
+
+    Raises ValueError for 'signed' sessions, if no SESSION_SECRET is
+    configured (a random key would differ in every process).
+
+    Keyword Parameters:
+      store_type  -- String, 'signed', 'memory' or 'sqlite'
+      max_age  -- Integer, seconds until a session expires
+    """
+    if store_type == 'signed':
+        if not config.SESSION_SECRET:
+            raise ValueError('signed sessions require a SESSION_SECRET')
+        return SignedCookieStore(config.SESSION_SECRET.encode('utf-8'), max_age)
+    if store_type == 'memory':
+        return MemoryStore(config.SESSION_MEMORY_SIZE, max_age)
+    if store_type == 'sqlite':
+        return SQLiteStore(config.SESSION_DATABASE, max_age,
+                           busy_timeout=config.SQLITE_BUSY_TIMEOUT)
+    raise ValueError('Unknown session store: {}'.format(store_type))
 
 def wrap_app_with_session_middleware(wsgi_app):
     """
@@ -60,30 +661,43 @@ def wrap_app_with_session_middleware(wsgi_app):
     Keyword Parameters:
       wsgi_app  -- WSGI application to add middleware to & return
     """
-    cache_filename = 'beaker.sqlite3'
-    session_cache_url = 'sqlite:///{}'.format(cache_filename)
-    
-    max_session_days = 1 # Cookie invalid after 24h
+    global reaper
+    max_age = config.SESSION_MAX_AGE # Cookie invalid after this
+    if config.SESSION_STORE == 'beaker':
+        session_app = wrap_app_with_beaker_middleware(wsgi_app, max_age)
+        store = BeakerSessionTable(BEAKER_URL, max_age)
+    else:
+        store = create_session_store(config.SESSION_STORE, max_age)
+        session_app = SessionMiddleware(wsgi_app, store, max_age)
+    # periodically clean up old/expired sessions
+    if reaper is not None:
+        reaper.stop()
+    reaper = SessionReaper(store, interval=config.SESSION_REAP_INTERVAL,
+                           batch_size=config.SESSION_REAP_BATCH_SIZE,
+                           max_batches=config.SESSION_REAP_MAX_BATCHES,
+                           pause=config.SESSION_REAP_PAUSE)
+    if config.SESSION_REAP_INTERVAL > 0:
+        reaper.start()
+    return session_app
 
+def wrap_app_with_beaker_middleware(wsgi_app, max_age):
+    """
+    Install Beaker Middleware for SQLite3 session storage around app
+
+    Keyword Parameters:
+      wsgi_app  -- WSGI application to add middleware to & return
+      max_age  -- Integer, seconds until session cookie expires
+    """
+    # deferred: only needed for this (legacy) session store
+    from beaker.middleware import SessionMiddleware as BeakerSessionMiddleware
     session_opts = {
-        'session.cookie_expires': max_session_days*24*3600,
-        'session.auto': True, # Automatically save session
-        'session.key': 'api.session.id',
+        'session.cookie_expires': max_age,
+        'session.auto': False, # save only when changed (at login)
+        'session.key': COOKIE_NAME,
         'session.type': 'ext:database',# ext:redis may be viable migration path
-        'session.url': session_cache_url,
+        'session.url': BEAKER_URL,
     }
 
-    # attempt to clean up old/expired sessions
-    cleanup_sql = "DELETE FROM beaker_cache WHERE accessed < datetime('now', :modifier)"
-    delete_older_than_modifier = '-{} days'.format(max_session_days)
-    logger = logging.getLogger(wrap_app_with_session_middleware.__name__)
-    try:
-        engine = sqlalchemy.create_engine(session_cache_url)
-        engine.execute(cleanup_sql, [delete_older_than_modifier])
-    except Exception as e:
-        # dont worry, cleanup will be retried if WSGI app launches again
-        logger.error(e)
-        # ignore error & continue
-
     # install the session middleware
-    return SessionMiddleware(wsgi_app, session_opts)
+    return BeakerSessionMiddleware(wsgi_app, session_opts,
+                                   environ_key=ENVIRON_KEY)
@@ -3,7 +3,7 @@ Simple module defining unittest testcases for project doctests
 """
 import doctest
 
-import user, auth, session
+import user, auth, session, hashing, cache, config, api, bench, metrics, asgi, patch, ratelimit, sqlstore, writebehind, encoding
 
 def load_tests(loader, tests, ignore):
     """
@@ -12,4 +12,16 @@ def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(auth))
     tests.addTests(doctest.DocTestSuite(user))
     tests.addTests(doctest.DocTestSuite(session))
+    tests.addTests(doctest.DocTestSuite(hashing))
+    tests.addTests(doctest.DocTestSuite(cache))
+    tests.addTests(doctest.DocTestSuite(config))
+    tests.addTests(doctest.DocTestSuite(api))
+    tests.addTests(doctest.DocTestSuite(bench))
+    tests.addTests(doctest.DocTestSuite(metrics))
+    tests.addTests(doctest.DocTestSuite(asgi))
+    tests.addTests(doctest.DocTestSuite(patch))
+    tests.addTests(doctest.DocTestSuite(ratelimit))
+    tests.addTests(doctest.DocTestSuite(sqlstore))
+    tests.addTests(doctest.DocTestSuite(writebehind))
+    tests.addTests(doctest.DocTestSuite(encoding))
     return tests
@@ -2,9 +2,34 @@
 Module defining integration tests for the simple REST API
 """
 
+import asyncio
+import gzip
+import json
+import os
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import threading
+from unittest import TestCase
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+from unittest.mock import Mock, patch
+
 from falcon import testing
 
-import api, user
+import api, user, hashing, session, config, metrics, asgi, ratelimit, bench
+
+if session.reaper is not None:
+    session.reaper.stop() # (of the default session store: see TestApi)
+
+def get_hash_then_delete(get_user_hash):
+    """Returns function to read a user's hash, then delete the user"""
+    def get_hash(datastore, username):
+        stored_hash = get_user_hash(datastore, username)
+        user.delete_user(datastore, username) # (as if by another request)
+        return stored_hash
+    return get_hash
 
 class TestApi(testing.TestCase):
     """
@@ -15,7 +40,14 @@ class TestApi(testing.TestCase):
     def setUp(self):
         super(TestApi, self).setUp()
         # reset the user storage
-        api.user_storage = user.Datastore()
+        api.user_storage = api.create_user_storage()
+        api.write_buffer = api.create_write_buffer()
+        api.login_limiter = api.create_login_limiter()
+        # keep sessions in a temporary directory (not the working directory)
+        session_dir = TemporaryDirectory()
+        self.addCleanup(session_dir.cleanup)
+        api.api.store = session.SQLiteStore(
+            os.path.join(session_dir.name, 'sessions.sqlite3'), api.api.max_age)
         self.app = api.api
 
 class TestBase(TestApi):
@@ -74,8 +106,8 @@ class TestUser(TestApi):
         result = self.simulate_post(user_url, params = test_params)
         self.assertEqual(result.json, expected)
         # test for reject of double-registration
-        with self.assertRaises(Exception):
-            double_result = self.simulate_post(user_url, params = test_params)
+        double_result = self.simulate_post(user_url, params = test_params)
+        self.assertEqual(double_result.status_code, 409) # Conflict
 
         # test optional JSON sign up data (with comma characters in it)
         signup_url = '/user' # sign up a user
@@ -128,6 +160,287 @@ class TestUser(TestApi):
         result = self.simulate_get(user_url, headers={'Cookie': session_token})
         self.assertEqual(result.json, expected)
 
+    def test_patch(self):
+        user_url = '/user/pat.ng'
+        test_params = {'username': 'pat.ng', 'password': 'greatpass',
+                       'data': '{"address": "21 Jump St.", "pets": ["cat"]}'}
+        self.simulate_post('/user', params = test_params)
+        result = self.simulate_post('/auth', params = test_params)
+        session_token = result.headers['set-cookie'].lstrip().split(';', 1)[0]
+        headers = {'Cookie': session_token,
+                   'Content-Type': 'application/merge-patch+json'}
+        # merge patch
+        result = self.simulate_patch(user_url, headers = headers,
+                                     body = '{"address": null, "email": "pat@ng.fake"}')
+        self.assertEqual(result.status_code, 200) # OK
+        result = self.simulate_get(user_url, headers = headers)
+        self.assertEqual(result.json['data'], {'email': 'pat@ng.fake', 'pets': ['cat']})
+        # JSON patch
+        headers['Content-Type'] = 'application/json-patch+json'
+        operations = [{'op': 'add', 'path': '/pets/-', 'value': 'dog'},
+                      {'op': 'replace', 'path': '/email', 'value': 'pat@ng.test'}]
+        result = self.simulate_patch(user_url, headers = headers,
+                                     body = json.dumps(operations))
+        self.assertEqual(result.status_code, 200) # OK
+        result = self.simulate_get(user_url, headers = headers)
+        self.assertEqual(result.json['data'], {'email': 'pat@ng.test',
+                                               'pets': ['cat', 'dog']})
+        # non-ASCII keys
+        for operations in [[{'op': 'add', 'path': '/ué', 'value': 1}],
+                           [{'op': 'add', 'path': '/ué', 'value': 2}],
+                           [{'op': 'remove', 'path': '/email'},
+                            {'op': 'replace', 'path': '/ué', 'value': 3}]]:
+            result = self.simulate_patch(user_url, headers = headers,
+                                         body = json.dumps(operations))
+            self.assertEqual(result.status_code, 200) # OK
+        result = self.simulate_get(user_url, headers = headers)
+        self.assertEqual(result.json['data'], {'ué': 3, 'pets': ['cat', 'dog']})
+        operations = [{'op': 'remove', 'path': '/ué'}]
+        self.simulate_patch(user_url, headers = headers, body = json.dumps(operations))
+        result = self.simulate_get(user_url, headers = headers)
+        self.assertEqual(result.json['data'], {'pets': ['cat', 'dog']})
+        # failed test operation
+        operations = [{'op': 'test', 'path': '/email', 'value': 'wrong'}]
+        result = self.simulate_patch(user_url, headers = headers,
+                                     body = json.dumps(operations))
+        self.assertEqual(result.status_code, 409) # Conflict
+        # malformed patch & unsupported patch format
+        result = self.simulate_patch(user_url, headers = headers, body = '{}')
+        self.assertEqual(result.status_code, 400)
+        headers['Content-Type'] = 'text/plain'
+        result = self.simulate_patch(user_url, headers = headers, body = '{}')
+        self.assertEqual(result.status_code, 415)
+        self.assertIn('application/json-patch+json', result.headers['accept-patch'])
+
+    def test_packed_data(self):
+        """test user data stored in the packed format"""
+        data_format, config.DATA_FORMAT = config.DATA_FORMAT, 'packed'
+        threshold, config.DATA_COMPRESS_THRESHOLD = config.DATA_COMPRESS_THRESHOLD, 100
+        try:
+            api.user_storage = api.create_user_storage()
+        finally:
+            config.DATA_FORMAT = data_format
+            config.DATA_COMPRESS_THRESHOLD = threshold
+        user_url = '/user/pat.ng'
+        test_params = {'username': 'pat.ng', 'password': 'greatpass',
+                       'data': '{"address": "21 Jump St."}'}
+        self.simulate_post('/user', params = test_params)
+        result = self.simulate_post('/auth', params = test_params)
+        headers = {'Cookie': result.headers['set-cookie'].lstrip().split(';', 1)[0],
+                   'Content-Type': 'application/json'}
+        result = self.simulate_get(user_url, headers = headers)
+        self.assertEqual(result.json['data'], {'address': '21 Jump St.'})
+        large = {'works': ['untitled'] * 1000}
+        self.simulate_put(user_url, headers = headers, body = json.dumps(large))
+        with api.user_storage.get_session() as s:
+            stored = api.user_storage.get(s, 'pat.ng')
+            self.assertIsNone(stored.json_data)
+            self.assertLess(len(stored.packed_data), 100) # compressed
+        headers['Content-Type'] = 'application/merge-patch+json'
+        self.simulate_patch(user_url, headers = headers, body = '{"a": 1}')
+        result = self.simulate_get(user_url, headers = headers,
+                                   query_string = 'fields=a')
+        self.assertEqual(result.json['data'], {'a': 1})
+
+    def test_write_behind(self):
+        """test rapid user data replacements are coalesced"""
+        window, config.WRITE_BEHIND_WINDOW = config.WRITE_BEHIND_WINDOW, 60
+        try:
+            api.write_buffer = api.create_write_buffer()
+        finally:
+            config.WRITE_BEHIND_WINDOW = window
+        self.addCleanup(api.write_buffer.close)
+        user_url = '/user/pat.ng'
+        test_params = {'username': 'pat.ng', 'password': 'greatpass'}
+        self.simulate_post('/user', params = test_params)
+        result = self.simulate_post('/auth', params = test_params)
+        headers = {'Cookie': result.headers['set-cookie'].lstrip().split(';', 1)[0],
+                   'Content-Type': 'application/json'}
+        for draft in ['H', 'He', 'Hello']:
+            result = self.simulate_put(user_url, headers = headers,
+                                       body = json.dumps({'note': draft}))
+            self.assertEqual(result.status_code, 200) # OK
+        # user reads their own (pending) write
+        result = self.simulate_get(user_url, headers = headers)
+        self.assertEqual(result.json['data'], {'note': 'Hello'})
+        self.assertIsNone(user.get_user_data(api.user_storage, 'pat.ng')['data'])
+        # a patch applies to the latest data
+        headers['Content-Type'] = 'application/merge-patch+json'
+        self.simulate_patch(user_url, headers = headers, body = '{"a": 1}')
+        self.assertEqual(user.get_user_data(api.user_storage, 'pat.ng')['data'],
+                         {'note': 'Hello', 'a': 1})
+        stats = api.write_buffer.stats()
+        self.assertEqual((stats['writes'], stats['coalesced'], stats['flushes']),
+                         (3, 2, 1))
+        # flushed data keeps its version
+        headers['Content-Type'] = 'application/json'
+        self.simulate_put(user_url, headers = headers, body = '{"b": 2}')
+        result = self.simulate_get(user_url, headers = headers)
+        etag = result.headers['etag']
+        api.write_buffer.close() # e.g.: on shutdown
+        result = self.simulate_get(user_url, headers = headers)
+        self.assertEqual(result.json['data'], {'b': 2})
+        self.assertEqual(result.headers['etag'], etag)
+
+    def test_compression(self):
+        """test large responses are compressed, if the client accepts it"""
+        user_url = '/user/pat.ng'
+        large = {'works': ['untitled'] * 1000}
+        test_params = {'username': 'pat.ng', 'password': 'greatpass',
+                       'data': json.dumps(large)}
+        self.simulate_post('/user', params = test_params)
+        result = self.simulate_post('/auth', params = test_params)
+        headers = {'Cookie': result.headers['set-cookie'].lstrip().split(';', 1)[0]}
+        result = self.simulate_get(user_url, headers = headers)
+        self.assertNotIn('content-encoding', result.headers)
+        self.assertEqual(result.headers['vary'], 'Accept-Encoding')
+        self.assertEqual(result.json['data'], large)
+        etag = result.headers['etag']
+        headers['Accept-Encoding'] = 'gzip, deflate'
+        for repeat in range(2): # (then from the cache)
+            result = self.simulate_get(user_url, headers = headers)
+            self.assertEqual(result.headers['content-encoding'], 'gzip')
+            self.assertLess(len(result.content), 1000)
+            self.assertEqual(json.loads(gzip.decompress(result.content).decode('utf-8')),
+                             {'username': 'pat.ng', 'data': large})
+        self.assertEqual(result.headers['etag'], 'W/' + etag)
+        result = self.simulate_get(user_url, headers = dict(
+            headers, **{'If-None-Match': result.headers['etag']}))
+        self.assertEqual(result.status_code, 304) # not modified
+        # small responses are sent as they are
+        result = self.simulate_get('/', headers = {'Accept-Encoding': 'gzip'})
+        self.assertNotIn('content-encoding', result.headers)
+        self.assertEqual(result.json, ['Hello World'])
+
+    def test_large_integers(self):
+        """test integers beyond 64 bits are kept exactly"""
+        user_url = '/user/pat.ng'
+        test_params = {'username': 'pat.ng', 'password': 'greatpass'}
+        self.simulate_post('/user', params = test_params)
+        result = self.simulate_post('/auth', params = test_params)
+        headers = {'Cookie': result.headers['set-cookie'].lstrip().split(';', 1)[0]}
+        new_data = {'big': 2**70, 'id': 9007199254740993}
+        result = self.simulate_put(user_url, headers = headers,
+                                   body = json.dumps(new_data))
+        self.assertEqual(result.status_code, 200) # OK
+        result = self.simulate_get(user_url, headers = headers)
+        self.assertEqual(result.json['data'], new_data)
+
+    def test_body_limits(self):
+        """test oversized request bodies are refused"""
+        test_params = {'username': 'pat.ng', 'password': 'greatpass'}
+        self.simulate_post('/user', params = test_params)
+        result = self.simulate_post('/auth', params = test_params)
+        session_token = result.headers['set-cookie'].lstrip().split(';', 1)[0]
+        headers = {'Cookie': session_token, 'Content-Type': 'application/json'}
+        max_body_size, config.MAX_BODY_SIZE = config.MAX_BODY_SIZE, 100
+        try:
+            big_data = json.dumps({'history': 'x' * 100})
+            result = self.simulate_put('/user/pat.ng', headers = headers,
+                                       body = big_data)
+            self.assertEqual(result.status_code, 413)
+            form_headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+            result = self.simulate_post('/user', headers = form_headers,
+                                        body = 'username=cruz&password=x&data=' + big_data)
+            self.assertEqual(result.status_code, 413)
+            # within limit
+            result = self.simulate_put('/user/pat.ng', headers = headers,
+                                       body = '{"a": "b,c"}')
+            self.assertEqual(result.status_code, 200) # OK
+        finally:
+            config.MAX_BODY_SIZE = max_body_size
+
+    def test_put_cached(self):
+        """test updates are visible, after data was read into cache"""
+        cache_size, config.USER_CACHE_SIZE = config.USER_CACHE_SIZE, 1024
+        try:
+            api.user_storage = api.create_user_storage()
+        finally:
+            config.USER_CACHE_SIZE = cache_size
+        user_url = '/user/pat.ng'
+        test_params = {'username': 'pat.ng', 'password': 'greatpass',
+                       'data': '{"email": "old@ng.fake"}'}
+        result = self.simulate_post('/user', params = test_params)
+        self.assertEqual(result.status_code, 200) # OK
+        result = self.simulate_post('/auth', params = test_params)
+        session_token, expire_info = result.headers['set-cookie'].lstrip().split(';', 1)
+        headers = {'Cookie': session_token}
+        for email in ['old@ng.fake', 'new@ng.fake']:
+            if email != 'old@ng.fake':
+                result = self.simulate_put(user_url, headers = headers,
+                                           body = '{"email": "new@ng.fake"}')
+                self.assertEqual(result.status_code, 200) # OK
+            for repeat in range(2): # second read is served from cache
+                result = self.simulate_get(user_url, headers = headers)
+                self.assertEqual(result.json['data'], {'email': email})
+        self.assertGreater(api.user_storage.cache.stats()['hits'], 0)
+        # users returned don't share data with the cache
+        for fields in [None, ['email']]:
+            record, version = user.get_user_record(api.user_storage, 'pat.ng', fields)
+            record['data']['email'] = 'changed'
+            record, version = user.get_user_record(api.user_storage, 'pat.ng', fields)
+            self.assertEqual(record['data'], {'email': 'new@ng.fake'})
+
+    def test_get_conditional(self):
+        """test ETag & If-None-Match handling"""
+        user_url = '/user/pat.ng'
+        test_params = {'username': 'pat.ng', 'password': 'greatpass',
+                       'data': '{"email": "pat@ng.fake"}'}
+        result = self.simulate_post('/user', params = test_params)
+        self.assertEqual(result.status_code, 200) # OK
+        result = self.simulate_post('/auth', params = test_params)
+        session_token, expire_info = result.headers['set-cookie'].lstrip().split(';', 1)
+        headers = {'Cookie': session_token}
+        result = self.simulate_get(user_url, headers = headers)
+        etag = result.headers['etag']
+        # unchanged data
+        headers['If-None-Match'] = etag
+        for url in [user_url, '/']:
+            result = self.simulate_get(url, headers = headers)
+            self.assertEqual(result.status_code, 304) # Not Modified
+            self.assertEqual(result.content, b'')
+        # changed data
+        result = self.simulate_put(user_url, headers = headers,
+                                   body = '{"email": "pat@ng.new"}')
+        self.assertEqual(result.status_code, 200) # OK
+        result = self.simulate_get(user_url, headers = headers)
+        self.assertEqual(result.status_code, 200) # OK
+        self.assertNotEqual(result.headers['etag'], etag)
+        self.assertEqual(result.json['data'], {'email': 'pat@ng.new'})
+
+    def test_get_fields(self):
+        """test user data field projection"""
+        user_url = '/user/pat.ng'
+        test_params = {'username': 'pat.ng', 'password': 'greatpass'}
+        self.simulate_post('/user', params = test_params)
+        result = self.simulate_post('/auth', params = test_params)
+        session_token = result.headers['set-cookie'].lstrip().split(';', 1)[0]
+        headers = {'Cookie': session_token, 'Content-Type': 'application/json'}
+        data = {'email': 'pat@ng.fake', 'address': {'city': 'Seattle', 'zip': '98101'},
+                'active': True, 'history': ['x'] * 100, 'ué': {'ô': 1}}
+        self.simulate_put(user_url, headers = headers, body = json.dumps(data))
+        result = self.simulate_get(user_url, headers = headers,
+                                   query_string = 'fields=u%C3%A9.%C3%B4')
+        self.assertEqual(result.json['data'], {'ué': {'ô': 1}})
+        # integers beyond 64 bits are exact, as in the full data
+        self.simulate_put(user_url, headers = headers,
+                          body = json.dumps(dict(data, n=2**70 + 1)))
+        result = self.simulate_get(user_url, headers = headers,
+                                   query_string = 'fields=n')
+        self.assertEqual(result.json['data'], {'n': 2**70 + 1})
+        self.simulate_put(user_url, headers = headers, body = json.dumps(data))
+        expected = {'username': 'pat.ng',
+                    'data': {'email': 'pat@ng.fake', 'address': {'city': 'Seattle'},
+                             'active': True}}
+        for source in ['database', 'cache']:
+            result = self.simulate_get(user_url, headers = headers,
+                                       query_string = 'fields=email,address.city,active,none')
+            self.assertEqual(result.json, expected, source)
+            result = self.simulate_get(user_url, headers = headers) # all fields
+            self.assertEqual(result.json['data'], data)
+        result = self.simulate_get('/', headers = headers, query_string = 'fields=email')
+        self.assertEqual(result.json['data'], {'email': 'pat@ng.fake'})
+
     def test_delete(self):
         user_url = '/user/d-admin'
         # no login session
@@ -159,14 +472,234 @@ class TestUser(TestApi):
         result = self.simulate_post(signup_url, params = test_params)
         self.assertEqual(result.status_code, 200) # OK
 
+class TestUsers(TestApi):
+    """Test the /users administrative API url paths"""
+    def setUp(self):
+        super(TestUsers, self).setUp()
+        self.admin_users = config.ADMIN_USERS
+        config.ADMIN_USERS = frozenset(['d-admin'])
+        # sign up & log in as administrator
+        test_params = {'username': 'd-admin', 'password': 'too)short'}
+        self.simulate_post('/user', params = test_params)
+        result = self.simulate_post('/auth', params = test_params)
+        session_token, expire_info = result.headers['set-cookie'].lstrip().split(';', 1)
+        self.admin_headers = {'Cookie': session_token}
+
+    def tearDown(self):
+        config.ADMIN_USERS = self.admin_users
+        super(TestUsers, self).tearDown()
+
+    def test_import_export(self):
+        import_url, export_url = '/users/import', '/users/export'
+        existing_hash = user.hash_password('secret1')
+        import_body = '\n'.join([
+            '{"username": "pat.ng", "password": "greatpass", "data": {"a": 1}}',
+            '{"username": "salvador.dali", "pw_hash": "' + existing_hash + '"}',
+            'not JSON',
+            '{"username": "cruz", "pw_hash": "FACECAFE"}',
+            '{"username": "d-admin", "password": "again"}',
+            '{"username": 5, "password": "greatpass"}',
+            '{"username": "paul", "password": ["greatpass"]}',
+            '{"username": "paul", "pw_hash": 5}',
+            ''])
+        # no login session
+        result = self.simulate_post(import_url, body = import_body)
+        self.assertEqual(result.json, {'title': 'Login required'})
+        result = self.simulate_post(import_url, body = import_body,
+                                    headers = self.admin_headers)
+        expected = {'imported': 2,
+                    'errors': [{'line': 3, 'error': 'Invalid JSON'},
+                               {'line': 4, 'error': 'Missing password, or invalid pw_hash'},
+                               {'line': 6, 'error': 'Missing username'},
+                               {'line': 7, 'error': 'Invalid password'},
+                               {'line': 8, 'error': 'Missing password, or invalid pw_hash'},
+                               {'line': 5, 'error': 'User already exists'}]}
+        self.assertEqual(result.json, expected)
+        # imported users can log in
+        for username, password in [('pat.ng', 'greatpass'),
+                                   ('salvador.dali', 'secret1')]:
+            test_params = {'username': username, 'password': password}
+            result = self.simulate_post('/auth', params = test_params)
+            self.assertEqual(result.status_code, 200) # OK
+
+        result = self.simulate_get(export_url, headers = self.admin_headers)
+        self.assertEqual(result.status_code, 200) # OK
+        exported = [json.loads(line) for line in result.text.splitlines()]
+        self.assertEqual([u['username'] for u in exported],
+                         ['d-admin', 'pat.ng', 'salvador.dali'])
+        self.assertEqual(exported[1]['data'], {'a': 1})
+        self.assertEqual(exported[2]['pw_hash'], existing_hash)
+
+    def test_import_line_limit(self):
+        import_body = '\n'.join([
+            '{"username": "pat.ng", "password": "greatpass", "data": "' + 'x' * 200 + '"}',
+            '{"username": "cruz", "password": "greatpass"}'])
+        max_line_size, config.MAX_IMPORT_LINE_SIZE = config.MAX_IMPORT_LINE_SIZE, 100
+        try:
+            result = self.simulate_post('/users/import', body = import_body,
+                                        headers = self.admin_headers)
+        finally:
+            config.MAX_IMPORT_LINE_SIZE = max_line_size
+        self.assertEqual(result.json, {'imported': 1, 'errors': [
+            {'line': 1, 'error': 'Line too long'}]})
+
+    def test_lookup(self):
+        """test batch user data retrieval"""
+        lookup_url = '/users/lookup'
+        existing_hash = user.hash_password('secret1')
+        import_body = '\n'.join(
+            json.dumps({'username': name, 'pw_hash': existing_hash,
+                        'data': {'name': name, 'age': 30}})
+            for name in ['pat.ng', 'pat.o', 'paul', 'cruz'])
+        self.simulate_post('/users/import', body = import_body,
+                           headers = self.admin_headers)
+        result = self.simulate_get(lookup_url, headers = self.admin_headers,
+            query_string = 'username=paul&username=nobody&username=cruz&fields=age')
+        self.assertEqual(result.headers['content-type'], 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in result.text.splitlines()],
+                         [{'username': 'paul', 'data': {'age': 30}},
+                          {'username': 'cruz', 'data': {'age': 30}}])
+        result = self.simulate_post(lookup_url, headers = dict(
+            self.admin_headers, **{'Content-Type': 'application/json'}),
+            body = json.dumps({'usernames': ['pat.o', 'pat.ng']}))
+        self.assertEqual([json.loads(line)['username'] for line in result.text.splitlines()],
+                         ['pat.o', 'pat.ng'])
+        result = self.simulate_post(lookup_url, headers = dict(
+            self.admin_headers, **{'Content-Type': 'application/json'}),
+            body = json.dumps({'usernames': ['paul'], 'fields': [['age']]}))
+        self.assertEqual(result.status_code, 400)
+        # pages of users, by name prefix
+        result = self.simulate_get(lookup_url, headers = self.admin_headers,
+                                   query_string = 'prefix=pa&limit=2')
+        page = [json.loads(line)['username'] for line in result.text.splitlines()]
+        self.assertEqual(page, ['pat.ng', 'pat.o'])
+        result = self.simulate_get(lookup_url, headers = self.admin_headers,
+            query_string = 'prefix=pa&limit=2&after=' + page[-1])
+        self.assertEqual([json.loads(line)['username'] for line in result.text.splitlines()],
+                         ['paul'])
+        result = self.simulate_get(lookup_url, headers = self.admin_headers,
+                                   query_string = 'prefix=%ED%9F%BF') # U+D7FF
+        self.assertEqual((result.status_code, result.text), (200, ''))
+        # too many users
+        max_users, config.LOOKUP_MAX_USERS = config.LOOKUP_MAX_USERS, 1
+        try:
+            result = self.simulate_get(lookup_url, headers = self.admin_headers,
+                                       query_string = 'username=paul&username=cruz')
+        finally:
+            config.LOOKUP_MAX_USERS = max_users
+        self.assertEqual(result.status_code, 400)
+
+    def test_query(self):
+        """test finding users by an indexed data field"""
+        indexed, config.INDEXED_FIELDS = config.INDEXED_FIELDS, frozenset(
+            ['email', 'address.city'])
+        try:
+            api.user_storage = api.create_user_storage()
+        finally:
+            config.INDEXED_FIELDS = indexed
+        self.simulate_post('/user', params = {'username': 'd-admin',
+                                              'password': 'too)short'})
+        existing_hash = user.hash_password('secret1')
+        import_body = '\n'.join(
+            json.dumps({'username': name, 'pw_hash': existing_hash,
+                        'data': {'email': email, 'address': {'city': 'Paris'}}})
+            for name, email in [('pat.ng', 'pat@example.org'),
+                                ('paul', 'paul@example.org'),
+                                ('cruz', 'cruz@example.com')])
+        self.simulate_post('/users/import', body = import_body,
+                           headers = self.admin_headers)
+        result = self.simulate_get('/users/query', headers = self.admin_headers,
+            query_string = 'field=email&value=paul@example.org&fields=email')
+        self.assertEqual(result.headers['content-type'], 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in result.text.splitlines()],
+                         [{'username': 'paul', 'data': {'email': 'paul@example.org'}}])
+        # pages of users, by field value prefix
+        pages, path = [], '/users/query?field=email&prefix=pa&limit=1'
+        while path:
+            url, query_string = path.split('?', 1)
+            result = self.simulate_get(url, headers = self.admin_headers,
+                                       query_string = query_string)
+            pages.append([json.loads(line)['username']
+                          for line in result.text.splitlines()])
+            path = result.headers.get('link', '').split('>', 1)[0].lstrip('<')
+        self.assertEqual(pages, [['pat.ng'], ['paul']])
+        # index follows updates
+        self.simulate_put('/user/d-admin', body = '{"email": "admin@example.org"}',
+                          headers = dict(self.admin_headers,
+                                         **{'Content-Type': 'application/json'}))
+        result = self.simulate_get('/users/query', headers = self.admin_headers,
+                                   query_string = 'field=address.city&value=Paris')
+        self.assertEqual(len(result.text.splitlines()), 3)
+        result = self.simulate_get('/users/query', headers = self.admin_headers,
+                                   query_string = 'field=email&prefix=admin')
+        self.assertEqual([json.loads(line)['username'] for line in result.text.splitlines()],
+                         ['d-admin'])
+        result = self.simulate_get('/users/query', headers = self.admin_headers,
+                                   query_string = 'field=phone&value=555')
+        self.assertEqual(result.status_code, 400) # not indexed
+
+    def test_list(self):
+        """test paging through all users"""
+        existing_hash = user.hash_password('secret1')
+        import_body = '\n'.join(
+            json.dumps({'username': name, 'pw_hash': existing_hash,
+                        'data': {'name': name, 'age': 30}})
+            for name in ['pat.ng', 'pat.o', 'paul', 'cruz'])
+        self.simulate_post('/users/import', body = import_body,
+                           headers = self.admin_headers)
+        pages, path = [], '/users?limit=2&fields=age'
+        while path:
+            url, query_string = path.split('?', 1)
+            result = self.simulate_get(url, query_string = query_string,
+                                       headers = self.admin_headers)
+            self.assertEqual(result.status_code, 200)
+            pages.append([json.loads(line) for line in result.text.splitlines()])
+            path = None
+            if 'link' in result.headers:
+                path = result.headers['link'].split('>', 1)[0].lstrip('<')
+        self.assertEqual([[u['username'] for u in page] for page in pages],
+                         [['cruz', 'd-admin'], ['pat.ng', 'pat.o'], ['paul']])
+        self.assertEqual(pages[0][0], {'username': 'cruz', 'data': {'age': 30}})
+        result = self.simulate_get('/users', query_string = 'cursor=bad',
+                                   headers = self.admin_headers)
+        self.assertEqual(result.status_code, 400)
+
+    def test_lookup_permission(self):
+        test_params = {'username': 'pat.ng', 'password': 'greatpass'}
+        self.simulate_post('/user', params = test_params)
+        result = self.simulate_post('/auth', params = test_params)
+        session_token, expire_info = result.headers['set-cookie'].lstrip().split(';', 1)
+        headers = {'Cookie': session_token}
+        result = self.simulate_get('/users/lookup', query_string = 'username=d-admin')
+        self.assertEqual(result.json, {'title': 'Login required'})
+        result = self.simulate_get('/users/lookup', headers = headers,
+                                   query_string = 'username=d-admin')
+        self.assertEqual(result.json, {'title': 'Permission denied'})
+        lookup_users, config.LOOKUP_USERS = config.LOOKUP_USERS, frozenset(['*'])
+        try:
+            result = self.simulate_get('/users/lookup', headers = headers,
+                                       query_string = 'username=d-admin')
+        finally:
+            config.LOOKUP_USERS = lookup_users
+        self.assertEqual(json.loads(result.text), {'username': 'd-admin', 'data': None})
+
+    def test_permission(self):
+        test_params = {'username': 'pat.ng', 'password': 'greatpass'}
+        self.simulate_post('/user', params = test_params)
+        result = self.simulate_post('/auth', params = test_params)
+        session_token, expire_info = result.headers['set-cookie'].lstrip().split(';', 1)
+        result = self.simulate_get('/users/export', headers={'Cookie': session_token})
+        self.assertEqual(result.json, {'title': 'Permission denied'})
+
 class TestAuth(TestApi):
     def test_post(self):
         """test authentication"""
         auth_url = '/auth'
         test_params = {'username': 'cruzbustamante', 'password': 'secret'}
         # no user exists yet
-        with self.assertRaises(user.UserNotFoundException):
-            result = self.simulate_post(auth_url, params = test_params)
+        result = self.simulate_post(auth_url, params = test_params)
+        self.assertEqual(result.status_code, 401)
+        self.assertEqual(result.json, {'title': 'Login incorrect'})
         # now sign up a user
         user_url = '/user'
         result = self.simulate_post(user_url, params = test_params)
@@ -178,6 +711,29 @@ class TestAuth(TestApi):
         expected_token_prefix = ' api.session.id='
         self.assertEqual(result_token_key_value_pair[:16], expected_token_prefix)
 
+    def test_rate_limit(self):
+        """test repeated login attempts are refused"""
+        api.login_limiter = ratelimit.LoginLimiter(
+            user_rate=1, user_burst=2, address_rate=0, address_burst=0)
+        test_params = {'username': 'cruzbustamante', 'password': 'guess'}
+        for attempt in range(2):
+            result = self.simulate_post('/auth', params = test_params)
+            self.assertEqual(result.status_code, 401)
+        result = self.simulate_post('/auth', params = test_params)
+        self.assertEqual(result.status_code, 429) # Too Many Requests
+        self.assertGreater(int(result.headers['retry-after']), 0)
+        # other users are unaffected
+        test_params['username'] = 'pat.ng'
+        result = self.simulate_post('/auth', params = test_params)
+        self.assertEqual(result.status_code, 401)
+        # repeated usernames are refused (before they're rate limited)
+        form = {'Content-Type': 'application/x-www-form-urlencoded'}
+        result = self.simulate_post('/auth', headers = form,
+            body = 'username=pat.ng&username=cruz&password=guess')
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(result.json['description'],
+                         'The "username" parameter is invalid. Must be provided once')
+
     def test_delete(self):
         """test logout"""
         auth_url = '/auth'
@@ -205,3 +761,452 @@ class TestAuth(TestApi):
         expected = ['Hello World'] # no user session data
         result = self.simulate_get(base_url, headers={'Cookie': session_token})
         self.assertEqual(result.json, expected)
+
+    def test_post_rehash(self):
+        """test login upgrades hashes made with outdated cost settings"""
+        auth_url = '/auth'
+        test_params = {'username': 'pat.ng', 'password': 'greatpass'}
+        old_policy = hashing.HashPolicy(memory_cost=256, time_cost=1, parallelism=1)
+        old_hash = user.hash_password('greatpass', old_policy)
+        with api.user_storage.get_session() as s:
+            api.user_storage.add(s, 'pat.ng', old_hash)
+        api.hash_policy = hashing.HashPolicy(memory_cost=512, time_cost=2, parallelism=1)
+        try:
+            result = self.simulate_post(auth_url, params = test_params)
+            self.assertEqual(result.status_code, 200) # OK
+            new_hash = user.get_user_hash(api.user_storage, 'pat.ng')
+            self.assertEqual(new_hash[:28], '$argon2i$v=19$m=512,t=2,p=1$')
+            # login continues to work, with the replacement hash
+            result = self.simulate_post(auth_url, params = test_params)
+            self.assertEqual(result.status_code, 200) # OK
+            self.assertEqual(user.get_user_hash(api.user_storage, 'pat.ng'), new_hash)
+        finally:
+            api.hash_policy = hashing.default_policy
+
+    def test_post_rehash_deleted(self):
+        """test login of a user deleted before their hash is replaced"""
+        old_policy = hashing.HashPolicy(memory_cost=256, time_cost=1, parallelism=1)
+        user.add_user(api.user_storage, 'pat.ng',
+                      user.hash_password('greatpass', old_policy))
+        with patch.object(user, 'get_user_hash',
+                          side_effect=get_hash_then_delete(user.get_user_hash)):
+            result = self.simulate_post('/auth', params = {
+                'username': 'pat.ng', 'password': 'greatpass'})
+        self.assertEqual(result.status_code, 401)
+        self.assertEqual(result.json, {'title': 'Login incorrect'})
+
+class TestHashingPool(TestApi):
+    """Test API behavior when the password hashing pool is saturated"""
+    def setUp(self):
+        super(TestHashingPool, self).setUp()
+        api.hash_pool = hashing.HashingPool(max_workers=1, max_queue=0)
+
+    def tearDown(self):
+        api.hash_pool.shutdown()
+        super(TestHashingPool, self).tearDown()
+
+    def test_post_saturated(self):
+        """test signup & login are refused while pool is busy"""
+        test_params = {'username': 'pat.ng', 'password': 'greatpass'}
+        with api.user_storage.get_session() as s: # existing login
+            api.user_storage.add(s, 'cruz.bustamante', 'fake_hash')
+        unblock = threading.Event()
+        busy_job = api.hash_pool.submit(unblock.wait)
+        try:
+            for url, username in [('/user', 'pat.ng'),
+                                  ('/auth', 'cruz.bustamante')]:
+                params = dict(test_params, username=username)
+                result = self.simulate_post(url, params = params)
+                self.assertEqual(result.status_code, 503)
+                self.assertEqual(result.headers['retry-after'], '1')
+            # cheap endpoints are unaffected
+            result = self.simulate_get('/')
+            self.assertEqual(result.json, ['Hello World'])
+        finally:
+            unblock.set()
+            busy_job.result()
+        # pool has capacity again
+        result = self.simulate_post('/user', params = test_params)
+        self.assertEqual(result.status_code, 200) # OK
+        self.assertEqual(api.hash_pool.stats()['rejected'], 2)
+
+class TestMetrics(TestApi):
+    """Test the request timing metrics endpoint"""
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        metrics.registry.clear()
+        # (not exposed by default)
+        api.falcon_api.add_route('/metrics', metrics.MetricsResource())
+
+    def test_get(self):
+        test_params = {'username': 'pat.ng', 'password': 'greatpass'}
+        self.simulate_post('/user', params = test_params)
+        result = self.simulate_post('/auth', params = test_params)
+        session_token = result.headers['set-cookie'].lstrip().split(';', 1)[0]
+        self.simulate_get('/user/pat.ng', headers={'Cookie': session_token})
+        result = self.simulate_get('/metrics')
+        self.assertEqual(result.status_code, 200) # OK
+        self.assertTrue(result.headers['content-type'].startswith('text/plain'))
+        lines = result.text.splitlines()
+        self.assertIn('restdemo_request_duration_seconds_count'
+                      '{method="GET",route="/user/{username}",status="200"} 1', lines)
+        for phase in ['datastore_query', 'datastore_commit', 'hash_pool',
+                      'password_hash', 'password_verify', 'session_load',
+                      'session_save', 'json_encode']:
+            self.assertIn('restdemo_phase_duration_seconds_count{{phase="{}"}}'
+                          .format(phase), result.text)
+        self.assertIn('restdemo_hash_pool_completed', result.text)
+
+    def test_sampling(self):
+        metrics.registry.sample_rate = 0
+        try:
+            self.simulate_get('/')
+            result = self.simulate_get('/metrics')
+            self.assertNotIn('restdemo_request_duration_seconds', result.text)
+            self.assertNotIn('restdemo_phase_duration_seconds', result.text)
+        finally:
+            metrics.registry.sample_rate = 1.0
+
+class TestAsgi(TestApi):
+    """Test the API, served by the asyncio (ASGI) application"""
+    def setUp(self):
+        super(TestAsgi, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        super(TestAsgi, self).tearDown()
+
+    def request(self, method, path, body=b'', headers=None):
+        """
+        Returns tuple: HTTP status code, dict of headers & body
+
+        The request body may be a list of parts, sent as separate messages.
+        Response body messages are kept in self.body_messages.
+        """
+        scope = {'type': 'http', 'method': method, 'path': path,
+                 'query_string': b'', 'headers': [
+                     (name.lower().encode('latin-1'), value.encode('latin-1'))
+                     for name, value in (headers or {}).items()]}
+        parts = body if isinstance(body, list) else [body]
+        messages = [{'type': 'http.request', 'body': part, 'more_body': True}
+                    for part in parts]
+        messages[-1]['more_body'] = False
+        sent = []
+        async def receive():
+            return messages.pop(0)
+        async def send(message):
+            sent.append(message)
+        self.loop.run_until_complete(asgi.app(scope, receive, send))
+        start, self.body_messages = sent[0], sent[1:]
+        self.assertFalse(self.body_messages[-1].get('more_body'))
+        return (start['status'],
+                dict((name.decode('latin-1'), value.decode('latin-1'))
+                     for name, value in start['headers']),
+                b''.join(message['body'] for message in self.body_messages))
+
+    def test_user(self):
+        form = {'Content-Type': 'application/x-www-form-urlencoded'}
+        body = b'username=pat.ng&password=secret&data={"a":1,"b":2}'
+        status, headers, result = self.request('POST', '/user', body, form)
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(result.decode('utf-8')),
+                         {'message': 'Successfully signed up new user: pat.ng'})
+        status, headers, result = self.request('POST', '/user', body, form)
+        self.assertEqual(status, 409) # Conflict
+        status, headers, result = self.request('POST', '/auth',
+            b'username=pat.ng&password=secret&password=guess', form)
+        self.assertEqual(status, 400)
+        status, headers, result = self.request('POST', '/auth',
+            b'username=pat.ng&password=\xff', form)
+        self.assertEqual((status, json.loads(result.decode('utf-8'))['title']),
+                         (400, 'Invalid form'))
+        status, headers, result = self.request('POST', '/auth', body, form)
+        self.assertEqual(status, 200)
+        cookie = {'Cookie': headers['set-cookie'].lstrip().split(';', 1)[0]}
+        status, headers, result = self.request('GET', '/user/pat.ng', headers=cookie)
+        self.assertEqual(json.loads(result.decode('utf-8')),
+                         {'username': 'pat.ng', 'data': {'a': 1, 'b': 2}})
+        # unchanged data
+        conditional = dict(cookie, **{'If-None-Match': headers['etag']})
+        status, headers, result = self.request('GET', '/user/pat.ng',
+                                               headers=conditional)
+        self.assertEqual((status, result), (304, b''))
+        # update
+        put_headers = dict(cookie, **{'Content-Type': 'application/json'})
+        status, headers, result = self.request('PUT', '/user/pat.ng', b'["new"]',
+                                               put_headers)
+        self.assertEqual(status, 200)
+        # (JSON is the default media type)
+        status, headers, result = self.request('PUT', '/user/pat.ng', b'["new"]',
+                                               cookie)
+        self.assertEqual(status, 200)
+        # sessions are shared with the WSGI application
+        result = self.simulate_get('/', headers=cookie)
+        self.assertEqual(result.json, {'username': 'pat.ng', 'data': ['new']})
+        # large responses are compressed
+        status, headers, result = self.request('PUT', '/user/pat.ng',
+            json.dumps(['new'] * 1000).encode('utf-8'), put_headers)
+        status, headers, result = self.request('GET', '/user/pat.ng',
+            headers=dict(cookie, **{'Accept-Encoding': 'gzip'}))
+        self.assertEqual((headers['content-encoding'], headers['etag'][:2]),
+                         ('gzip', 'W/'))
+        self.assertEqual(json.loads(gzip.decompress(result).decode('utf-8'))['data'],
+                         ['new'] * 1000)
+        # other users' data is off-limits
+        status, headers, result = self.request('DELETE', '/user/cruz', headers=cookie)
+        self.assertEqual(status, 401)
+        self.assertEqual(json.loads(result.decode('utf-8'))['title'],
+                         'Permission denied')
+        status, headers, result = self.request('DELETE', '/user/pat.ng', headers=cookie)
+        self.assertEqual(status, 200)
+        self.assertIn('max-age=0', headers['set-cookie'].lower())
+        with self.assertRaises(user.UserNotFoundException):
+            user.get_user_data(api.user_storage, 'pat.ng')
+
+    def test_post_rehash_deleted(self):
+        """test login of a user deleted before their hash is replaced"""
+        old_policy = hashing.HashPolicy(memory_cost=256, time_cost=1, parallelism=1)
+        user.add_user(api.user_storage, 'pat.ng',
+                      user.hash_password('greatpass', old_policy))
+        form = {'Content-Type': 'application/x-www-form-urlencoded'}
+        with patch.object(user, 'get_user_hash',
+                          side_effect=get_hash_then_delete(user.get_user_hash)):
+            status, headers, result = self.request(
+                'POST', '/auth', b'username=pat.ng&password=greatpass', form)
+        self.assertEqual((status, json.loads(result.decode('utf-8'))),
+                         (401, {'title': 'Login incorrect'}))
+
+    def test_wsgi_routes(self):
+        """test routes without coroutines are served by the WSGI app"""
+        status, headers, result = self.request('GET', '/users/export')
+        self.assertEqual(status, 401)
+        self.assertEqual(json.loads(result.decode('utf-8'))['title'],
+                         'Login required')
+        api.falcon_api.add_route('/metrics', metrics.MetricsResource())
+        status, headers, result = self.request('GET', '/metrics')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-length'], str(len(result)))
+
+    def test_import_export(self):
+        """test bulk import & export bodies are streamed, not buffered"""
+        admin_users, config.ADMIN_USERS = config.ADMIN_USERS, frozenset(['d-admin'])
+        self.addCleanup(setattr, config, 'ADMIN_USERS', admin_users)
+        form = {'Content-Type': 'application/x-www-form-urlencoded'}
+        body = b'username=d-admin&password=secret'
+        self.request('POST', '/user', body, form)
+        status, headers, result = self.request('POST', '/auth', body, form)
+        cookie = {'Cookie': headers['set-cookie'].lstrip().split(';', 1)[0]}
+        existing_hash = user.hash_password('secret1')
+        import_lines = [json.dumps({'username': 'user{}'.format(number),
+                                    'pw_hash': existing_hash}).encode('utf-8') + b'\n'
+                        for number in range(5)]
+        # (imports aren't limited to the default request body size)
+        max_body_size, config.MAX_BODY_SIZE = config.MAX_BODY_SIZE, 100
+        try:
+            status, headers, result = self.request(
+                'POST', '/users/import', import_lines, dict(cookie, **{
+                    'Content-Length': str(len(b''.join(import_lines)))}))
+        finally:
+            config.MAX_BODY_SIZE = max_body_size
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(result.decode('utf-8')),
+                         {'imported': 5, 'errors': []})
+        status, headers, result = self.request('GET', '/users/export',
+                                               headers=cookie)
+        self.assertEqual(status, 200)
+        self.assertEqual(len(result.splitlines()), 6)
+        self.assertGreater(len(self.body_messages), 2) # sent in parts
+
+class TestSession(TestApi):
+    """Test login & logout with each type of session store"""
+    def setUp(self):
+        super(TestSession, self).setUp()
+        self.db_dir = TemporaryDirectory() # (not the working directory)
+        self.addCleanup(self.db_dir.cleanup)
+        beaker_url, session.BEAKER_URL = session.BEAKER_URL, 'sqlite:///' + (
+            os.path.join(self.db_dir.name, 'beaker.sqlite3'))
+        self.addCleanup(setattr, session, 'BEAKER_URL', beaker_url)
+
+    def test_stores(self):
+        max_age = 3600
+        db_dir = self.db_dir
+        stores = {'signed': session.SignedCookieStore(b'secret', max_age),
+                  'memory': session.MemoryStore(100, max_age),
+                  'sqlite': session.SQLiteStore(
+                      os.path.join(db_dir.name, 'sessions.sqlite3'), max_age)}
+        for store_type in ['signed', 'memory', 'sqlite', 'beaker']:
+            with self.subTest(store_type=store_type):
+                if store_type == 'beaker':
+                    self.app = session.wrap_app_with_beaker_middleware(
+                        api.falcon_api, max_age)
+                else:
+                    self.app = session.SessionMiddleware(
+                        api.falcon_api, stores[store_type], max_age)
+                self.check_login_logout(store_type)
+
+    def test_malformed_tokens(self):
+        """test tokens the store didn't make are treated as logged out"""
+        max_age = 3600
+        self.simulate_post('/user', params = {'username': 'pat.ng',
+                                              'password': 'secret'})
+        for store in [session.SignedCookieStore(b'secret', max_age),
+                      session.MemoryStore(100, max_age), api.api.store]:
+            self.app = session.SessionMiddleware(api.falcon_api, store, max_age)
+            for token in ['"a\\351.abc"', '"abc.\\351"', 'abc']:
+                with self.subTest(store=type(store).__name__, token=token):
+                    result = self.simulate_get('/user/pat.ng', headers={
+                        'Cookie': 'api.session.id=' + token})
+                    self.assertEqual(result.status_code, 401)
+                    self.assertEqual(result.json['title'], 'Login required')
+
+    def test_lazy(self):
+        """test session store is only used when needed"""
+        max_age = 3600
+        store = Mock(wraps=session.MemoryStore(100, max_age))
+        self.app = session.SessionMiddleware(api.falcon_api, store, max_age)
+        test_params = {'username': 'pat.ng', 'password': 'secret'}
+        result = self.simulate_post('/user', params = test_params)
+        result = self.simulate_get('/') # anonymous
+        self.assertEqual(store.method_calls, []) # no session I/O
+        result = self.simulate_post('/auth', params = test_params)
+        session_token, expire_info = result.headers['set-cookie'].lstrip().split(';', 1)
+        self.assertEqual(store.save.call_count, 1)
+        for repeat in range(2):
+            result = self.simulate_get('/', headers={'Cookie': session_token})
+            self.assertEqual(result.json['username'], 'pat.ng')
+            self.assertNotIn('set-cookie', result.headers)
+        self.assertEqual(store.load.call_count, 2)
+        self.assertEqual(store.save.call_count, 1) # unchanged: not saved
+
+    def test_reap_beaker(self):
+        """test removal of expired Beaker sessions"""
+        max_age = 3600
+        self.app = session.wrap_app_with_beaker_middleware(api.falcon_api, max_age)
+        self.check_login_logout('beaker') # creates a session
+        test_params = {'username': 'beaker', 'password': 'secret'}
+        result = self.simulate_post('/auth', params = test_params)
+        session_token, expire_info = result.headers['set-cookie'].lstrip().split(';', 1)
+        session_table = session.BeakerSessionTable(session.BEAKER_URL, max_age)
+        reaper = session.SessionReaper(session_table, interval=60,
+                                       batch_size=100, pause=0)
+        reaper.run_once() # session is fresh
+        result = self.simulate_get('/', headers={'Cookie': session_token})
+        self.assertEqual(result.json['username'], 'beaker')
+        session_table.max_age = -60 # now any session is expired
+        self.assertEqual(reaper.run_once()['removed'], 2)
+        result = self.simulate_get('/', headers={'Cookie': session_token})
+        self.assertEqual(result.json, ['Hello World'])
+
+    def check_login_logout(self, username):
+        test_params = {'username': username, 'password': 'secret'}
+        result = self.simulate_post('/user', params = test_params)
+        self.assertEqual(result.status_code, 200) # OK
+        result = self.simulate_get('/') # anonymous
+        self.assertNotIn('set-cookie', result.headers)
+        result = self.simulate_post('/auth', params = test_params)
+        session_token, expire_info = result.headers['set-cookie'].lstrip().split(';', 1)
+        self.assertEqual(session_token[:15], 'api.session.id=')
+        expected = {'data': None, 'username': username}
+        result = self.simulate_get('/', headers={'Cookie': session_token})
+        self.assertEqual(result.json, expected)
+        result = self.simulate_delete('/auth', headers={'Cookie': session_token})
+        self.assertEqual(result.status_code, 200) # OK
+        result = self.simulate_get('/', headers={'Cookie': session_token})
+        self.assertEqual(result.json, ['Hello World'])
+
+class TestStartup(TestCase):
+    import_budget_ms = 1000 # generous, for slow test machines
+
+    def test_import(self):
+        """test importing the API is quick & creates no heavy resources"""
+        script = ('import sys, api; print(sorted(name for name in sys.modules'
+                  ' if name.split(".")[0] in ("sqlalchemy", "beaker", "sqlstore")'
+                  ' or name == "passlib.hash"))')
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         stderr=subprocess.DEVNULL)
+        self.assertEqual(output.decode('utf-8').strip(), '[]')
+        startup = bench.measure_startup(runs=1)
+        self.assertLess(startup['import_ms'], self.import_budget_ms)
+
+    def test_sqlite_pool_options(self):
+        """test pool sizing (for server databases) doesn't break SQLite3"""
+        pool_size, config.DATABASE_POOL_SIZE = config.DATABASE_POOL_SIZE, 5
+        max_overflow, config.DATABASE_MAX_OVERFLOW = config.DATABASE_MAX_OVERFLOW, 2
+        try:
+            storage = api.create_user_storage()
+        finally:
+            config.DATABASE_POOL_SIZE = pool_size
+            config.DATABASE_MAX_OVERFLOW = max_overflow
+        user.add_user(storage, 'pat.ng', 'FACECAFE')
+        self.assertEqual(user.get_user_hash(storage, 'pat.ng'), 'FACECAFE')
+
+class TestSharedState(TestCase):
+    """Test state is shared by several worker processes"""
+    WORKER_SCRIPT = (
+        'import sys, wsgiref.simple_server as w, api\n'
+        'class Quiet(w.WSGIRequestHandler):\n'
+        '    def log_message(self, *args): pass\n'
+        'server = w.make_server("127.0.0.1", 0, api.api, handler_class=Quiet)\n'
+        'print(server.server_port, flush=True)\n'
+        'server.serve_forever()\n')
+
+    def setUp(self):
+        state_dir = TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+        env = dict(os.environ, RESTDEMO_SHARED_STATE_DIR=state_dir.name)
+        self.urls = []
+        for worker in range(2):
+            process = subprocess.Popen(
+                [sys.executable, '-c', self.WORKER_SCRIPT], env=env,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            self.addCleanup(process.wait)
+            self.addCleanup(process.stdout.close)
+            self.addCleanup(process.terminate)
+            port = int(process.stdout.readline())
+            self.urls.append('http://127.0.0.1:{}'.format(port))
+
+    def request(self, worker, method, path, params=None, cookie=None,
+                json_body=None):
+        """Returns tuple: HTTP status, response headers & decoded JSON body"""
+        data = urlencode(params).encode('utf-8') if params else None
+        if json_body is not None:
+            data = json.dumps(json_body).encode('utf-8')
+        request = Request(self.urls[worker] + path, data=data, method=method)
+        if json_body is not None:
+            request.add_header('Content-Type', 'application/json')
+        if cookie:
+            request.add_header('Cookie', cookie)
+        try:
+            with urlopen(request, timeout=30) as response:
+                body = response.read().decode('utf-8')
+                return (response.status, response.headers,
+                        json.loads(body) if body else None)
+        except HTTPError as error:
+            error.close()
+            return error.code, error.headers, None
+
+    def test_workers(self):
+        test_params = {'username': 'pat.ng', 'password': 'secret'}
+        status, headers, body = self.request(0, 'POST', '/user', test_params)
+        self.assertEqual(status, 200) # OK
+        # user created by worker 0 can log in with worker 1
+        status, headers, body = self.request(1, 'POST', '/auth', test_params)
+        self.assertEqual(status, 200) # OK
+        cookie = headers['Set-Cookie'].split(';', 1)[0]
+        # session created by worker 1 is known to worker 0
+        status, headers, body = self.request(0, 'GET', '/', cookie=cookie)
+        self.assertEqual(body, {'data': None, 'username': 'pat.ng'})
+        status, headers, body = self.request(
+            0, 'PUT', '/user/pat.ng', cookie=cookie, json_body={'a': 1})
+        self.assertEqual(status, 200) # OK
+        status, headers, body = self.request(1, 'GET', '/', cookie=cookie)
+        self.assertEqual(body, {'data': {'a': 1}, 'username': 'pat.ng'})
+        # logout by worker 0 is seen by worker 1
+        status, headers, body = self.request(0, 'DELETE', '/auth', cookie=cookie)
+        self.assertEqual(status, 200) # OK
+        status, headers, body = self.request(1, 'GET', '/', cookie=cookie)
+        self.assertEqual(body, ['Hello World'])
@@ -1,35 +1,45 @@
 """
 Module defining an API user datastore and access interface
 """
-from tempfile import NamedTemporaryFile
-from contextlib import contextmanager
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import copy
 import json
+import threading
+import uuid
+import zlib
 
-from sqlalchemy import create_engine, Column, String, JSON
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+import hashing, metrics, patch
 
-from passlib.hash import argon2
+PACKED_JSON, PACKED_ZLIB = b'J', b'Z' # packed user data format headers
+
+class UserExistsException(RuntimeError):
+    """Raised when adding a user whose name is already taken"""
 
 class UserNotFoundException(RuntimeError):
     """Raised when specified user not found in datastore"""
     pass
 
-def hash_password(user_password):
+def hash_password(user_password, policy=None):
     """
     utilty function to securely hash user password
 
     Keyword Parameters:
       user_password  -- (String) plain-text password supplied by user
+      policy  -- (hashing.HashPolicy) hash cost settings to use (Optional)
 
     >>> initial_hash = hash_password('secret2')
     >>> len(initial_hash) # fixed length
     76
     >>> initial_hash[:16] # spot-check hash header
     '$argon2i$v=19$m='
+    >>> cheap_policy = hashing.HashPolicy(memory_cost=512, time_cost=1, parallelism=1)
+    >>> hash_password('secret2', cheap_policy)[:28]
+    '$argon2i$v=19$m=512,t=1,p=1$'
     """
     # generate new salt and secure pw hash
-    return argon2.hash(user_password)
+    with metrics.timed('password_hash'):
+        return (policy or hashing.default_policy).hash(user_password)
 
 def get_user_data(datastore, username):
     """
@@ -50,18 +60,389 @@ def get_user_data(datastore, username):
     Traceback (most recent call last):
        ...
     user.UserNotFoundException: florence.nightingale
+    >>> from cache import LRUCache
+    >>> ds = Datastore(cache=LRUCache())
+    >>> with ds.get_session() as s:
+    ...     ds.add(s, 'salvador.dali', 'fake_hash', '{"address": "earth"}')
+    >>> pprint(get_user_data(ds, 'salvador.dali'))
+    {'data': {'address': 'earth'}, 'username': 'salvador.dali'}
+    >>> pprint(get_user_data(ds, 'salvador.dali')) # from cache
+    {'data': {'address': 'earth'}, 'username': 'salvador.dali'}
+    >>> ds.cache.stats()['hits']
+    1
+    """
+    user, version = get_user_record(datastore, username)
+    return user
+
+def get_user_record(datastore, username, fields=None):
     """
+    Returns tuple: dict representing referenced user & its data version
+
+    The version String changes every time the user's data is replaced,
+    so it can identify a particular representation of the user (e.g.:
+    as an HTTP entity tag).
+
+    Keyword Parameters:
+      datastore  -- (Datastore) object providing user persistance
+      username  -- (String) name of the user to retrieve
+      fields  -- List of Strings, top-level or dotted-path keys of the
+        user data to return (Optional, default: all user data). Where
+        possible, only these fields are read from the database.
+
+    >>> ds = Datastore()
+    >>> with ds.get_session() as s:
+    ...     ds.add(s, 'salvador.dali', 'fake_hash', '{"address": "earth"}')
+    >>> user, version = get_user_record(ds, 'salvador.dali')
+    >>> len(version)
+    32
+    >>> update_user_data(ds, 'salvador.dali', {"address": "mars"})
+    >>> new_user, new_version = get_user_record(ds, 'salvador.dali')
+    >>> new_version == version
+    False
+    >>> get_user_record(ds, 'salvador.dali', ['address', 'phone'])[0]
+    {'username': 'salvador.dali', 'data': {'address': 'mars'}}
+    """
+    if datastore.cache is not None:
+        cache_stamp = datastore.cache.stamp()
+        record = datastore.cache.get(username)
+        if record is not None:
+            user, version = record
+            if fields is not None:
+                return {'username': username, 'data': copy.deepcopy(
+                    project_data(user['data'], fields))}, version
+            return copy_user(user), version
+    if fields is not None:
+        with datastore.get_session() as session:
+            stored = datastore.get_fields(session, username, fields)
+        if stored is None:
+            raise UserNotFoundException(username)
+        projected_data, version = stored
+        return {'username': username, 'data': projected_data}, version
     with datastore.get_session() as session:
-        stored_user = datastore.get(session, username)
-        if stored_user:
-            user = {'username': stored_user.name, 'data': stored_user.data}
-            try: 
-                user['data'] = json.loads(user['data'])
-            except TypeError: # json data isn't a String
-                pass # OK - just continue
-            return user
+        stored = datastore.get_data(session, username)
+        if stored:
+            stored_data, version = stored
+            user = {'username': username, 'data': decode_data(stored_data)}
+            if datastore.cache is not None:
+                record = (copy_user(user), version)
+                datastore.cache.set(username, record, cache_stamp)
+            return user, version
         raise UserNotFoundException(username)
 
+def get_user_records(datastore, usernames, fields=None):
+    """
+    Returns list of dicts representing the referenced users that exist
+
+    Users are returned in the order requested. Any not held in the cache
+    are read together, in a single query.
+
+    Keyword Parameters:
+      datastore  -- (Datastore) object providing user persistance
+      usernames  -- List of Strings, names of the users to retrieve
+      fields  -- List of Strings, top-level or dotted-path keys of the
+        user data to return (Optional, default: all user data)
+
+    >>> from cache import LRUCache
+    >>> ds = Datastore(cache=LRUCache())
+    >>> add_users(ds, [{'new_name': 'pat.ng', 'new_hash': 'FACECAFE'},
+    ...                {'new_name': 'cruz', 'new_hash': 'FACECAFE',
+    ...                 'new_json': {'address': 'earth', 'phone': '555'}}])
+    []
+    >>> get_user_records(ds, ['cruz', 'nobody', 'pat.ng'])
+    [{'username': 'cruz', 'data': {'address': 'earth', 'phone': '555'}}, {'username': 'pat.ng', 'data': None}]
+    >>> get_user_records(ds, ['cruz'], ['phone']) # from cache
+    [{'username': 'cruz', 'data': {'phone': '555'}}]
+    """
+    usernames = list(OrderedDict.fromkeys(usernames)) # drop repeated names
+    users, missing = {}, usernames
+    if datastore.cache is not None:
+        cache_stamp = datastore.cache.stamp()
+        missing = []
+        for username in usernames:
+            record = datastore.cache.get(username)
+            if record is None:
+                missing.append(username)
+            elif fields is not None: # (projected below, then copied)
+                users[username] = dict(record[0])
+            else:
+                users[username] = copy_user(record[0])
+    if missing:
+        with datastore.get_session() as session:
+            stored = datastore.get_many_data(session, missing)
+        for username, (stored_data, version) in stored.items():
+            user = {'username': username, 'data': decode_data(stored_data)}
+            if datastore.cache is not None:
+                datastore.cache.set(username, (copy_user(user), version),
+                                    cache_stamp)
+            users[username] = user
+    records = [users[username] for username in usernames if username in users]
+    if fields is not None:
+        for user in records:
+            user['data'] = copy.deepcopy(project_data(user['data'], fields))
+    return records
+
+def copy_user(user):
+    """
+    Returns copy of a user dict, sharing no (nested) data with it
+
+    Cached users are copied as they are stored & read: so callers may
+    modify the users they are returned, without changing the cache.
+
+    >>> cached = {'username': 'pat.ng', 'data': {'pets': ['cat']}}
+    >>> copy_user(cached)['data']['pets'] is cached['data']['pets']
+    False
+    """
+    return {'username': user['username'], 'data': copy.deepcopy(user['data'])}
+
+def find_user_records(datastore, prefix, after=None, limit=100, fields=None):
+    """
+    Returns list of dicts representing users whose names begin with prefix
+
+    Users are returned in name order, read in a single query. To fetch
+    the next page, call again with after set to the last name returned.
+
+    Keyword Parameters:
+      datastore  -- (Datastore) object providing user persistance
+      prefix  -- String, beginning of the user names to find
+      after  -- String, only return users with names sorting after this
+        (Optional, default: from the first matching name)
+      limit  -- Integer, maximum number of users to return
+      fields  -- List of Strings, top-level or dotted-path keys of the
+        user data to return (Optional, default: all user data)
+
+    >>> ds = Datastore()
+    >>> add_users(ds, [{'new_name': name, 'new_hash': 'FACECAFE'}
+    ...                for name in ['pat.ng', 'pat.o', 'paul', 'cruz']])
+    []
+    >>> [user['username'] for user in find_user_records(ds, 'pa', limit=2)]
+    ['pat.ng', 'pat.o']
+    >>> [user['username'] for user in find_user_records(ds, 'pa', 'pat.o')]
+    ['paul']
+    """
+    with datastore.get_session() as session:
+        stored = datastore.find_data(session, prefix, after, limit)
+    records = []
+    for username, stored_data, version in stored:
+        data = decode_data(stored_data)
+        if fields is not None:
+            data = project_data(data, fields)
+        records.append({'username': username, 'data': data})
+    return records
+
+def list_users(datastore, after=None, limit=100, fields=None):
+    """
+    Returns tuple: list of dicts representing users (in name order), &
+    the name to continue listing after (None, if no more users follow)
+
+    Keyword Parameters:
+      datastore  -- (Datastore) object providing user persistance
+      after  -- String, name the previous page ended with (Optional,
+        default: list from the first user)
+      limit  -- Integer, maximum number of users to return
+      fields  -- List of Strings, top-level or dotted-path keys of the
+        user data to return (Optional, default: all user data)
+
+    >>> ds = Datastore()
+    >>> add_users(ds, [{'new_name': name, 'new_hash': 'FACECAFE'}
+    ...                for name in ['pat.ng', 'paul', 'cruz']])
+    []
+    >>> users, after = list_users(ds, limit=2)
+    >>> [user['username'] for user in users], after
+    (['cruz', 'pat.ng'], 'pat.ng')
+    >>> users, after = list_users(ds, after, limit=2)
+    >>> [user['username'] for user in users], after
+    (['paul'], None)
+    """
+    # one extra user shows if another page follows
+    records = find_user_records(datastore, '', after, limit + 1, fields)
+    if len(records) > limit:
+        return records[:limit], records[limit - 1]['username']
+    return records, None
+
+def find_indexed_users(datastore, field, value, prefix=False, after=None,
+                       limit=100, fields=None):
+    """
+    Returns tuple: list of dicts representing users whose data field has
+    value (or begins with it, if prefix), & the (value, name) pair to
+    continue finding users after (None, if no more users follow)
+
+    Users are found from the datastore's index of the field, if it is one
+    of its indexed_fields, ordered by field value, then name.
+
+    Keyword Parameters:
+      datastore  -- (Datastore) object providing user persistance
+      field  -- String, top-level or dotted-path key of the user data
+      value  -- String, field value to find (see: index_values)
+      prefix  -- Boolean, if True find field values beginning with value
+      after  -- tuple: value & name the previous page ended with
+        (Optional, default: from the first match)
+      limit  -- Integer, maximum number of users to return
+      fields  -- List of Strings, top-level or dotted-path keys of the
+        user data to return (Optional, default: all user data)
+
+    >>> ds = Datastore(indexed_fields=['email'])
+    >>> add_users(ds, [{'new_name': name, 'new_hash': 'FACECAFE',
+    ...                 'new_json': {'email': email}} for name, email in [
+    ...     ('pat.ng', 'pat@example.org'), ('cruz', 'cruz@example.org'),
+    ...     ('paul', 'paul@example.com')]])
+    []
+    >>> find_indexed_users(ds, 'email', 'cruz@example.org')
+    ([{'username': 'cruz', 'data': {'email': 'cruz@example.org'}}], None)
+    >>> users, after = find_indexed_users(ds, 'email', 'pa', prefix=True,
+    ...                                   limit=1, fields=[])
+    >>> users, after
+    ([{'username': 'pat.ng', 'data': {}}], ('pat@example.org', 'pat.ng'))
+    >>> find_indexed_users(ds, 'email', 'pa', True, after, fields=[])
+    ([{'username': 'paul', 'data': {}}], None)
+    """
+    # one extra match shows if another page follows
+    with datastore.get_session() as session:
+        matches = datastore.find_indexed(session, field, value, prefix,
+                                         after, limit + 1)
+    next_after = None
+    if len(matches) > limit:
+        matches, next_after = matches[:limit], matches[limit - 1]
+    records = get_user_records(datastore, [name for indexed, name in matches],
+                               fields)
+    return records, next_after
+
+def project_data(data, fields):
+    """
+    Returns dict of only the referenced fields of user data
+
+    Keyword Parameters:
+      data  -- user data (e.g.: Dict)
+      fields  -- List of Strings, top-level or dotted-path keys. Fields
+        not present in data are omitted.
+
+    >>> project_data({'a': {'b': 1, 'c': 2}, 'd': 3}, ['a.b', 'd', 'x.y'])
+    {'a': {'b': 1}, 'd': 3}
+    """
+    projected = {}
+    for field in fields:
+        keys, value = field.split('.'), data
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                break # field not present
+            value = value[key]
+        else:
+            set_field(projected, keys, value)
+    return projected
+
+def set_field(projected, keys, value):
+    """
+    Store value at the (nested) location of keys, in projected data dict
+
+    >>> projected = {'a': {'b': 1}}
+    >>> set_field(projected, ['a', 'c'], 2)
+    >>> projected
+    {'a': {'b': 1, 'c': 2}}
+    """
+    for key in keys[:-1]:
+        if isinstance(projected.get(key), dict):
+            projected[key] = dict(projected[key]) # dont alter user data
+        else:
+            projected[key] = {}
+        projected = projected[key]
+    projected[keys[-1]] = value
+
+def index_values(data, field):
+    """
+    Returns set of Strings, the values of a user data field as indexed
+
+    Strings are indexed as they are, other scalars as JSON text (e.g.:
+    'true', '42') & each scalar in a List separately. Objects & nulls
+    aren't indexed.
+
+    Keyword Parameters:
+      data  -- user data (e.g.: Dict)
+      field  -- String, top-level or dotted-path key
+
+    >>> data = {'email': 'pat@example.org', 'tags': ['a', 1, None, {}]}
+    >>> index_values(data, 'email')
+    {'pat@example.org'}
+    >>> sorted(index_values(data, 'tags'))
+    ['1', 'a']
+    >>> index_values(data, 'address.city')
+    set()
+    """
+    value = data
+    for key in field.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return set() # field not present
+        value = value[key]
+    values = value if isinstance(value, list) else [value]
+    return set(item if isinstance(item, str) else json.dumps(item)
+               for item in values
+               if item is not None and not isinstance(item, (dict, list)))
+
+def decode_data(stored_data):
+    """
+    Returns stored user data, parsing it if it was stored as JSON text
+
+    >>> decode_data('{"address": "earth"}')
+    {'address': 'earth'}
+    >>> decode_data(['my', {'super': 'list'}])
+    ['my', {'super': 'list'}]
+    >>> decode_data(pack_data('{"address": "earth"}'))
+    {'address': 'earth'}
+    """
+    if isinstance(stored_data, bytes):
+        return unpack_data(stored_data)
+    try: 
+        return json.loads(stored_data)
+    except TypeError: # json data isn't a String
+        return stored_data # OK - just continue
+
+def pack_data(data, compress_threshold=0):
+    """
+    Returns user data, packed as compact bytes (or None, for no data)
+
+    JSON text (e.g.: from a signup form) is parsed first, so all data is
+    stored the same way & is never parsed twice when read. Packs longer
+    than compress_threshold bytes are compressed (if that is smaller).
+
+    Keyword Parameters:
+      data  -- Dict, List, or String representing JSON data
+      compress_threshold  -- Integer, bytes (0: never compress)
+
+    >>> pack_data('{"address": "earth"}')
+    b'J{"address":"earth"}'
+    >>> packed = pack_data({'works': ['x'] * 1000}, compress_threshold=100)
+    >>> packed[:1], len(packed) < 100
+    (b'Z', True)
+    >>> unpack_data(packed) == {'works': ['x'] * 1000}
+    True
+    """
+    if data is None:
+        return None
+    if isinstance(data, str):
+        try:
+            data = json.loads(data)
+        except ValueError:
+            pass # plain text, kept as a JSON String
+    encoded = json.dumps(data, ensure_ascii=False,
+                         separators=(',', ':')).encode('utf-8')
+    if compress_threshold and len(encoded) > compress_threshold:
+        compressed = zlib.compress(encoded)
+        if len(compressed) + 1 < len(encoded):
+            return PACKED_ZLIB + compressed
+    return PACKED_JSON + encoded
+
+def unpack_data(packed):
+    """
+    Returns user data, from pack_data bytes
+
+    >>> unpack_data(b'J["my",{"super":"list"}]')
+    ['my', {'super': 'list'}]
+    """
+    header, body = packed[:1], packed[1:]
+    if header == PACKED_ZLIB:
+        body = zlib.decompress(body)
+    elif header != PACKED_JSON:
+        raise ValueError('Unknown packed data format: {!r}'.format(header))
+    return json.loads(body.decode('utf-8'))
+
 def get_user_hash(datastore, username):
     """
     Returns datastore secure hash for referenced user
@@ -81,11 +462,78 @@ def get_user_hash(datastore, username):
     Traceback (most recent call last):
        ...
     user.UserNotFoundException: florence.nightingale
+    >>> from cache import LRUCache
+    >>> ds = Datastore(unknown_cache=LRUCache(ttl=5))
+    >>> for attempt in range(2):
+    ...     try:
+    ...         get_user_hash(ds, 'florence.nightingale')
+    ...     except UserNotFoundException:
+    ...         pass
+    >>> ds.unknown_cache.stats()['hits'] # 2nd attempt: no database query
+    1
+    >>> add_user(ds, 'florence.nightingale', hash)
+    >>> get_user_hash(ds, 'florence.nightingale') == hash
+    True
     """
+    unknown_cache = datastore.unknown_cache
+    if unknown_cache is not None:
+        if unknown_cache.get(username):
+            raise UserNotFoundException(username) # recently looked up
+        cache_stamp = unknown_cache.stamp()
     with datastore.get_session() as session:
-        stored_user = datastore.get(session, username)
-        if stored_user:
-            return stored_user.pw_hash
+        stored_hash = datastore.get_hash(session, username)
+    if stored_hash is not None:
+        return stored_hash
+    if unknown_cache is not None:
+        unknown_cache.set(username, True, cache_stamp)
+    raise UserNotFoundException(username)
+
+def add_user(datastore, new_name, new_hash, new_json=None):
+    """
+    Persist a new user
+
+    Raises UserExistsException, if a user named new_name exists
+
+    Keyword Parameters:
+    datastore  -- Datastore, object providing user persistance
+    new_name  -- String, name of the new user
+    new_hash  -- String, secure hash of the new user's password
+    new_json  -- Dict, List, or String representing JSON data (Optional)
+
+    >>> ds = Datastore()
+    >>> add_user(ds, 'salvador.dali', 'fake_hash', {'address': 'earth'})
+    >>> get_user_data(ds, 'salvador.dali')['data']
+    {'address': 'earth'}
+    """
+    try:
+        with datastore.get_session() as session:
+            datastore.add(session, new_name, new_hash, new_json)
+    finally:
+        datastore.invalidate(new_name) # after commit: drop stale lookups
+
+def update_user_hash(datastore, username, new_hash):
+    """
+    Replace secure password hash stored for referenced user
+
+    Keyword Parameters:
+    datastore  -- Datastore, object providing user persistance
+    username  -- String, name of user to update hash for
+    new_hash  -- String, new secure hash of the user's password
+
+    >>> ds = Datastore()
+    >>> with ds.get_session() as s:
+    ...     ds.add(s, 'salvador.dali', 'fake_hash')
+    >>> update_user_hash(ds, 'salvador.dali', 'FACECAFE')
+    >>> get_user_hash(ds, 'salvador.dali')
+    'FACECAFE'
+    >>> update_user_hash(ds, 'florence.nightingale', 'FACECAFE')
+    Traceback (most recent call last):
+       ...
+    user.UserNotFoundException: florence.nightingale
+    """
+    with datastore.get_session() as session:
+        if datastore.update(session, username, pw_hash=new_hash):
+            return
         raise UserNotFoundException(username)
 
 def update_user_data(datastore, username, new_data):
@@ -110,12 +558,108 @@ def update_user_data(datastore, username, new_data):
        ...
     user.UserNotFoundException: florence.nightingale
     """
-    with datastore.get_session() as session:
-        stored_user = datastore.get(session, username)
-        if stored_user:
-            stored_user.data = new_data
-            return
-        raise UserNotFoundException(username)
+    try:
+        with datastore.get_session() as session:
+            if datastore.update(session, username, data=new_data,
+                                version=datastore.new_version()):
+                return
+            raise UserNotFoundException(username)
+    finally:
+        datastore.invalidate(username) # after commit: drop stale data
+
+def update_users_data(datastore, updates):
+    """
+    Replace JSON data of a batch of users, in a single transaction
+
+    Returns names of any users not updated (as they don't exist)
+
+    Keyword Parameters:
+    datastore  -- Datastore, object providing user persistance
+    updates  -- List of tuples: username, new JSON data (e.g.: Dict) &
+      new version String (e.g.: from Datastore.new_version)
+
+    >>> ds = Datastore()
+    >>> with ds.get_session() as s:
+    ...     ds.add(s, 'salvador.dali', 'fake_hash')
+    >>> update_users_data(ds, [('salvador.dali', {'address': 'mars'}, 'v2'),
+    ...                        ('florence.nightingale', None, 'v2')])
+    ['florence.nightingale']
+    >>> get_user_record(ds, 'salvador.dali')
+    ({'username': 'salvador.dali', 'data': {'address': 'mars'}}, 'v2')
+    """
+    try:
+        missing_names = []
+        with datastore.get_session() as session:
+            for username, new_data, version in updates:
+                if not datastore.update(session, username, data=new_data,
+                                        version=version):
+                    missing_names.append(username)
+        return missing_names
+    finally:
+        for username, new_data, version in updates: # after commit
+            datastore.invalidate(username)
+
+def patch_user_data(datastore, username, patch_document,
+                    patch_type=patch.MERGE_PATCH, retries=3):
+    """
+    Partially update JSON data stored for referenced user
+
+    The patch is applied by the database, if the datastore supports it.
+    Otherwise the data is read, patched & written back only if it was not
+    changed meanwhile (per its version), retrying up to retries times.
+
+    Keyword Parameters:
+    datastore  -- Datastore, object providing user persistance
+    username  -- String, name of user to update data for
+    patch_document  -- JSON Merge Patch (e.g.: Dict), or JSON Patch (List
+      of operation Dicts) to apply to the user's data
+    patch_type  -- String, patch.MERGE_PATCH or patch.JSON_PATCH
+    retries  -- Integer, attempts to apply the patch to unchanged data
+
+    >>> from pprint import pprint
+    >>> ds = Datastore()
+    >>> with ds.get_session() as s:
+    ...     ds.add(s, 'salvador.dali', 'fake_hash', {'address': 'earth', 'age': 84})
+    >>> patch_user_data(ds, 'salvador.dali', {'address': 'mars', 'age': None})
+    >>> pprint(get_user_data(ds, 'salvador.dali'))
+    {'data': {'address': 'mars'}, 'username': 'salvador.dali'}
+    >>> patch_user_data(ds, 'salvador.dali', [{'op': 'add', 'path': '/pets',
+    ...                                        'value': ['cat']}], patch.JSON_PATCH)
+    >>> get_user_data(ds, 'salvador.dali')['data']['pets']
+    ['cat']
+    >>> patch_user_data(ds, 'florence.nightingale', {'address': 'mars'})
+    Traceback (most recent call last):
+       ...
+    user.UserNotFoundException: florence.nightingale
+    """
+    if patch_type == patch.JSON_PATCH:
+        operations = patch.validate_operations(patch_document)
+        apply_patch = lambda data: patch.apply_json_patch(data, operations)
+        apply_in_database = lambda session, version: datastore.patch_data(
+            session, username, operations, version)
+    elif patch_type == patch.MERGE_PATCH:
+        apply_patch = lambda data: patch.merge_patch(data, patch_document)
+        apply_in_database = lambda session, version: datastore.merge_data(
+            session, username, patch_document, version)
+    else:
+        raise ValueError('Unknown patch type: {}'.format(patch_type))
+    try:
+        with datastore.get_session() as session:
+            if apply_in_database(session, datastore.new_version()):
+                return
+        for attempt in range(retries):
+            with datastore.get_session() as session:
+                stored = datastore.get_data(session, username)
+                if stored is None:
+                    raise UserNotFoundException(username)
+                stored_data, version = stored
+                new_data = apply_patch(decode_data(stored_data))
+                if datastore.update(session, username, expected_version=version,
+                                    data=new_data, version=datastore.new_version()):
+                    return
+        raise patch.PatchConflictException('User data is changing, try again')
+    finally:
+        datastore.invalidate(username) # after commit: drop stale data
 
 def delete_user(datastore, username):
     """
@@ -138,86 +682,349 @@ def delete_user(datastore, username):
        ...
     user.UserNotFoundException: salvador.dali
     """
-    with datastore.get_session() as session:
-        stored_user = datastore.get(session, username)
-        if stored_user:
-            session.delete(stored_user) # remove
-            return
-        raise UserNotFoundException(username)
+    try:
+        with datastore.get_session() as session:
+            if datastore.delete(session, username):
+                return
+            raise UserNotFoundException(username)
+    finally:
+        datastore.invalidate(username) # after commit: drop stale data
 
-class Datastore:
+def add_users(datastore, new_users):
     """
-    Class encapsulating a User persistance backend
+    Persist a batch of new users, returns names of any users not added
+
+    The batch is added in a single bulk insert. If that fails (e.g.: as
+    some users already exist) users are retried one at a time, skipping
+    any that already exist.
+
+    Keyword Parameters:
+    datastore  -- Datastore, object providing user persistance
+    new_users  -- List of Dicts, with the keyword parameters for
+      Datastore.add (new_name, new_hash & optional new_json)
 
     >>> ds = Datastore()
-    >>> with ds.get_session() as s:
-    ...     ds.add(s, 'salvador.dali', 'FACECAFE')
-    >>> user = None # test fetch
-    >>> with ds.get_session() as s:
-    ...     user = ds.get(s, 'salvador.dali')
-    ...     user.name
-    ...     user.pw_hash
-    'salvador.dali'
+    >>> add_users(ds, [{'new_name': 'pat.ng', 'new_hash': 'FACECAFE'},
+    ...                {'new_name': 'cruz', 'new_hash': 'FACECAFE'}])
+    []
+    >>> add_users(ds, [{'new_name': 'pat.ng', 'new_hash': 'FACECAFE'},
+    ...                {'new_name': 'salvador.dali', 'new_hash': 'FACECAFE'}])
+    ['pat.ng']
+    >>> get_user_hash(ds, 'salvador.dali')
     'FACECAFE'
     """
-    Base = declarative_base()
+    try:
+        try:
+            with datastore.get_session() as session:
+                datastore.add_many(session, new_users)
+            return []
+        except UserExistsException:
+            pass # find the user(s) at fault
+        failed_names = []
+        with datastore.get_session() as session:
+            for new_user in new_users:
+                if not datastore.insert(session, **new_user):
+                    failed_names.append(new_user['new_name'])
+        return failed_names
+    finally:
+        for new_user in new_users: # after commit: drop stale lookups
+            datastore.invalidate(new_user['new_name'])
+
+def export_users(datastore, batch_size=1000):
+    """
+    Returns generator, yielding a dict for each user (with password hash)
 
-    class User(Base):
-        """Define user storage model"""
-        __tablename__ = 'user'
+    Users are read incrementally, batch_size at a time, rather than all
+    at once.
 
-        name = Column(String, primary_key=True)
-        pw_hash = Column(String)
-        data = Column(JSON)
+    Keyword Parameters:
+    datastore  -- Datastore, object providing user persistance
+    batch_size  -- Integer, number of users to fetch from the db at once
+
+    >>> from pprint import pprint
+    >>> ds = Datastore()
+    >>> with ds.get_session() as s:
+    ...     ds.add(s, 'salvador.dali', 'FACECAFE', '{"address": "earth"}')
+    >>> pprint(list(export_users(ds)))
+    [{'data': {'address': 'earth'},
+      'pw_hash': 'FACECAFE',
+      'username': 'salvador.dali'}]
+    """
+    with datastore.get_session() as session:
+        for stored_user in datastore.iter_users(session, batch_size):
+            yield {'username': stored_user.name,
+                   'pw_hash': stored_user.pw_hash,
+                   'data': decode_data(stored_user.data)}
 
-    def __init__(self):
-        """Default to an ephemeral SQLite3 backend"""
-        # create a tempfile for this instance
-        self._db_file = NamedTemporaryFile()
-        url = 'sqlite:///{}'.format(self._db_file.name)
-        # create db & migrate declarative schema
-        self.engine = create_engine(url)
-        self.Base.metadata.create_all(self.engine)
+class BaseDatastore(ABC):
+    """
+    Abstract interface of a User persistance backend
 
-        self.SessionFactory = sessionmaker()
-        self.SessionFactory.configure(bind=self.engine)
+    The module functions (get_user_data, update_user_data, etc.) access
+    users only through these methods, so alternative backends can be
+    used by implementing them. Every method that reads or writes takes
+    a session, obtained from get_session(), which is committed at the
+    end of the 'with' block (or rolled back, if an exception is raised).
+    Returned User objects must provide attributes: name, pw_hash, data
+    & version, & changes to them must be persisted on commit.
 
-    def __del__(self):
-        """Clean up db"""
-        self._db_file.close()
+    Backends should override the default insert, get_hash, get_data &
+    update methods (implemented here in terms of get & add) with single
+    statements that read or write only the columns needed, & may
+    override get_fields, merge_data & patch_data to read or patch parts
+    of the JSON data in place.
+    """
+    cache = None # optional cache.LRUCache of recently read user data
+    unknown_cache = None # optional cache.LRUCache of names found not to exist
+    indexed_fields = () # user data fields (dotted-path keys) to index
 
-    @contextmanager
+    @abstractmethod
     def get_session(self):
-        """Create a transactional storage-access session"""
-        session = self.SessionFactory()
-        try:
-            yield session
-            session.commit()
-        except:
-            session.rollback()
-            raise
-        finally:
-            session.close()
+        """Returns context manager for a transactional storage session"""
 
+    @abstractmethod
     def add(self, session, new_name, new_hash, new_json=None):
         """
         Persist a new User to the datastore
 
-        >>> ds = Datastore()
-        >>> with ds.get_session() as s:
-        ...     ds.add(s, 'salvador.dali', 'FACECAFE')
+        Raises UserExistsException, if a User named new_name exists
         """
-        session.add(self.User(name=new_name, pw_hash=new_hash, data=new_json))
 
+    def insert(self, session, new_name, new_hash, new_json=None):
+        """Persist a new User, returns False if the name is already taken"""
+        if self.get(session, new_name) is not None:
+            return False
+        self.add(session, new_name, new_hash, new_json)
+        return True
+
+    def add_many(self, session, new_users):
+        """
+        Persist a batch of new Users to the datastore
+
+        Keyword Parameters:
+          new_users  -- List of Dicts, with the keyword parameters for add
+        """
+        for new_user in new_users:
+            self.add(session, **new_user)
+
+    @abstractmethod
     def get(self, session, user_name):
+        """Returns referenced User, or None if user doesn't exist"""
+
+    def get_hash(self, session, user_name):
+        """Returns referenced User's pw_hash, or None if user doesn't exist"""
+        stored_user = self.get(session, user_name)
+        return stored_user.pw_hash if stored_user else None
+
+    def get_data(self, session, user_name):
+        """
+        Returns tuple: referenced User's data & version, or None if user
+        doesn't exist
         """
-        Retrieve a User from the datastore
+        stored_user = self.get(session, user_name)
+        return (stored_user.data, stored_user.version) if stored_user else None
 
-        >>> ds = Datastore()
-        >>> with ds.get_session() as s:
-        ...     ds.get(s, 'UserDoesnt@exist')
+    def get_many_data(self, session, user_names):
+        """
+        Returns dict: tuple of data & version, for each referenced User
+        that exists (by name)
+        """
+        found = {}
+        for user_name in user_names:
+            stored = self.get_data(session, user_name)
+            if stored is not None:
+                found[user_name] = stored
+        return found
+
+    def find_data(self, session, prefix, after=None, limit=100):
+        """
+        Returns list of tuples: name, data & version of each User whose
+        name begins with prefix (& sorts after `after`, if provided), in
+        name order, up to limit. An empty prefix matches every User.
+        """
+        found = []
+        for stored_user in self.iter_users(session, batch_size=limit):
+            if not stored_user.name.startswith(prefix):
+                continue
+            if after is not None and stored_user.name <= after:
+                continue
+            found.append((stored_user.name, stored_user.data, stored_user.version))
+            if len(found) >= limit:
+                break
+        return sorted(found)
+
+    def find_indexed(self, session, field, value, prefix=False, after=None,
+                     limit=100):
+        """
+        Returns list of tuples: indexed value & name of each User whose
+        data field (a dotted-path key) has value (or a value beginning
+        with it, if prefix), sorting after the `after` tuple (if provided),
+        in order, up to limit
+
+        Implemented here by reading every User: backends should answer
+        from an index of the indexed_fields (see: index_values)
+        """
+        matches = []
+        for stored_user in self.iter_users(session, 1000):
+            for indexed in index_values(decode_data(stored_user.data), field):
+                if indexed == value or (prefix and indexed.startswith(value)):
+                    matches.append((indexed, stored_user.name))
+        matches.sort()
+        if after is not None:
+            matches = [match for match in matches if match > tuple(after)]
+        return matches[:limit]
+
+    def get_fields(self, session, user_name, fields):
+        """
+        Returns tuple: dict of the referenced fields (dotted-path keys) of
+        the User's data & its version, or None if user doesn't exist
+        """
+        stored = self.get_data(session, user_name)
+        if stored is None:
+            return None
+        stored_data, version = stored
+        return project_data(decode_data(stored_data), fields), version
+
+    def update(self, session, user_name, expected_version=None, **values):
+        """
+        Replace column values (e.g.: pw_hash) of the referenced User
+
+        Returns False if the user doesn't exist, or if expected_version
+        is provided & the User's version differs
+        """
+        stored_user = self.get(session, user_name)
+        if stored_user is None:
+            return False
+        if expected_version is not None and stored_user.version != expected_version:
+            return False
+        for column, value in values.items():
+            setattr(stored_user, column, value)
+        return True
+
+    def merge_data(self, session, user_name, merge_patch, new_version):
+        """
+        Apply a JSON Merge Patch to the User's data, within the database
+
+        Returns False if the patch was not applied (e.g.: the backend can't
+        patch data, or the User doesn't exist)
+        """
+        return False
 
+    def patch_data(self, session, user_name, operations, new_version):
+        """
+        Apply JSON Patch operations to the User's data, within the database
+
+        Returns False if the patch was not applied (e.g.: the backend can't
+        apply these operations, or the User doesn't exist)
+        """
+        return False
+
+    @abstractmethod
+    def iter_users(self, session, batch_size):
+        """Returns iterator over all Users, fetched batch_size at a time"""
+
+    @abstractmethod
+    def delete(self, session, user_name):
+        """Remove referenced User, returns False if user doesn't exist"""
+
+    @staticmethod
+    def new_version():
+        """Returns new, unique String to identify a version of User data"""
+        return uuid.uuid4().hex
+
+    def invalidate(self, user_name):
+        """
+        Discard any cached data (or absence) for referenced User
+
+        >>> from cache import LRUCache
+        >>> ds = Datastore(cache=LRUCache())
+        >>> ds.cache.set('salvador.dali', {'username': 'salvador.dali'})
+        >>> ds.invalidate('salvador.dali')
+        >>> ds.cache.get('salvador.dali') is None
+        True
+        """
+        if self.cache is not None:
+            self.cache.invalidate(user_name)
+        if self.unknown_cache is not None:
+            self.unknown_cache.invalidate(user_name)
+
+class Datastore:
+    """
+    Class encapsulating the default (SQLAlchemy) User persistance backend
+
+    SQLAlchemy is only imported, & the database engine (& any tempfile)
+    only created, on first use: so importing the API (e.g.: in each new
+    WSGI process) stays quick. Call warmup() to create them ahead of
+    time. All BaseDatastore methods are those of the sqlstore.SQLDatastore.
+
+    >>> ds = Datastore()
+    >>> ds.loaded
+    False
+    >>> with ds.get_session() as s:
+    ...     ds.add(s, 'salvador.dali', 'FACECAFE')
+    >>> ds.loaded
+    True
+    """
+    def __init__(self, url=None, engine_options=None, cache=None,
+                 sqlite_busy_timeout=5000, unknown_cache=None,
+                 data_format='json', compress_threshold=0, indexed_fields=()):
+        """
+        Keyword Parameters (see: sqlstore.SQLDatastore):
+          url  -- String, SQLAlchemy database URL (Default: a new tempfile)
+          engine_options  -- Dict, additional create_engine() keyword
+            arguments (Optional)
+          cache  -- cache.LRUCache, to hold recently read user data
+            (Optional, default: no caching)
+          sqlite_busy_timeout  -- Integer, milliseconds a SQLite
+            connection waits for another writer's lock
+          unknown_cache  -- cache.LRUCache, to hold names recently found
+            not to exist (Optional, default: no caching)
+          data_format  -- String, how user data is stored: 'json' or
+            'packed' (see: pack_data)
+          compress_threshold  -- Integer, bytes of packed data above
+            which it is compressed (0: never)
+          indexed_fields  -- List of Strings, top-level or dotted-path
+            keys of the user data to index (see: find_indexed_users)
+        """
+        self.cache = cache
+        self.unknown_cache = unknown_cache
+        self._options = {'url': url, 'engine_options': engine_options,
+                         'cache': cache, 'unknown_cache': unknown_cache,
+                         'sqlite_busy_timeout': sqlite_busy_timeout,
+                         'data_format': data_format,
+                         'compress_threshold': compress_threshold,
+                         'indexed_fields': indexed_fields}
+        self._backend = None # created on first use (not at import time)
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        """True if the backend (& its database engine) has been created"""
+        return self._backend is not None
+
+    @property
+    def backend(self):
+        """sqlstore.SQLDatastore, created on first access"""
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    import sqlstore # deferred: SQLAlchemy is slow to import
+                    self._backend = sqlstore.SQLDatastore(**self._options)
+        return self._backend
+
+    def warmup(self):
+        """
+        Create the backend & open a first database connection
+
+        >>> ds = Datastore()
+        >>> ds.warmup()
+        >>> ds.loaded
+        True
         """
-        user = session.query(self.User).filter_by(name=user_name).one_or_none()
-        return user
+        with self.backend.engine.connect():
+            pass # the pool keeps the connection, for the first request
 
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name) # private, or not initialized yet
+        return getattr(self.backend, name)
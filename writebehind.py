@@ -0,0 +1,154 @@
+"""
+Module defining a write-behind buffer, coalescing user data replacements
+
+Clients which save on every edit send bursts of updates to the same user.
+Buffered, only the latest update for each user is kept until the next
+flush, which then writes all pending users in one transaction.
+"""
+import atexit
+import logging
+import threading
+
+import user
+
+class WriteBuffer:
+    """
+    Class encapsulating pending user data writes, flushed periodically
+
+    Each put replaces any write still pending for that user. Pending data
+    is returned by get (so users read their own writes before a flush), &
+    is written every window seconds by a background thread, when max_pending
+    users have writes pending, or on flush (e.g.: at interpreter exit).
+
+    >>> ds = user.Datastore()
+    >>> with ds.get_session() as s:
+    ...     ds.add(s, 'pat.ng', 'FACECAFE')
+    >>> buffer = WriteBuffer(ds, window=60)
+    >>> for draft in ['H', 'He', 'Hello']:
+    ...     version = buffer.put('pat.ng', {'note': draft})
+    >>> buffer.get('pat.ng') == ({'note': 'Hello'}, version)
+    True
+    >>> user.get_user_data(ds, 'pat.ng')['data'] is None # not yet written
+    True
+    >>> buffer.flush()
+    1
+    >>> user.get_user_record(ds, 'pat.ng') == ({'username': 'pat.ng',
+    ...     'data': {'note': 'Hello'}}, version)
+    True
+    >>> buffer.close()
+    >>> sorted(buffer.stats().items())
+    [('coalesced', 2), ('flushed', 1), ('flushes', 1), ('pending', 0), ('writes', 3)]
+    """
+    def __init__(self, datastore, window, max_pending=10000):
+        """
+        Keyword Parameters:
+          datastore  -- Datastore, object providing user persistance
+          window  -- Number, seconds between background flushes
+          max_pending  -- Integer, users with pending writes which trigger
+            an immediate flush (by the writer)
+        """
+        self.datastore = datastore
+        self.window = window
+        self.max_pending = max_pending
+        self._pending = {} # username: (new data, new version)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock() # one flush at a time, in order
+        self._counters = {'writes': 0, 'coalesced': 0, 'flushes': 0,
+                          'flushed': 0}
+        self._stop = threading.Event()
+        self._thread = None # created on first use (not at import time)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, username, new_data):
+        """
+        Buffer replacement JSON data for referenced user, returns its version
+
+        The user is expected to exist: writes for users not found when
+        flushed are logged & discarded.
+        """
+        version = self.datastore.new_version()
+        with self._lock:
+            if username in self._pending:
+                self._counters['coalesced'] += 1
+            self._pending[username] = (new_data, version)
+            self._counters['writes'] += 1
+            full = len(self._pending) >= self.max_pending
+            closed = self._stop.is_set() # then write through
+            if self._thread is None and not closed:
+                self._start()
+        if full or closed:
+            self.flush()
+        return version
+
+    def get(self, username):
+        """Returns tuple: pending data & version for user, or None"""
+        return self._pending.get(username)
+
+    def discard(self, username):
+        """Drop any pending write for referenced user (e.g.: once deleted)"""
+        with self._lock:
+            self._pending.pop(username, None)
+
+    def flush(self, usernames=None):
+        """
+        Write pending data in a single transaction, returns number of users
+
+        Keyword Parameters:
+          usernames  -- List of Strings, users whose pending writes to
+            flush (Optional, default: all users)
+        """
+        with self._flush_lock:
+            with self._lock:
+                if usernames is None:
+                    batch = dict(self._pending)
+                else:
+                    batch = dict((name, self._pending[name]) for name in usernames
+                                 if name in self._pending)
+            if not batch:
+                return 0
+            missing_names = user.update_users_data(self.datastore, [
+                (name, new_data, version)
+                for name, (new_data, version) in batch.items()])
+            with self._lock:
+                for name, (new_data, version) in batch.items():
+                    if self._pending.get(name, (None, None))[1] == version:
+                        del self._pending[name] # (unless replaced meanwhile)
+                self._counters['flushes'] += 1
+                self._counters['flushed'] += len(batch)
+        if missing_names:
+            logger = logging.getLogger(WriteBuffer.__name__)
+            logger.warning('Discarded writes for missing users: %s',
+                           ', '.join(sorted(missing_names)))
+        return len(batch)
+
+    def stats(self):
+        """Returns dict of counters, & number of users with writes pending"""
+        with self._lock:
+            return dict(self._counters, pending=len(self._pending))
+
+    def _run(self):
+        """Flush pending writes every window seconds, until stopped"""
+        logger = logging.getLogger(WriteBuffer.__name__)
+        while not self._stop.wait(self.window):
+            try:
+                self.flush()
+            except Exception:
+                # pending writes are kept, & retried next window
+                logger.exception('Flush of buffered writes failed')
+
+    def _start(self):
+        """Begin flushing periodically, in a background thread"""
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='write-behind')
+        self._thread.start()
+        atexit.register(self.close) # dont lose writes, on shutdown
+
+    def close(self):
+        """Stop background flushing, & write any pending data"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()